@@ -1,157 +1,380 @@
 import os
-from PIL import Image
-import pyodbc
-import io
-from rembg import remove
+from PIL import Image, ImageOps
+from corner_probe import has_black_corner
+from compositing import cutout, flatten_image
+from color_key import color_key_mask, PATH_COLOR_KEY, PATH_MODEL
+from manifest import (open_manifest, DEFAULT_MANIFEST_NAME, STATUS_CLASSIFIED, STATUS_DONE, STATUS_ERROR,
+                      CLASS_BLACK, CLASS_OTHER)
+import logging
+import threading
+from collections import Counter
+from session_pool import get_session
+from pipeline import Pipeline, Stage
+from barcode_lookup import lookup_barcodes, BarcodeCache
+from file_copy import Copier, DEFAULT_STRATEGY, copy_file
+from low_res import open_reduced, low_res_mask
+from lazy_import import LazyModule, wants_import_profile, print_import_profile
+from metrics import get_metrics, reset_metrics, setup_logging, log_event, DEFAULT_METRICS_NAME
+from scanner import scan_images, DEFAULT_INDEX_NAME, DEFAULT_SCAN_WORKERS, LISTING_DEPTH
+from scheduler import MemoryBudget, job_cost, default_budget, SESSION_BYTES
+from dedup import Deduplicator
+from encoder import encode_outputs, write_outputs, DEFAULT_OUTPUTS, DEFAULT_ENCODE_WORKERS
 
-def has_black_color(image_path):
+# Loaded when a stage first needs them, so scan-only runs start fast
+pyodbc = LazyModule('pyodbc')
+rembg = LazyModule('rembg')
+
+log = logging.getLogger('abcd')
+log.addHandler(logging.NullHandler())  # Silent when imported as a library; entry points call setup_logging
+
+CONNECTION_STRING = (
+    "DRIVER={SQL Server};"
+    "SERVER=FOODWORLD\\SQLEXPRESS;"
+    "DATABASE=foodworld;"
+    "UID=skienuser;"
+    "PWD=skiendberp@123;"
+)
+BARCODE_CACHE_NAME = ".barcodes.sqlite"
+
+# Threads per stage of process_images (see pipeline.Stage), plus the copy and directory listing pools
+DEFAULT_CONCURRENCY = {"scan": 1, "list": DEFAULT_SCAN_WORKERS, "probe": 4, "copy": 4, "resolve": 1, "infer": 1,
+                       "encode": DEFAULT_ENCODE_WORKERS, "write": 2}
+# Folders per barcode lookup, and seconds to wait for a batch to fill
+RESOLVE_BATCH_SIZE = 200
+RESOLVE_BATCH_TIMEOUT = 2.0
+
+def has_black_color(image_path, tolerance=0):
     """Check if black color exists in the corner pixels of the image."""
-    img = Image.open(image_path)
-    img = img.convert("RGB")  # Ensure the image is in RGB mode
-
-    width, height = img.size
-    corners = [
-        img.getpixel((0, 0)),           # Top-left
-        img.getpixel((width - 1, 0)),  # Top-right
-        img.getpixel((0, height - 1)), # Bottom-left
-        img.getpixel((width - 1, height - 1)) # Bottom-right
-    ]
-
-    return (0, 0, 0) in corners
-
-def fetch_matching_barcodes(folder_names):
-    """Fetch barcodes using the custom query and match with folder names."""
-    connection_string = (
-        "DRIVER={SQL Server};"
-        "SERVER=FOODWORLD\\SQLEXPRESS;"
-        "DATABASE=foodworld;"
-        "UID=skienuser;"
-        "PWD=skiendberp@123;"
-    )
+    return has_black_corner(image_path, tolerance)  # Decodes as little of the image as possible
+
+def sort_lines(path):
+    """Sort the lines of a text file in place, so outputs written by concurrent stages are reproducible."""
+    with open(path) as f:
+        lines = f.readlines()
+    with open(path, "w") as f:
+        f.writelines(sorted(lines))
+
+def fetch_matching_barcodes(folder_names, connection=None, cache=None):
+    """
+    Fetch barcodes for the given folder names.
+
+    Only the rows for these folders are queried (see barcode_lookup). Pass a
+    DB-API `connection` to use instead of the SQL Server one (e.g. a SQLite
+    stand-in), and a BarcodeCache to answer recently seen folders locally.
+    """
     matching_results = []
 
     try:
-        with pyodbc.connect(connection_string) as conn:
-            cursor = conn.cursor()
-            query = """
-                SELECT 
-                    sku.BarCode,
-                    CASE 
-                        WHEN CHARINDEX('/', img.ImageFile) > 0 AND CHARINDEX('\\', img.ImageFile) > 0 THEN 
-                            LEFT(img.ImageFile, 
-                                 CASE 
-                                     WHEN CHARINDEX('/', img.ImageFile) < CHARINDEX('\\', img.ImageFile) THEN CHARINDEX('/', img.ImageFile) - 1
-                                     ELSE CHARINDEX('\\', img.ImageFile) - 1
-                                 END)
-                        WHEN CHARINDEX('/', img.ImageFile) > 0 THEN 
-                            LEFT(img.ImageFile, CHARINDEX('/', img.ImageFile) - 1)
-                        WHEN CHARINDEX('\\', img.ImageFile) > 0 THEN 
-                            LEFT(img.ImageFile, CHARINDEX('\\', img.ImageFile) - 1)
-                        ELSE 
-                            img.ImageFile
-                    END AS ExtractedNumber
-                FROM 
-                    catalog.ProductImageMaps img
-                LEFT JOIN 
-                    catalog.ProductSKUMaps sku 
-                ON 
-                    sku.ProductSKUMapIID = img.ProductSKUMapID
-                WHERE 
-                    ProductImageTypeID = 8
-            """
-            cursor.execute(query)
-            results = cursor.fetchall()
-            
-            # Create a dictionary of extracted numbers to barcodes
-            barcode_map = {str(row.ExtractedNumber): row.BarCode for row in results if row.BarCode is not None}
-            
-            # Match folder names with extracted numbers and get corresponding barcodes
-            for folder_name in folder_names:
-                if folder_name in barcode_map:
-                    matching_results.append((folder_name, barcode_map[folder_name]))
-                    print(f"Found match: Folder {folder_name} -> Barcode {barcode_map[folder_name]}")
+        barcode_map, missing = cache.lookup(folder_names) if cache is not None else ({}, folder_names)
+        if missing:
+            conn = connection or pyodbc.connect(CONNECTION_STRING)
+            try:
+                fresh = lookup_barcodes(conn, missing)
+            finally:
+                if connection is None:
+                    conn.close()
+            if cache is not None:
+                cache.store(missing, fresh)
+            barcode_map.update(fresh)
+
+        # Match folder names with extracted numbers and get corresponding barcodes
+        for folder_name in folder_names:
+            if barcode_map.get(folder_name) is not None:
+                matching_results.append((folder_name, barcode_map[folder_name]))
+                log_event(log, "barcode found", folder=folder_name, barcode=barcode_map[folder_name])
 
     except Exception as e:
-        print(f"Error fetching barcodes: {e}")
+        log_event(log, "barcode lookup failed", logging.ERROR, error=e)
+        get_metrics().inc('errors')
 
     return matching_results
 
-def remove_background_and_save(image_path, output_path):
+def remove_background(image_path, use_color_key=False, max_side=None):
+    """
+    Return the RGBA cutout of the image and the path that produced its mask.
+    With `max_side`, the model runs on a copy reduced to that size (see low_res).
+    """
+    metrics = get_metrics()
+    with metrics.timer('decode'):
+        with Image.open(image_path) as img:
+            # rembg works on the EXIF-rotated image, so key that one too
+            img = ImageOps.exif_transpose(img)
+            img.load()
+
+    with metrics.sampled('infer'):
+        # Opt-in: a uniform black background is keyed out directly; anything else goes to the model
+        mask = color_key_mask(img)[0] if use_color_key else None
+        if mask is not None:
+            return cutout(img, mask), PATH_COLOR_KEY
+        if max_side:
+            mask = low_res_mask(img, lambda im: rembg.remove(im, session=get_session(), only_mask=True),
+                                max_side, open_reduced(image_path, max_side))
+            return cutout(img, mask), PATH_MODEL
+        return rembg.remove(img, session=get_session()), PATH_MODEL
+
+def encode_on_white(processed_img, output_path, outputs=DEFAULT_OUTPUTS):
+    """
+    Flatten a cutout onto white and return every output of it (see encoder)
+    for `output_path` as [(path, bytes)].
+    """
+    with get_metrics().timer('composite'):
+        flattened = flatten_image(processed_img)
+    return encode_outputs(flattened, output_path, outputs)
+
+def remove_background_and_save(image_path, output_path, use_color_key=False, stats=None):
     """Remove the background from the image and save it to the specified path."""
     try:
-        with open(image_path, 'rb') as input_file:
-            image_data = remove(input_file.read())
-            with Image.open(io.BytesIO(image_data)) as img:
-                # Convert transparent pixels to white
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, (0, 0), img.convert('RGBA'))
-                background.save(output_path, 'JPEG')
-        print(f"Background removed and saved: {output_path}")
+        processed_img, path = remove_background(image_path, use_color_key)
+        if stats is not None:
+            stats[path] += 1
+
+        # Convert transparent pixels to white
+        write_outputs(encode_on_white(processed_img, output_path))
+        log_event(log, "background removed", path=path, output=output_path)
+        return True
     except Exception as e:
-        print(f"Error removing background from {image_path}: {e}")
+        log_event(log, "background removal failed", logging.ERROR, image=image_path, error=e)
+        get_metrics().inc('errors')
+        return False
 
-def process_images(input_folder, output_folder, bg_removed_folder):
-    """Process images and save matching barcodes."""
+def process_images(input_folder, output_folder, bg_removed_folder, manifest_path=None, use_color_key=False,
+                   concurrency=None, barcode_cache_path=None, copy_strategy=DEFAULT_STRATEGY, max_side=None,
+                   metrics_path=None, profile_every=0, scan_index_path=None, scan_depth=LISTING_DEPTH,
+                   memory_budget=None, dedup=True, perceptual_dedup=False, outputs=DEFAULT_OUTPUTS):
+    """
+    Process images and save matching barcodes.
+
+    Runs as a streaming pipeline: scan -> probe -> resolve -> infer -> encode -> write.
+    Each stage has its own threads (`concurrency` overrides DEFAULT_CONCURRENCY per
+    stage name) and bounded input queue, so background removal starts as soon as
+    the first matching folder is found and memory stays flat however big the tree is.
+    Barcode answers are kept in a local snapshot at `barcode_cache_path`, if given.
+    Originals are copied with `copy_strategy` (see file_copy) on their own threads.
+    With `max_side`, the model runs on copies reduced to that size (see low_res).
+    Stage timings, counters and queue depths are written to `metrics_path`
+    while the run goes (JSON, or Prometheus text for *.prom), and every
+    `profile_every`th image per stage is profiled into `<output_folder>/profiles`.
+    The scan lists directories on its own threads and only reads 'ListingImage'
+    folders (see scanner.scan_images); with `scan_index_path`, directories
+    unchanged since the last run are not listed again, and `scan_depth` stops
+    it entering branches deeper than 'ListingImage' folders can be (by
+    default our <root>/<product>/ListingImage layout; None scans every level).
+    An image is only decoded for background removal once its estimated peak
+    memory fits in `memory_budget` bytes next to the images still between
+    infer and encode (see scheduler.MemoryBudget); by default most of the
+    available memory.
+    With `dedup`, folders sharing the same listing image (same content) get
+    one background removal, and its output is copied to every barcode file
+    name; `perceptual_dedup` also groups near-identical photos (see dedup).
+    Each background-removed image is written as `outputs` (formats and size
+    variants, see encoder.OutputSpec) by the encode stage's own threads, and
+    every file is written atomically.
+    """
     os.makedirs(output_folder, exist_ok=True)
     os.makedirs(bg_removed_folder, exist_ok=True)
+    workers = dict(DEFAULT_CONCURRENCY, **(concurrency or {}))
+    metrics = reset_metrics(profile_every, os.path.join(output_folder, "profiles"))
+    budget = MemoryBudget(memory_budget if memory_budget is not None else default_budget(SESSION_BYTES))
+    metrics.gauge('memory', budget.usage)
 
     # File to store names of folders containing images with black corners
     folder_txt_file_path = os.path.join(output_folder, "black_corner_folders.txt")
     barcode_txt_file_path = os.path.join(output_folder, "matching_barcodes.txt")
     processed_folders = set()
-    folder_to_images = {}  # Dictionary to store folder -> image filename mapping
-
-    # First pass: collect all images with black corners and their folder names
-    with open(folder_txt_file_path, "w") as folder_txt_file:
-        for root, dirs, files in os.walk(input_folder):
-            if "ListingImage" in root:
-                folder_name = os.path.basename(os.path.dirname(root))
-                for filename in files:
-                    if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
-                        continue
-
-                    file_path = os.path.join(root, filename)
-                    try:
-                        if has_black_color(file_path):
-                            # Save original image
-                            img = Image.open(file_path)
-                            output_path = os.path.join(output_folder, filename)
-                            img.save(output_path)
-                            print(f"Saved image with black corners: {output_path}")
-
-                            # Store the mapping of folder to image filename
-                            folder_to_images[folder_name] = file_path
-
-                            # Write the folder name if not already written
-                            if folder_name not in processed_folders:
-                                folder_txt_file.write(folder_name + "\n")
-                                processed_folders.add(folder_name)
-                                print(f"Found black corners in folder: {folder_name}")
-                            break
-                    except Exception as e:
-                        print(f"Error processing file {file_path}: {e}")
+    stats = Counter()
+    lock = threading.Lock()  # Guards the text files, processed_folders and stats
 
-    print(f"Folder names saved in: {folder_txt_file_path}")
+    # Images classified in an earlier run and unchanged since are not checked or copied again
+    manifest = open_manifest(manifest_path)
+    barcode_cache = BarcodeCache(barcode_cache_path) if barcode_cache_path else None
+    copier = Copier(copy_strategy, workers["copy"])
+    deduplicator = Deduplicator(perceptual_dedup) if dedup else None
+    folder_txt_file = open(folder_txt_file_path, "w")
+    barcode_txt_file = open(barcode_txt_file_path, "w")
+
+    def scan(folder, emit):
+        for root, filenames in scan_images(folder, workers=workers["list"], index_path=scan_index_path,
+                                           max_depth=scan_depth, exclude=(output_folder, bg_removed_folder)):
+            folder_name = os.path.basename(os.path.dirname(root))
+            emit((folder_name, root, filenames))
+
+    def saved(file_path, output_path, error):
+        if error is None:
+            metrics.inc('originals_copied')
+            log_event(log, "original saved", output=output_path)
+        else:
+            metrics.inc('errors')
+            log_event(log, "copy failed", logging.ERROR, image=file_path, error=error)
+            manifest.record(file_path, STATUS_ERROR)
 
-    # Second pass: get barcodes and process background removal
-    matching_results = fetch_matching_barcodes(processed_folders)
-    with open(barcode_txt_file_path, "w") as barcode_txt_file:
-        for folder_name, barcode in matching_results:
-            barcode_txt_file.write(f"{barcode}\n")
-            print(f"Saved barcode for folder {folder_name}: {barcode}")
-
-            # Get the corresponding image path and process it
-            if folder_name in folder_to_images:
-                original_image_path = folder_to_images[folder_name]
-                # Save with barcode as filename
-                file_extension = os.path.splitext(original_image_path)[1]
-                bg_output_path = os.path.join(bg_removed_folder, f"{barcode}{file_extension}")
-                remove_background_and_save(original_image_path, bg_output_path)
+    def duplicate_done(image_path, output_path, leader_output):
+        # The image had the same content as one already being processed: copy that one's outputs
+        if leader_output is None:
+            metrics.inc('errors')
+            log_event(log, "background removal failed", logging.ERROR, image=image_path,
+                      error="failed for an identical image")
+            manifest.record(image_path, STATUS_ERROR, CLASS_BLACK)
+        else:
+            copier.submit(outputs[0].path_for(leader_output), outputs[0].path_for(output_path),
+                          lambda src, dst, error: duplicate_saved(image_path, leader_output, output_path, error))
 
+    def duplicate_saved(image_path, leader_output, output_path, error):
+        if error is None:
+            try:
+                # Size and format variants after the main output, still on the copy thread
+                for spec in outputs[1:]:
+                    copy_file(spec.path_for(leader_output), spec.path_for(output_path), copy_strategy)
+            except OSError as e:
+                error = e
+        if error is None:
+            metrics.inc('duplicates_reused')
+            log_event(log, "background removal reused", output=outputs[0].path_for(output_path))
+            manifest.record(image_path, STATUS_DONE, CLASS_BLACK, outputs[0].path_for(output_path))
+        else:
+            metrics.inc('errors')
+            log_event(log, "copy failed", logging.ERROR, image=image_path, error=error)
+            manifest.record(image_path, STATUS_ERROR, CLASS_BLACK)
+
+    def probe(item, emit):
+        # Find the first image with black corners in the folder
+        folder_name, root, filenames = item
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            try:
+                previous = manifest.finished(file_path, status=(STATUS_CLASSIFIED, STATUS_DONE))
+                if previous is not None:
+                    is_black = previous['classification'] == CLASS_BLACK
+                else:
+                    with metrics.sampled('classify'):
+                        is_black = has_black_color(file_path)
+                    metrics.inc('images_classified')
+                    if is_black:
+                        # Save original image on the copy threads. Recorded now, not when the
+                        # copy finishes, so it can't overwrite the 'done' record of a fast removal
+                        output_path = os.path.join(output_folder, filename)
+                        manifest.record(file_path, STATUS_CLASSIFIED, CLASS_BLACK, output_path)
+                        copier.submit(file_path, output_path, saved)
+                    else:
+                        manifest.record(file_path, STATUS_DONE, CLASS_OTHER)
+
+                if is_black:
+                    # Write the folder name if not already written
+                    with lock:
+                        first = folder_name not in processed_folders
+                        if first:
+                            folder_txt_file.write(folder_name + "\n")
+                            processed_folders.add(folder_name)
+                    if first:
+                        log_event(log, "black corners found", folder=folder_name)
+                        emit((folder_name, file_path))
+                    break
+            except Exception as e:
+                metrics.inc('errors')
+                log_event(log, "classify failed", logging.ERROR, image=file_path, error=e)
+                manifest.record(file_path, STATUS_ERROR)
+
+    def resolve(batch, emit):
+        # One barcode lookup per batch of folders, not one after the whole scan
+        folder_to_images = dict(batch)
+        with metrics.timer('resolve'):
+            matches = fetch_matching_barcodes(list(folder_to_images), cache=barcode_cache)
+        metrics.inc('barcodes_found', len(matches))
+        for folder_name, barcode in matches:
+            with lock:
+                barcode_txt_file.write(f"{barcode}\n")
+
+            # Save with barcode as filename
+            original_image_path = folder_to_images[folder_name]
+            file_extension = os.path.splitext(original_image_path)[1]
+            bg_output_path = os.path.join(bg_removed_folder, f"{barcode}{file_extension}")
+
+            previous = manifest.finished(original_image_path)
+            if previous is not None and previous['output_path'] == outputs[0].path_for(bg_output_path):
+                metrics.inc('images_skipped')
+                log_event(log, "already processed", output=bg_output_path)
+                continue
+
+            # Content hash recorded when the image was probed, if there is a manifest
+            row = manifest.lookup(original_image_path)
+            content_hash = row['content_hash'] if row is not None else None
+            if deduplicator is None or deduplicator.claim(original_image_path, bg_output_path, duplicate_done,
+                                                          content_hash):
+                emit((original_image_path, bg_output_path))
+
+    def infer(item, emit):
+        image_path, output_path = item
+        # Held until the image is encoded (or fails), since the decoded image travels down the pipeline
+        budget.acquire(image_path, job_cost(image_path))
+        processed_img, path = remove_background(image_path, use_color_key, max_side)
+        with lock:
+            stats[path] += 1
+        emit((image_path, output_path, processed_img, path))
+
+    def encode(item, emit):
+        image_path, output_path, processed_img, path = item
+        encoded = encode_on_white(processed_img, output_path, outputs)
+        budget.release(image_path)
+        emit((image_path, output_path, encoded, path))
+
+    def write(item, emit):
+        image_path, output_path, encoded, path = item
+        write_outputs(encoded)
+        metrics.inc('images_processed')
+        log_event(log, "background removed", path=path, output=encoded[0][0])
+        manifest.record(image_path, STATUS_DONE, CLASS_BLACK, encoded[0][0])
+        if deduplicator is not None:
+            deduplicator.finish(image_path, output_path)
+
+    def on_error(stage, item, e):
+        metrics.inc('errors')
+        if stage.name in ("infer", "encode", "write"):
+            budget.release(item[0])  # No-op if it was released already
+            if deduplicator is not None:
+                deduplicator.finish(item[0], None)
+            log_event(log, "background removal failed", logging.ERROR, image=item[0], error=e)
+            manifest.record(item[0], STATUS_ERROR, CLASS_BLACK)
+        else:
+            log_event(log, "stage failed", logging.ERROR, stage=stage.name, error=e)
+
+    pipeline = Pipeline([
+        Stage("scan", scan, workers["scan"]),
+        Stage("probe", probe, workers["probe"], queue_size=256),
+        Stage("resolve", resolve, workers["resolve"], queue_size=1024,
+              batch_size=RESOLVE_BATCH_SIZE, batch_timeout=RESOLVE_BATCH_TIMEOUT),
+        Stage("infer", infer, workers["infer"], queue_size=64),
+        Stage("encode", encode, workers["encode"], queue_size=4),  # Holds decoded images
+        Stage("write", write, workers["write"], queue_size=16),
+    ], on_error=on_error)
+    metrics.gauge('queue_depth', pipeline.queue_depths)
+    if metrics_path:
+        metrics.start_export(metrics_path)
+    try:
+        pipeline.run([input_folder])
+    finally:
+        metrics.stop_export()
+        copier.close()
+        folder_txt_file.close()
+        barcode_txt_file.close()
+        # Lines arrive in whatever order the probe and resolve workers finish
+        sort_lines(folder_txt_file_path)
+        sort_lines(barcode_txt_file_path)
+        manifest.close()
+        if barcode_cache is not None:
+            barcode_cache.close()
+
+    print(f"Folder names saved in: {folder_txt_file_path}")
     print(f"Matching barcodes saved in: {barcode_txt_file_path}")
     print(f"Background-removed images saved in: {bg_removed_folder}")
+    print(f"Background removal paths: {PATH_COLOR_KEY} {stats[PATH_COLOR_KEY]}, {PATH_MODEL} {stats[PATH_MODEL]}")
+    print(metrics.summary())
+    if deduplicator is not None:
+        print(deduplicator.summary(metrics))
 
 def main():
+    if wants_import_profile():
+        print_import_profile('abcd')
+        return
+
     print("Detect black corner pixels, find matching barcodes, and remove backgrounds.")
     input_folder = input("Enter the path to the input folder: ").strip()
     output_folder = input("Enter the path to the output folder: ").strip()
@@ -161,7 +384,11 @@ def main():
         print(f"The input folder '{input_folder}' does not exist.")
         return
 
-    process_images(input_folder, output_folder, bg_removed_folder)
+    setup_logging()
+    process_images(input_folder, output_folder, bg_removed_folder, os.path.join(output_folder, DEFAULT_MANIFEST_NAME),
+                   barcode_cache_path=os.path.join(output_folder, BARCODE_CACHE_NAME),
+                   metrics_path=os.path.join(output_folder, DEFAULT_METRICS_NAME),
+                   scan_index_path=os.path.join(output_folder, DEFAULT_INDEX_NAME))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
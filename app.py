@@ -1,36 +1,31 @@
 import argparse
-from PIL import Image
+from corner_probe import corner_colors
+from lazy_import import wants_import_profile, print_import_profile, IMPORT_PROFILE_FLAG
 
-def get_corner_colors(image_path):
-    # Open the image
-    img = Image.open(image_path)
-    # Ensure the image is in RGB mode
-    img = img.convert("RGB")
-    
-    # Get dimensions
-    width, height = img.size
-
-    # Get pixel colors from the corners
-    corners = [
-        img.getpixel((0, 0)),           # Top-left
-        img.getpixel((width - 1, 0)),  # Top-right
-        img.getpixel((0, height - 1)), # Bottom-left
-        img.getpixel((width - 1, height - 1)) # Bottom-right
-    ]
+def get_corner_colors(image_path, tolerance=0):
+    # Read only the corner pixels (see corner_probe)
+    corners = corner_colors(image_path, tolerance)
 
     # Return the most common color among the corners
     return max(set(corners), key=corners.count)
 
 def main():
+    if wants_import_profile():
+        print_import_profile('app')
+        return
+
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Detect the background color of an image based on corner pixels.")
     parser.add_argument("image_path", help="Path to the image file")
+    parser.add_argument("--tolerance", type=int, default=0,
+                        help="Allowed color error per channel; above 0 JPEGs are probed at reduced scale")
+    parser.add_argument(IMPORT_PROFILE_FLAG, action="store_true", help="Report start-up import cost and exit")
     
     # Parse arguments
     args = parser.parse_args()
     
     # Get the background color from the image
-    background_color = get_corner_colors(args.image_path)
+    background_color = get_corner_colors(args.image_path, args.tolerance)
     
     # Print the result
     print("Background color:", background_color)
@@ -1,63 +1,106 @@
 import argparse
+import logging
 import os
-from PIL import Image
+from corner_probe import has_black_corner
+from file_copy import Copier, DEFAULT_STRATEGY, STRATEGIES
+from manifest import open_manifest, DEFAULT_MANIFEST_NAME, STATUS_DONE, STATUS_ERROR, CLASS_BLACK, CLASS_OTHER
+from lazy_import import wants_import_profile, print_import_profile, IMPORT_PROFILE_FLAG
+from metrics import reset_metrics, setup_logging, log_event
 
-def has_black_color(image_path):
+log = logging.getLogger('app2')
+log.addHandler(logging.NullHandler())  # Silent when imported as a library; entry points call setup_logging
+
+def has_black_color(image_path, tolerance=0):
     """Check if black color exists in the corner pixels of the image."""
-    # Open the image
-    img = Image.open(image_path)
-    # Ensure the image is in RGB mode
-    img = img.convert("RGB")
-
-    # Get dimensions
-    width, height = img.size
-
-    # Get pixel colors from the corners
-    corners = [
-        img.getpixel((0, 0)),           # Top-left
-        img.getpixel((width - 1, 0)),  # Top-right
-        img.getpixel((0, height - 1)), # Bottom-left
-        img.getpixel((width - 1, height - 1)) # Bottom-right
-    ]
-
-    # Check if any corner contains black (RGB: (0, 0, 0))
-    return (0, 0, 0) in corners
-
-def process_images(input_folder, output_folder):
+    # Only the corner pixels are decoded/converted (see corner_probe)
+    return has_black_corner(image_path, tolerance)
+
+def process_images(input_folder, output_folder, tolerance=0, manifest_path=None, copy_strategy=DEFAULT_STRATEGY,
+                   metrics_path=None, profile_every=0):
     """Process all images in the input folder and save those with black corners to the output folder."""
     # Ensure output folder exists
     os.makedirs(output_folder, exist_ok=True)
+    metrics = reset_metrics(profile_every, os.path.join(output_folder, "profiles"))
+    if metrics_path:
+        metrics.start_export(metrics_path)
+
+    def saved(file_path, output_path, error):
+        # Runs on a copy thread once the original has been copied
+        if error is None:
+            metrics.inc('images_processed')
+            log_event(log, "saved", output=output_path)
+            manifest.record(file_path, STATUS_DONE, CLASS_BLACK, output_path)
+        else:
+            metrics.inc('errors')
+            log_event(log, "copy failed", logging.ERROR, image=file_path, error=error)
+            manifest.record(file_path, STATUS_ERROR)
+
+    # Copies run on a thread pool so they overlap with checking the next images
+    with open_manifest(manifest_path) as manifest, Copier(copy_strategy) as copier:
+        for filename in os.listdir(input_folder):
+            # Get full file path
+            file_path = os.path.join(input_folder, filename)
+
+            # Skip if not an image file
+            if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
+                continue
 
-    for filename in os.listdir(input_folder):
-        # Get full file path
-        file_path = os.path.join(input_folder, filename)
-
-        # Skip if not an image file
-        if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
-            continue
-
-        try:
-            # Check if the image has black corners
-            if has_black_color(file_path):
-                # Save the image to the output folder
-                img = Image.open(file_path)
-                output_path = os.path.join(output_folder, filename)
-                img.save(output_path)
-                print(f"Saved: {output_path}")
-        except Exception as e:
-            print(f"Error processing file {file_path}: {e}")
+            # Skip if handled in an earlier run and unchanged since
+            if manifest.is_unchanged(file_path):
+                metrics.inc('images_skipped')
+                continue
+
+            try:
+                # Check if the image has black corners
+                with metrics.sampled('classify'):
+                    is_black = has_black_color(file_path, tolerance)
+                metrics.inc('images_classified')
+                if is_black:
+                    # Save the image to the output folder
+                    output_path = os.path.join(output_folder, filename)
+                    copier.submit(file_path, output_path, saved)
+                else:
+                    manifest.record(file_path, STATUS_DONE, CLASS_OTHER)
+            except Exception as e:
+                metrics.inc('errors')
+                log_event(log, "classify failed", logging.ERROR, image=file_path, error=e)
+                manifest.record(file_path, STATUS_ERROR)
+
+    metrics.stop_export()
+    print(metrics.summary())
 
 def main():
+    if wants_import_profile():
+        print_import_profile('app2')
+        return
+
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Detect black corner pixels in images from a folder and save matching images to another folder.")
     parser.add_argument("input_folder", help="Path to the folder containing images")
     parser.add_argument("output_folder", help="Path to the folder to save images with black corners")
+    parser.add_argument("--tolerance", type=int, default=0,
+                        help="Highest channel value still counted as black; above 0 JPEGs are probed at reduced scale")
+    parser.add_argument("--manifest", help=f"Manifest of processed files (default: <output_folder>/{DEFAULT_MANIFEST_NAME})")
+    parser.add_argument("--copy-strategy", choices=STRATEGIES, default=DEFAULT_STRATEGY,
+                        help="How originals are saved; 'reencode' is the old decode-and-save behavior")
+    parser.add_argument("--no-manifest", action="store_true", help="Process every image, ignoring earlier runs")
+    parser.add_argument("--metrics", help="Write stage timings and counters here while running (JSON, or Prometheus text for .prom)")
+    parser.add_argument("--profile-every", type=int, default=0, help="Profile every Nth image with cProfile (0 = off)")
+    parser.add_argument("--log-json", action="store_true", help="Log one JSON object per line")
+    parser.add_argument("--log-rate", type=int, default=20, help="Most log lines per second per event (0 = unlimited)")
+    parser.add_argument(IMPORT_PROFILE_FLAG, action="store_true", help="Report start-up import cost and exit")
 
     # Parse arguments
     args = parser.parse_args()
 
+    manifest_path = None
+    if not args.no_manifest:
+        manifest_path = args.manifest or os.path.join(args.output_folder, DEFAULT_MANIFEST_NAME)
+
     # Process the images
-    process_images(args.input_folder, args.output_folder)
+    setup_logging(json_format=args.log_json, rate=args.log_rate)
+    process_images(args.input_folder, args.output_folder, args.tolerance, manifest_path, args.copy_strategy,
+                   args.metrics, args.profile_every)
 
 if __name__ == "__main__":
     main()
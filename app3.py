@@ -1,30 +1,34 @@
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 from rembg import remove
+from compositing import cutout, flatten_image
+from low_res import open_reduced, low_res_mask
 import os
 
-def change_background_to_white(input_path, output_path):
+def change_background_to_white(input_path, output_path, max_side=None):
     """
     Remove the background of an image and replace it with white
     
     Parameters:
     input_path (str): Path to input image
     output_path (str): Path where the processed image will be saved
+    max_side (int): If set, run the model on a copy reduced to this longest side
+        and upscale the mask to the full image (faster and lighter for large photos)
     """
     # Open the image
     input_image = Image.open(input_path)
     
     # Remove the background
-    output = remove(input_image)
+    if max_side:
+        input_image = ImageOps.exif_transpose(input_image)
+        mask = low_res_mask(input_image, lambda im: remove(im, only_mask=True), max_side,
+                            open_reduced(input_path, max_side))
+        output = cutout(input_image, mask)
+    else:
+        output = remove(input_image)
     
-    # Create a white background image of the same size
-    white_background = Image.new('RGBA', output.size, (255, 255, 255, 255))
-    
-    # Composite the image onto the white background
-    white_background.paste(output, (0, 0), output)
-    
-    # Convert to RGB (removing alpha channel) and save
-    final_image = white_background.convert('RGB')
+    # Composite the image onto a white background (RGB, alpha removed) and save
+    final_image = flatten_image(output)
     final_image.save(output_path)
 
 # Example usage
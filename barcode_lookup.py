@@ -0,0 +1,129 @@
+import re
+import sqlite3
+import threading
+import time
+
+# Folders per query. Each folder takes 3 parameters, which keeps a chunk under
+# SQL Server's 2100 parameter limit and SQLite's default of 999.
+LOOKUP_CHUNK_SIZE = 300
+FETCH_SIZE = 500  # Rows per cursor.fetchmany()
+
+DEFAULT_MAX_AGE = 24 * 3600  # Seconds a cached barcode is trusted
+DEFAULT_NEGATIVE_MAX_AGE = 3600  # Seconds a cached "no barcode" answer is trusted
+
+LOOKUP_QUERY = """
+    SELECT
+        sku.BarCode,
+        img.ImageFile
+    FROM
+        catalog.ProductImageMaps img
+    LEFT JOIN
+        catalog.ProductSKUMaps sku
+    ON
+        sku.ProductSKUMapIID = img.ProductSKUMapID
+    WHERE
+        ProductImageTypeID = 8
+        AND ({conditions})
+"""
+# ImageFile is '<number>', '<number>/...' or '<number>\\...'; the LIKE prefixes can use an index
+FOLDER_CONDITION = "img.ImageFile = ? OR img.ImageFile LIKE ? ESCAPE '!' OR img.ImageFile LIKE ? ESCAPE '!'"
+
+
+def extract_number(image_file):
+    """Return the part of ImageFile before the first '/' or '\\' (the folder name it belongs to)."""
+    return re.split(r'[/\\]', str(image_file), maxsplit=1)[0]
+
+
+def _like_prefix(text):
+    # '[' is a wildcard in SQL Server's LIKE, '%' and '_' in both dialects
+    return re.sub(r'([!%_\[])', r'!\1', text)
+
+
+def lookup_barcodes(connection, folder_names, chunk_size=LOOKUP_CHUNK_SIZE):
+    """
+    Return {folder_name: barcode} for the given folder names.
+
+    Only the rows whose ImageFile belongs to one of the folders are fetched,
+    with one parameterized query per chunk of folders, and the cursor is read
+    in batches instead of with fetchall(). Works with any DB-API connection
+    using '?' parameters (pyodbc, sqlite3).
+    """
+    names = sorted({str(name) for name in folder_names})
+    barcode_map = {}
+    cursor = connection.cursor()
+    for start in range(0, len(names), chunk_size):
+        chunk = names[start:start + chunk_size]
+        wanted = set(chunk)
+        params = []
+        for name in chunk:
+            prefix = _like_prefix(name)
+            params += [name, prefix + '/%', prefix + '\\%']
+        conditions = " OR ".join(f"({FOLDER_CONDITION})" for _ in chunk)
+        cursor.execute(LOOKUP_QUERY.format(conditions=conditions), params)
+
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for barcode, image_file in rows:
+                if barcode is None or image_file is None:
+                    continue
+                # LIKE may be case-insensitive, so check the exact folder name here
+                folder_name = extract_number(image_file)
+                if folder_name in wanted:
+                    barcode_map[folder_name] = barcode
+    return barcode_map
+
+
+class BarcodeCache:
+    """
+    Local SQLite snapshot of folder name -> barcode answers.
+
+    Folders looked up recently are answered from the snapshot; only missing or
+    stale ones go to the database, so repeated runs skip most round trips.
+    "No barcode" answers are cached too, for a shorter time.
+    """
+
+    def __init__(self, db_path, max_age=DEFAULT_MAX_AGE, negative_max_age=DEFAULT_NEGATIVE_MAX_AGE):
+        self.max_age = max_age
+        self.negative_max_age = negative_max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS barcodes (
+                folder_name TEXT PRIMARY KEY,
+                barcode TEXT,
+                refreshed_at REAL
+            )
+        """)
+        self._conn.commit()
+
+    def lookup(self, folder_names):
+        """Return ({folder_name: barcode or None} for fresh entries, [stale or missing folder names])."""
+        now = time.time()
+        known, missing = {}, []
+        with self._lock:
+            for name in {str(name) for name in folder_names}:
+                row = self._conn.execute(
+                    "SELECT barcode, refreshed_at FROM barcodes WHERE folder_name = ?", (name,)).fetchone()
+                if row is not None:
+                    barcode, refreshed_at = row
+                    max_age = self.max_age if barcode is not None else self.negative_max_age
+                    if now - refreshed_at <= max_age:
+                        known[name] = barcode
+                        continue
+                missing.append(name)
+        return known, missing
+
+    def store(self, folder_names, barcode_map):
+        """Record the database's answer for `folder_names` (absent from `barcode_map` = no barcode)."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO barcodes (folder_name, barcode, refreshed_at) VALUES (?, ?, ?)",
+                [(str(name), barcode_map.get(str(name)), now) for name in folder_names])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
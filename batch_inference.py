@@ -0,0 +1,166 @@
+from PIL import Image
+from concurrent.futures import Future
+import queue
+import threading
+import time
+from lazy_import import LazyModule
+
+np = LazyModule('numpy')
+
+# Preprocessing used by rembg's u2net family
+U2NET_SIZE = (320, 320)
+U2NET_MEAN = (0.485, 0.456, 0.406)
+U2NET_STD = (0.229, 0.224, 0.225)
+
+_STOP = object()
+
+
+class BatchInferenceEngine:
+    """
+    Micro-batched mask prediction on an onnxruntime-style session.
+
+    Images submitted from any thread are collected into batches of up to
+    `batch_size`; a batch is run at the latest `max_wait` seconds after its
+    first image arrived. Each batch is preprocessed into one contiguous NCHW
+    float32 array and run with a single `session.run()` call, and the mask
+    outputs are split back out per image. Preprocessing and postprocessing
+    follow rembg's u2net session, so masks match `remove(..., only_mask=True)`
+    up to float rounding.
+
+    Parameters:
+    session: Object with get_inputs() and run(None, {name: array}), such as
+        onnxruntime.InferenceSession or a rembg session's `inner_session`, or
+        a callable returning one; it is then only called (and the model only
+        loaded) when the first batch runs
+    batch_size (int): Largest batch per session call. Models exported with a
+        fixed batch dimension are run in chunks of that size (the last one
+        padded). rembg's u2net.onnx is one of them, with a fixed batch of 1:
+        with it each image still gets its own session.run() and batching
+        only saves the per-call handoff. The full gain needs a model
+        exported with a dynamic batch axis
+    max_wait (float): Seconds to wait for a batch to fill
+    size, mean, std: Model input size and normalization
+    """
+
+    def __init__(self, session, batch_size=8, max_wait=0.05, size=U2NET_SIZE, mean=U2NET_MEAN, std=U2NET_STD):
+        self._session = session
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.size = size
+        self.mean = np.asarray(mean, np.float64)
+        self.std = np.asarray(std, np.float64)
+        self.input_name = None
+        self.fixed_batch = None
+        self.batches_run = 0
+
+        self._queue = queue.Queue()
+        self._buffer = np.empty((batch_size, 3, size[1], size[0]), np.float32)
+        self._thread = threading.Thread(target=self._run, name='batch-inference', daemon=True)
+        self._thread.start()
+
+    @property
+    def session(self):
+        if callable(self._session) and not hasattr(self._session, 'run'):
+            self._session = self._session()
+        return self._session
+
+    def _inspect_model(self):
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch_dim = model_input.shape[0] if model_input.shape else None
+        self.fixed_batch = batch_dim if isinstance(batch_dim, int) else None
+
+    def submit(self, img):
+        """Queue an image; returns a Future resolving to its 'L' mask at the image's size."""
+        future = Future()
+        self._queue.put((img, future))
+        return future
+
+    def predict(self, images):
+        """Return the masks for a list of images, batched together."""
+        futures = [self.submit(img) for img in images]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def preprocess(self, img, out):
+        """Write the normalized CHW input for `img` into `out`."""
+        im_ary = np.asarray(img.convert('RGB').resize(self.size, Image.Resampling.LANCZOS))
+        im_ary = im_ary / max(np.max(im_ary), 1e-6)
+        out[...] = ((im_ary - self.mean) / self.std).transpose((2, 0, 1))
+
+    def postprocess(self, pred, size):
+        """Turn one (H, W) model output into an 'L' mask of `size`."""
+        ma, mi = np.max(pred), np.min(pred)
+        pred = (pred - mi) / (ma - mi)
+        mask = Image.fromarray((pred.clip(0, 1) * 255).astype(np.uint8))
+        return mask.resize(size, Image.Resampling.LANCZOS)
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        stop = False
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch, stop = self._collect(item)
+            self._run_batch(batch)
+            if stop:
+                return
+
+    def _fixed_chunks(self, inputs):
+        # The model only takes exactly `fixed_batch` images per call
+        step = self.fixed_batch
+        for start in range(0, len(inputs), step):
+            chunk = inputs[start:start + step]
+            if len(chunk) < step:
+                padding = np.zeros((step - len(chunk),) + chunk.shape[1:], chunk.dtype)
+                chunk = np.concatenate([chunk, padding])
+            yield chunk
+
+    def _run_batch(self, batch):
+        try:
+            if self.input_name is None:
+                self._inspect_model()
+            count = len(batch)
+            inputs = self._buffer[:count]
+            for index, (img, _) in enumerate(batch):
+                self.preprocess(img, inputs[index])
+
+            if self.fixed_batch is None or self.fixed_batch == count:
+                outputs = self.session.run(None, {self.input_name: inputs})[0]
+            else:
+                outputs = np.concatenate([self.session.run(None, {self.input_name: chunk})[0]
+                                          for chunk in self._fixed_chunks(inputs)])
+            self.batches_run += 1
+
+            for index, (img, future) in enumerate(batch):
+                future.set_result(self.postprocess(outputs[index, 0], img.size))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
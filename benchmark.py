@@ -0,0 +1,416 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from PIL import Image, ImageDraw
+from compositing import cutout, flatten_image, paste_flatten
+from corner_probe import has_black_corner, image_corners
+from metrics import setup_logging
+from scanner import scan_images, DEFAULT_INDEX_NAME
+
+LISTING_FOLDER = "ListingImage"
+FIRST_PRODUCT = 100001  # Product folders are numbered like the catalog's ImageFile prefixes
+FAKE_THRESHOLD = 30  # Fake remover: pixels with a channel above this are foreground
+
+
+def _product_image(size, black, seed):
+    rng = random.Random(seed)
+    width, height = size
+    background = (0, 0, 0) if black else (255, 255, 255)
+    img = Image.new('RGB', size, background)
+    draw = ImageDraw.Draw(img)
+    # A product-like blob with some texture, never touching the border
+    left, top = rng.randint(width // 8, width // 4), rng.randint(height // 8, height // 4)
+    right, bottom = rng.randint(3 * width // 4, 7 * width // 8), rng.randint(3 * height // 4, 7 * height // 8)
+    color = tuple(rng.randint(60, 220) for _ in range(3))
+    draw.ellipse((left, top, right, bottom), fill=color)
+    for _ in range(20):
+        x, y = rng.randint(left, right), rng.randint(top, bottom)
+        draw.line((x, y, x + width // 20, y + height // 30), fill=tuple(rng.randint(40, 255) for _ in range(3)), width=3)
+    return img
+
+
+def generate_catalog(root, products=50, images_per_product=4, size=(800, 800), black_ratio=0.5,
+                     png_ratio=0.25, corrupt_ratio=0.02, extra_folders=True, seed=0):
+    """
+    Write a synthetic product tree laid out like ours:
+    `<root>/<product number>/ListingImage/<n>.jpg|png`.
+
+    Parameters:
+    products (int): Number of product folders
+    images_per_product (int): Images in each ListingImage folder
+    size (tuple): Image width and height
+    black_ratio (float): Share of images on a black background (the rest are on white)
+    png_ratio (float): Share of images written as PNG instead of JPEG
+    corrupt_ratio (float): Share of images truncated so they fail to decode
+    extra_folders (bool): Also write a non-ListingImage folder per product, for scanners to skip
+    seed (int): Seed for a reproducible tree
+
+    Returns a dict of counts and the catalog rows as {product number: barcode}.
+    """
+    rng = random.Random(seed)
+    counts = {'images': 0, 'black': 0, 'white': 0, 'png': 0, 'corrupt': 0}
+    barcodes = {}
+    for index in range(products):
+        product = str(FIRST_PRODUCT + index)
+        barcodes[product] = f"{890000000000 + index:013d}"
+        listing = os.path.join(root, product, LISTING_FOLDER)
+        os.makedirs(listing, exist_ok=True)
+        if extra_folders:
+            other = os.path.join(root, product, "Thumbnails")
+            os.makedirs(other, exist_ok=True)
+            _product_image((64, 64), False, index).save(os.path.join(other, "0.jpg"))
+
+        for number in range(images_per_product):
+            black = rng.random() < black_ratio
+            png = rng.random() < png_ratio
+            path = os.path.join(listing, f"{number}.{'png' if png else 'jpg'}")
+            _product_image(size, black, seed * 1000003 + index * 101 + number).save(path)
+            counts['images'] += 1
+            counts['black' if black else 'white'] += 1
+            counts['png'] += png
+            if rng.random() < corrupt_ratio:
+                with open(path, 'r+b') as image_file:
+                    image_file.truncate(max(16, os.path.getsize(path) // 3))
+                counts['corrupt'] += 1
+    return counts, barcodes
+
+
+def write_barcode_catalog(db_path, barcodes):
+    """Write a SQLite stand-in for the product catalog tables that abcd queries."""
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE ProductSKUMaps (ProductSKUMapIID INTEGER PRIMARY KEY, BarCode TEXT);
+        CREATE TABLE ProductImageMaps (ProductSKUMapID INTEGER, ImageFile TEXT, ProductImageTypeID INTEGER);
+        CREATE INDEX image_file ON ProductImageMaps (ImageFile);
+    """)
+    for sku_id, (product, barcode) in enumerate(sorted(barcodes.items()), 1):
+        conn.execute("INSERT INTO ProductSKUMaps VALUES (?, ?)", (sku_id, barcode))
+        conn.execute("INSERT INTO ProductImageMaps VALUES (?, ?, 8)", (sku_id, f"{product}/0.jpg"))
+    conn.commit()
+    conn.close()
+
+
+class FakeCatalogDriver:
+    """Stands in for pyodbc: connect() opens the SQLite catalog as schema `catalog`."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self, *args, **kwargs):
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        conn.execute("ATTACH DATABASE ? AS catalog", (self.db_path,))
+        return conn
+
+
+def fake_mask(img):
+    """Deterministic stand-in for the model: pixels with a channel above FAKE_THRESHOLD are foreground."""
+    channel_max = Image.eval(img.convert('RGB'), lambda v: 255 if v > FAKE_THRESHOLD else 0)
+    return channel_max.convert('L').point(lambda v: 255 if v else 0)
+
+
+class FakeInnerSession:
+    """onnxruntime-style session for BatchInferenceEngine, using the same threshold as fake_mask."""
+
+    class _Input:
+        name = 'input.1'
+        shape = ['batch', 3, 320, 320]
+
+    def get_inputs(self):
+        return [self._Input()]
+
+    def run(self, output_names, feed):
+        import numpy as np
+        inputs = next(iter(feed.values()))
+        # Normalized black is about -2; anything clearly brighter counts as foreground.
+        # The corner pixel is pinned to 0 so a uniform input still normalizes like a real prediction
+        pred = (inputs.max(axis=1, keepdims=True) > -1.5).astype(np.float32)
+        pred[:, :, 0, 0] = 0
+        return [pred]
+
+
+class FakeSession:
+    inner_session = FakeInnerSession()
+
+
+class FakeRembg:
+    """Offline stand-in for the rembg module with the same remove()/new_session() calls."""
+
+    def new_session(self, model_name='u2net', *args, **kwargs):
+        return FakeSession()
+
+    def remove(self, data, session=None, only_mask=False, **kwargs):
+        if isinstance(data, bytes):
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+            buffer = io.BytesIO()
+            self.remove(img, session, only_mask).save(buffer, 'PNG')
+            return buffer.getvalue()
+        mask = fake_mask(data)
+        return mask if only_mask else cutout(data, mask)
+
+
+@contextlib.contextmanager
+def fake_remover(catalog_db=None):
+    """Swap rembg (and pyodbc, given a catalog) for the fakes in every module that uses them."""
+    import abcd
+    import session_pool
+    import www
+
+    fake = FakeRembg()
+    patched = [(module, 'rembg', module.rembg) for module in (abcd, session_pool, www)]
+    if catalog_db is not None:
+        patched.append((abcd, 'pyodbc', abcd.pyodbc))
+    sessions = dict(session_pool._shared_sessions)
+    try:
+        for module, name, _ in patched:
+            setattr(module, name, FakeCatalogDriver(catalog_db) if name == 'pyodbc' else fake)
+        session_pool._shared_sessions.clear()
+        yield fake
+    finally:
+        for module, name, original in patched:
+            setattr(module, name, original)
+        session_pool._shared_sessions.clear()
+        session_pool._shared_sessions.update(sessions)
+
+
+def _timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _result(name, times, items):
+    median = statistics.median(times)
+    return {
+        'name': name,
+        'runs': len(times),
+        'items': items,
+        'median_ms': median * 1000,
+        'min_ms': min(times) * 1000,
+        'mean_ms': statistics.mean(times) * 1000,
+        'items_per_s': items / median if median else None,
+    }
+
+
+def list_images(root):
+    return sorted(os.path.join(folder, name) for folder, _, names in os.walk(root)
+                  for name in names if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+
+
+def _decodes(path):
+    try:
+        with Image.open(path) as img:
+            img.load()
+        return True
+    except Exception:
+        return False
+
+
+def micro_benchmarks(root, repeat=5, composite_size=(2000, 2000)):
+    """Time the probe, composite and encode stages (and the tree walk) on their own."""
+    paths = [path for path in list_images(root) if LISTING_FOLDER in path and _decodes(path)]
+    results = []
+
+    def walk():
+        for folder, _, files in os.walk(root):
+            if LISTING_FOLDER in folder:
+                [name for name in files if name.lower().endswith(('.jpg', '.jpeg', '.png'))]
+
+    results.append(_result('scan.os_walk', _timed(walk, repeat), len(paths)))
+
+    def scan(**options):
+        return lambda: [images for _, images in scan_images(root, **options)]
+
+    # The tree was only just written, and listings this fresh are not indexed (see scanner.RACY_SECONDS)
+    an_hour_ago = time.time() - 3600
+    for folder, _, _ in os.walk(root):
+        os.utime(folder, (an_hour_ago, an_hour_ago))
+    index_path = os.path.join(tempfile.mkdtemp(), DEFAULT_INDEX_NAME)
+    scan(index_path=index_path)()  # Fill the index, so the timed runs only stat directories
+    results.append(_result('scan.scandir', _timed(scan(), repeat), len(paths)))
+    results.append(_result('scan.scandir_pruned', _timed(scan(max_depth=2), repeat), len(paths)))
+    results.append(_result('scan.scandir_indexed', _timed(scan(index_path=index_path), repeat), len(paths)))
+    shutil.rmtree(os.path.dirname(index_path), ignore_errors=True)
+
+    def probe_full_decode():
+        for path in paths:
+            with Image.open(path) as img:
+                rgb = img.convert('RGB')
+                width, height = rgb.size
+                [rgb.getpixel(xy) for xy in ((0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1))]
+
+    def probe_corners():
+        for path in paths:
+            has_black_corner(path)
+
+    def probe_is_background_black():
+        for path in paths:
+            with Image.open(path) as img:
+                all(max(color) < 30 for color in image_corners(img))
+
+    results.append(_result('probe.full_decode', _timed(probe_full_decode, repeat), len(paths)))
+    results.append(_result('probe.has_black_corner', _timed(probe_corners, repeat), len(paths)))
+    results.append(_result('probe.image_corners', _timed(probe_is_background_black, repeat), len(paths)))
+
+    img = _product_image(composite_size, True, 0)
+    processed = cutout(img, fake_mask(img))
+    results.append(_result('composite.paste_new_canvas', _timed(lambda: paste_flatten(processed), repeat), 1))
+    results.append(_result('composite.flatten_image', _timed(lambda: flatten_image(processed), repeat), 1))
+    results.append(_result('composite.flatten_straight_alpha',
+                           _timed(lambda: flatten_image(processed, premultiplied=False), repeat), 1))
+
+    flattened = flatten_image(processed)
+    for name, save in (('encode.jpeg_q95', lambda buffer: flattened.save(buffer, 'JPEG', quality=95)),
+                       ('encode.png', lambda buffer: flattened.save(buffer, 'PNG'))):
+        results.append(_result(name, _timed(lambda: save(io.BytesIO()), repeat), 1))
+    return results
+
+
+def end_to_end(root, barcodes, work_dir, repeat=1):
+    """Run the folder walkers end to end on the tree with the fake remover; stdout is suppressed."""
+    import abcd
+    import listing
+    import session_pool
+    import www
+
+    images = len(list_images(root))
+    catalog_db = os.path.join(work_dir, 'catalog.sqlite')
+    if not os.path.exists(catalog_db):
+        write_barcode_catalog(catalog_db, barcodes)
+    flat_input = os.path.join(work_dir, 'flat')
+    if not os.path.exists(flat_input):
+        os.makedirs(flat_input)
+        for index, path in enumerate(list_images(root)):
+            if LISTING_FOLDER in path:
+                shutil.copyfile(path, os.path.join(flat_input, f"{index}{os.path.splitext(path)[1]}"))
+    flat_images = len(os.listdir(flat_input))
+
+    def fresh(name):
+        path = os.path.join(work_dir, name)
+        shutil.rmtree(path, ignore_errors=True)
+        return path
+
+    def run_abcd():
+        output = fresh('abcd_out')
+        abcd.process_images(root, output, os.path.join(output, 'bg'))
+
+    def run_abcd_rerun():
+        # Second run against the first run's manifest; only the skip path is timed
+        abcd.process_images(root, os.path.join(work_dir, 'abcd_manifest'), os.path.join(work_dir, 'abcd_manifest', 'bg'),
+                            os.path.join(work_dir, 'abcd_manifest.sqlite'))
+
+    def run_listing():
+        listing.process_images(root, fresh('listing_out'))
+
+    def run_www():
+        tree = fresh('www_tree')
+        shutil.copytree(root, tree)
+        www.process_products_folder(tree)
+
+    def run_session_pool():
+        session_pool.remove_background(flat_input, fresh('session_pool_out'))
+
+    def run_session_pool_batched():
+        session_pool.remove_background(flat_input, fresh('session_pool_batch_out'), batch_size=8)
+
+    runs = [('e2e.abcd', run_abcd, images), ('e2e.listing', run_listing, images),
+            ('e2e.www', run_www, images), ('e2e.session_pool', run_session_pool, flat_images),
+            ('e2e.session_pool_batch8', run_session_pool_batched, flat_images)]
+
+    results = []
+    with fake_remover(catalog_db), contextlib.redirect_stdout(io.StringIO()):
+        for name, function, items in runs:
+            results.append(_result(name, _timed(function, repeat), items))
+        run_abcd_rerun()
+        results.append(_result('e2e.abcd_rerun_manifest', _timed(run_abcd_rerun, repeat), images))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_suite(products=50, images_per_product=4, size=(800, 800), black_ratio=0.5, png_ratio=0.25,
+              corrupt_ratio=0.02, repeat=5, e2e_repeat=1, parts=('micro', 'e2e'), work_dir=None, seed=0):
+    """Generate a catalog, run the selected parts and return the results as a JSON-ready dict."""
+    catalog = dict(products=products, images_per_product=images_per_product, size=list(size),
+                   black_ratio=black_ratio, png_ratio=png_ratio, corrupt_ratio=corrupt_ratio, seed=seed)
+    temporary = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='bench-')
+    try:
+        root = os.path.join(work_dir, 'catalog')
+        counts, barcodes = generate_catalog(root, products, images_per_product, size, black_ratio,
+                                            png_ratio, corrupt_ratio, seed=seed)
+        results = []
+        if 'micro' in parts:
+            results += micro_benchmarks(root, repeat)
+        if 'e2e' in parts:
+            results += end_to_end(root, barcodes, work_dir, e2e_repeat)
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'catalog': dict(catalog, **counts),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the probe, composite and encode stages and the folder walkers on a synthetic catalog.")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--products", type=int, default=50, help="Product folders in the synthetic tree")
+    parser.add_argument("--images-per-product", type=int, default=4, help="Images per ListingImage folder")
+    parser.add_argument("--size", type=int, nargs=2, default=(800, 800), metavar=("WIDTH", "HEIGHT"),
+                        help="Size of the generated images")
+    parser.add_argument("--black-ratio", type=float, default=0.5, help="Share of images on a black background")
+    parser.add_argument("--png-ratio", type=float, default=0.25, help="Share of images written as PNG")
+    parser.add_argument("--corrupt-ratio", type=float, default=0.02, help="Share of truncated images")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per microbenchmark")
+    parser.add_argument("--e2e-repeat", type=int, default=1, help="Runs per end-to-end benchmark")
+    parser.add_argument("--only", choices=("micro", "e2e"), help="Run only one part of the suite")
+    parser.add_argument("--work-dir", help="Keep the generated tree and outputs here instead of a temporary folder")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic tree")
+    parser.add_argument("--log-level", default="WARNING", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="Log level for the walkers under test (per-image INFO records slow the runs down)")
+    args = parser.parse_args()
+    setup_logging(getattr(logging, args.log_level))
+
+    report = run_suite(args.products, args.images_per_product, tuple(args.size), args.black_ratio, args.png_ratio,
+                       args.corrupt_ratio, args.repeat, args.e2e_repeat,
+                       (args.only,) if args.only else ('micro', 'e2e'), args.work_dir, args.seed)
+    for result in report['results']:
+        rate = f"{result['items_per_s']:.1f} items/s" if result['items_per_s'] else ""
+        print(f"{result['name']:28} {result['median_ms']:10.1f} ms  {rate}")
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
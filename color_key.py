@@ -0,0 +1,82 @@
+from PIL import Image, ImageFilter
+from lazy_import import LazyModule
+
+np = LazyModule('numpy')
+ndimage = LazyModule('scipy.ndimage')
+
+# Names of the paths an image can take to get its alpha mask, for reporting
+PATH_COLOR_KEY = 'color-key'
+PATH_CACHE = 'cache'
+PATH_MODEL = 'model'
+
+
+def border_confidence(near_black, band=2):
+    """Return the fraction of pixels within `band` pixels of the edge that are near black."""
+    height, width = near_black.shape
+    band = max(1, min(band, height // 2, width // 2))
+    edge_count = near_black[:band].sum() + near_black[-band:].sum()
+    edge_count += near_black[band:-band, :band].sum() + near_black[band:-band, -band:].sum()
+    edge_total = 2 * band * width + 2 * band * max(0, height - 2 * band)
+    return float(edge_count / edge_total) if edge_total else 0.0
+
+
+def center_background(foreground, center=1 / 3):
+    """Return the fraction of the central box (`center` of each side) that is background."""
+    height, width = foreground.shape
+    top, left = int(height * (1 - center) / 2), int(width * (1 - center) / 2)
+    box = foreground[top:max(top + 1, height - top), left:max(left + 1, width - left)]
+    return 1.0 - float(box.mean())
+
+
+def color_key_mask(img, tolerance=30, min_confidence=0.98, min_foreground=0.005,
+                   cleanup=1, feather=1.0, band=2, max_center_background=0.5):
+    """
+    Build the alpha mask for an image on a uniform black background without the model.
+
+    Near-black pixels (no channel above `tolerance`) connected to the image
+    border are flood-filled as background; everything else is foreground.
+    A dark product that touches the border would be flood-filled along with
+    the background, so the result is rejected when the keyed background
+    covers most of the middle of the image, where the product normally sits.
+
+    Parameters:
+    img (PIL.Image): Source image
+    tolerance (int): Highest channel value still counted as background
+    min_confidence (float): Fraction of the border band that must be near black
+    min_foreground (float): Smallest foreground share of the image to trust the result
+    cleanup (int): Morphological opening/closing iterations on the foreground (0 = off)
+    feather (float): Gaussian blur radius for soft edges (0 = hard edges)
+    band (int): Width in pixels of the border band that is scored
+    max_center_background (float): Largest background share of the central
+        third of the image (each side) to trust the result
+
+    Returns:
+    (mask, confidence): 'L' mask with 255 = foreground, or None when the
+    confidence is too low and the caller should fall back to the model
+    """
+    rgb = np.asarray(img.convert('RGB'))
+    near_black = rgb.max(axis=2) <= tolerance
+    del rgb
+
+    confidence = border_confidence(near_black, band)
+    if confidence < min_confidence:
+        return None, confidence
+
+    # Flood fill from the borders: only near-black regions reachable from the edge are background
+    seeds = np.zeros_like(near_black)
+    seeds[0], seeds[-1], seeds[:, 0], seeds[:, -1] = near_black[0], near_black[-1], near_black[:, 0], near_black[:, -1]
+    foreground = ~ndimage.binary_propagation(seeds, mask=near_black)
+    del seeds, near_black
+
+    if cleanup:
+        # Drop isolated noise specks, then close pinholes in the product
+        foreground = ndimage.binary_opening(foreground, iterations=cleanup)
+        foreground = ndimage.binary_closing(foreground, iterations=cleanup)
+
+    if foreground.mean() < min_foreground or center_background(foreground) > max_center_background:
+        return None, 0.0
+
+    mask = Image.fromarray(foreground.astype(np.uint8) * 255, 'L')
+    if feather:
+        mask = mask.filter(ImageFilter.GaussianBlur(feather))
+    return mask, confidence
@@ -0,0 +1,231 @@
+from PIL import Image
+import struct
+import zlib
+from lazy_import import LazyModule
+
+np = LazyModule('numpy')  # Only scanlines below the first need it
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG colour type -> samples per pixel, for the 8-bit layouts the scanline reader handles
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+PNG_BLOCK_BYTES = 1 << 20  # Decompressed scanline data handled at a time below the first row
+
+
+def pixel_rgb(img, xy):
+    """Return the RGB colour of one pixel without converting the whole image."""
+    x, y = xy
+    return img.crop((x, y, x + 1, y + 1)).convert('RGB').getpixel((0, 0))
+
+
+def image_corners(img):
+    """Return the RGB colours of the corners of an open image: TL, TR, BL, BR."""
+    width, height = img.size
+    return [
+        pixel_rgb(img, (0, 0)),                  # Top-left
+        pixel_rgb(img, (width - 1, 0)),          # Top-right
+        pixel_rgb(img, (0, height - 1)),         # Bottom-left
+        pixel_rgb(img, (width - 1, height - 1))  # Bottom-right
+    ]
+
+
+def _png_rgb(pixel, colour_type, palette):
+    """Convert one raw PNG pixel to RGB the way PIL's convert('RGB') does."""
+    if colour_type in (0, 4):  # Greyscale, greyscale + alpha
+        return (pixel[0], pixel[0], pixel[0])
+    if colour_type == 3:  # Palette
+        entry = palette[pixel[0] * 3:pixel[0] * 3 + 3]
+        return tuple(entry) if len(entry) == 3 else (0, 0, 0)
+    return tuple(pixel[:3])  # RGB, RGBA
+
+
+def _first_row_ends(row, bpp):
+    """Return the raw (first pixel, last pixel) of a PNG's first scanline, or None for an unknown filter."""
+    filter_type, raw = row[0], row[1:]
+    if filter_type in (0, 2):
+        # None / Up: the row above the first scanline is all zeros
+        last = raw[-bpp:]
+    elif filter_type in (1, 4):
+        # Sub / Paeth: on the first scanline Paeth always predicts the left byte,
+        # so both reduce to a running sum per channel
+        last = bytes(sum(raw[c::bpp]) & 0xFF for c in range(bpp))
+    elif filter_type == 3:
+        # Average: each byte adds half of the reconstructed byte to its left
+        last = []
+        for c in range(bpp):
+            value = 0
+            for byte in raw[c::bpp]:
+                value = (byte + (value >> 1)) & 0xFF
+            last.append(value)
+        last = bytes(last)
+    else:
+        return None
+    return raw[:bpp], last  # The left neighbour of the first pixel is zero for every filter
+
+
+def _block_ends(block, bpp, ends):
+    """
+    Carry (first pixel, last pixel) of the row above `block` (a 2-D array of whole
+    filtered scanlines) down through it and return the ends of its last row, or
+    None when a scanline needs its whole width reconstructed.
+    """
+    filters = block[:, 0]
+    single = block.shape[1] == 1 + bpp  # One pixel wide: the first pixel is the last
+    if not single and ((filters == 3) | (filters == 4)).any():
+        return None  # Average / Paeth: the last pixel depends on every pixel to its left
+    # Sub rows are their own running sum per channel; only the ones an Up row or the end reads are summed
+    needed = np.flatnonzero((filters == 1) & np.append(filters[1:] == 2, True))
+    rows = block[needed, 1:].reshape(len(needed), (block.shape[1] - 1) // bpp, bpp)
+    sums = dict(zip(needed.tolist(), (rows.transpose(0, 2, 1).copy().sum(axis=2) & 0xFF).tolist()))
+
+    first, last = ends
+    heads = block[:, 1:1 + bpp].tolist()
+    tails = block[:, -bpp:].tolist()
+    for index, filter_type in enumerate(filters.tolist()):
+        head = heads[index]
+        if filter_type == 0:
+            first, last = head, tails[index]
+        elif filter_type == 1:
+            first, last = head, sums.get(index)
+        elif filter_type == 2:
+            first = [(byte + above) & 0xFF for byte, above in zip(head, first)]
+            last = [(byte + above) & 0xFF for byte, above in zip(tails[index], last)]
+        elif filter_type in (3, 4):
+            # With a zero left neighbour Average predicts half the byte above, Paeth the byte above
+            shift = 1 if filter_type == 3 else 0
+            first = last = [(byte + (above >> shift)) & 0xFF for byte, above in zip(head, first)]
+        else:
+            return None
+    return first, last
+
+
+def png_corners(image_path):
+    """
+    Yield the RGB colours of a PNG's corners without decoding it into an image:
+    first [TL, TR], from its first scanline alone, then [BL, BR] once the rest
+    of the pixel data has been decompressed. Only the first and last pixel of
+    each scanline are reconstructed, which the None, Sub and Up filters allow.
+
+    Yields None instead, and stops, when the file is not an 8-bit
+    non-interlaced PNG or a later scanline uses the Average or Paeth filter
+    (its last pixel then takes the whole row), so callers can fall back to a
+    full decode. Close the generator to stop early.
+    """
+    with open(image_path, 'rb') as fp:
+        if fp.read(8) != PNG_SIGNATURE:
+            yield None
+            return
+        length, chunk_type = struct.unpack('>I4s', fp.read(8))
+        if chunk_type != b'IHDR' or length != 13:
+            yield None
+            return
+        width, height, depth, colour_type, _, _, interlace = struct.unpack('>IIBBBBB', fp.read(13))
+        fp.read(4)  # CRC
+        if depth != 8 or interlace or colour_type not in PNG_CHANNELS or width == 0 or height == 0:
+            yield None
+            return
+
+        bpp = PNG_CHANNELS[colour_type]
+        stride = 1 + width * bpp  # Filter byte + one row of samples
+        palette = b''
+        decompressor = zlib.decompressobj()
+        pending = bytearray()
+        rows = 0
+        ends = None
+        while rows < height:
+            header = fp.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'PLTE':
+                palette = fp.read(length)
+            elif chunk_type == b'IDAT':
+                compressed = fp.read(length)
+                while compressed and rows < height:
+                    # Inflate the first scanline alone, then at most PNG_BLOCK_BYTES at a time
+                    limit = stride - len(pending) if rows == 0 else max(stride, PNG_BLOCK_BYTES)
+                    pending += decompressor.decompress(compressed, limit)
+                    compressed = decompressor.unconsumed_tail
+                    count = min(len(pending) // stride, height - rows)
+                    if not count:
+                        continue
+                    data = bytes(pending[:count * stride])
+                    del pending[:count * stride]
+                    if rows == 0:
+                        ends = _first_row_ends(data[:stride], bpp)
+                        if ends is None:
+                            yield None
+                            return
+                        yield [_png_rgb(end, colour_type, palette) for end in ends]
+                        ends = [list(end) for end in ends]
+                    if count > 1 or rows:
+                        block = np.frombuffer(data, np.uint8).reshape(count, stride)
+                        ends = _block_ends(block if rows else block[1:], bpp, ends)
+                        if ends is None:
+                            yield None
+                            return
+                    rows += count
+            elif chunk_type == b'IEND':
+                break
+            else:
+                fp.seek(length, 1)
+            fp.read(4)  # CRC
+
+    if rows < height:
+        yield None  # Truncated
+        return
+    yield [_png_rgb(end, colour_type, palette) for end in ends]
+
+
+def corner_colors(image_path, tolerance=0):
+    """
+    Return the RGB colours of the four corners of an image: TL, TR, BL, BR.
+
+    Only the corner pixels are converted to RGB, and they are the exact
+    pixels a full decode gives. With a `tolerance` above 0, JPEGs are decoded
+    at 1/8 scale (draft mode) and the corners are the colours of the 8x8
+    blocks they sit in, which differ from the exact pixels on thin frames,
+    noisy backgrounds and detailed edges, so only callers that already allow
+    some colour error get it.
+    """
+    with Image.open(image_path) as img:
+        if tolerance > 0 and img.format == 'JPEG':
+            width, height = img.size
+            img.draft('RGB', (max(1, width // 8), max(1, height // 8)))
+        return image_corners(img)
+
+
+def is_black(color, tolerance=0):
+    """Check if no channel of `color` is above `tolerance`."""
+    return max(color) <= tolerance
+
+
+def has_black_corner(image_path, tolerance=0):
+    """Check if black color exists in the corner pixels of the image."""
+    corners = png_corners(image_path)
+    try:
+        for pair in corners:
+            if pair is None:
+                break  # Not a PNG the scanline reader handles: decode the image
+            if any(is_black(color, tolerance) for color in pair):
+                return True  # No need to read the rest of the PNG
+        else:
+            return False
+    finally:
+        corners.close()
+    return any(is_black(color, tolerance) for color in corner_colors(image_path, tolerance))
+
+
+def all_corners_below(image_path, threshold, tolerance=0):
+    """Check if every channel of every corner pixel is below `threshold`."""
+    corners = png_corners(image_path)
+    try:
+        for pair in corners:
+            if pair is None:
+                break  # Not a PNG the scanline reader handles: decode the image
+            if not all(max(color) < threshold for color in pair):
+                return False  # No need to read the rest of the PNG
+        else:
+            return True
+    finally:
+        corners.close()
+    return all(max(color) < threshold for color in corner_colors(image_path, tolerance))
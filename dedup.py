@@ -0,0 +1,180 @@
+from PIL import Image, ImageOps
+import io
+import threading
+from manifest import file_hash
+
+HASH_SIZE = 8  # dHash compares a (HASH_SIZE + 1) x HASH_SIZE greyscale thumbnail: 64 bits
+HASH_BITS = HASH_SIZE * HASH_SIZE
+DEFAULT_MAX_DISTANCE = 4  # Differing dHash bits still counted as the same photo
+# Greyscale gradients can't tell colourways of one product shot apart, so near
+# duplicates must also match in average colour (0-255 per channel) and shape
+COLOR_TOLERANCE = 6
+ASPECT_TOLERANCE = 0.01
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)  # Orientations exif_transpose turns by 90 degrees
+
+
+def perceptual_hash(path, hash_size=HASH_SIZE):
+    """
+    Return (dHash bits, average RGB, aspect ratio) of the EXIF-rotated image
+    at `path` (or in a file object), or None if it can't be decoded. JPEGs
+    are decoded in draft mode.
+    """
+    try:
+        with Image.open(path) as img:
+            # From the full size: draft() rounds each side to a multiple of its scale separately
+            width, height = img.size
+            if img.getexif().get(EXIF_ORIENTATION, 1) in ROTATED_ORIENTATIONS:
+                width, height = height, width
+            img.draft('RGB', ((hash_size + 1) * 4, hash_size * 4))  # Only JPEGs take the hint
+            img = ImageOps.exif_transpose(img).convert('RGB')
+    except Exception:
+        return None
+    aspect = width / height
+    thumbnail = img.resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    grey = thumbnail.convert('L').tobytes()
+    bits = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = grey[row * (hash_size + 1) + column]
+            bits = (bits << 1) | (left > grey[row * (hash_size + 1) + column + 1])
+    pixels = len(grey)
+    color = tuple(sum(band.tobytes()) / pixels for band in thumbnail.split())
+    return bits, color, aspect
+
+
+class _Group:
+    __slots__ = ('perceptual', 'size', 'followers', 'done', 'result')
+
+    def __init__(self, perceptual):
+        self.perceptual = perceptual
+        self.size = 1
+        self.followers = []  # (path, destination, on_duplicate) waiting for the leader's result
+        self.done = False
+        self.result = None
+
+
+class Deduplicator:
+    """
+    Groups inputs with the same content so each group is processed once.
+
+    The first input of a group (its leader) is processed as usual and its
+    result handed to finish(); every later input with the same SHA-256 is not
+    processed, and its `on_duplicate(path, destination, result)` callback is
+    called with the leader's result instead, so the caller can copy the
+    leader's output to that destination. With `perceptual`, inputs whose
+    dHash differs in at most `max_distance` bits (and whose average colour and
+    aspect ratio match) join a group too, e.g. the same photo saved again at
+    another quality or size. Their outputs are then copies of the leader's,
+    so only turn it on for catalogs where that is wanted. Safe to share
+    between threads; callbacks run on the thread that calls claim() or
+    finish().
+    """
+
+    def __init__(self, perceptual=False, max_distance=DEFAULT_MAX_DISTANCE):
+        self.perceptual = perceptual
+        self.max_distance = max_distance
+        self.claimed = 0
+        self.duplicates = 0
+        self.groups = 0  # Groups with at least one duplicate
+        self._by_hash = {}
+        self._by_segment = {}  # (segment number, segment bits) -> groups, for near-duplicate lookups
+        self._leaders = {}
+        self._lock = threading.Lock()
+
+    def _segments(self, bits):
+        # Two hashes within max_distance bits agree exactly on at least one of max_distance + 1 segments
+        count = self.max_distance + 1
+        width = HASH_BITS // count
+        for number in range(count):
+            low = number * width
+            high = HASH_BITS if number == count - 1 else low + width
+            yield number, (bits >> low) & ((1 << (high - low)) - 1)
+
+    def _similar(self, key):
+        bits, color, aspect = key
+        for segment in self._segments(bits):
+            for group in self._by_segment.get(segment, ()):
+                other_bits, other_color, other_aspect = group.perceptual
+                if (bin(bits ^ other_bits).count('1') <= self.max_distance
+                        and all(abs(a - b) <= COLOR_TOLERANCE for a, b in zip(color, other_color))
+                        and abs(aspect - other_aspect) <= ASPECT_TOLERANCE * other_aspect):
+                    return group
+        return None
+
+    def claim(self, path, destination, on_duplicate, content_hash=None, data=None):
+        """
+        Return True if `path` is the first of its group and must be processed
+        (then call finish() with its result), or False if it is a duplicate;
+        `on_duplicate` is then called once the leader's result is known, which
+        may be right away.
+
+        Parameters:
+        path (str): Input file
+        destination: What the caller needs to deliver this input's output, e.g. its output path
+        on_duplicate (callable): Called as on_duplicate(path, destination, leader's result)
+        content_hash (str): SHA-256 hex digest of the file if already known (e.g. from the manifest)
+        data (bytes): The file's contents if already read; the perceptual hash is taken from them
+        """
+        try:
+            digest = bytes.fromhex(content_hash or file_hash(path))
+        except OSError:
+            return True  # Unreadable: processing it reports the error
+        key = perceptual_hash(io.BytesIO(data) if data is not None else path) if self.perceptual else None
+        with self._lock:
+            self.claimed += 1
+            group = self._by_hash.get(digest)
+            if group is None and key is not None:
+                group = self._similar(key)
+            if group is None:
+                group = _Group(key)
+                self._by_hash[digest] = group
+                if key is not None:
+                    for segment in self._segments(key[0]):
+                        self._by_segment.setdefault(segment, []).append(group)
+                self._leaders[path] = group
+                return True
+
+            self._by_hash.setdefault(digest, group)  # Exact copies of this near duplicate match directly
+            self.duplicates += 1
+            group.size += 1
+            if group.size == 2:
+                self.groups += 1
+            if not group.done:
+                group.followers.append((path, destination, on_duplicate))
+                return False
+            result = group.result
+        on_duplicate(path, destination, result)
+        return False
+
+    def finish(self, path, result):
+        """
+        Record the result of processing the leader `path` (None if it failed)
+        and call the callbacks of the duplicates waiting for it.
+        """
+        with self._lock:
+            group = self._leaders.pop(path, None)
+            if group is None:
+                return
+            group.done = True
+            group.result = result
+            followers, group.followers = group.followers, []
+        for follower, destination, on_duplicate in followers:
+            on_duplicate(follower, destination, result)
+
+    def summary(self, metrics=None):
+        """
+        Return a one-line report of the work saved. With `metrics` (see
+        metrics.Metrics), the time saved is estimated from the mean decode,
+        infer, composite and encode times of the images that were processed.
+        """
+        if not self.claimed:
+            return "Duplicates: no images checked"
+        text = (f"Duplicates: {self.duplicates} of {self.claimed} images ({self.duplicates / self.claimed:.0%}, "
+                f"{self.groups} groups) reused another image's result")
+        if metrics is not None and self.duplicates:
+            stages = metrics.snapshot()['stages']
+            per_image = sum(stages[stage]['mean'] for stage in ('decode', 'infer', 'composite', 'encode')
+                            if stage in stages and stages[stage]['count'])
+            text += f", about {self.duplicates * per_image:.1f}s of processing saved"
+        return text
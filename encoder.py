@@ -0,0 +1,174 @@
+from PIL import Image
+import io
+import os
+import threading
+from metrics import get_metrics, stage_timer
+
+FORMAT_JPEG = 'JPEG'
+FORMAT_WEBP = 'WEBP'
+FORMAT_PNG = 'PNG'
+FORMATS = (FORMAT_JPEG, FORMAT_WEBP, FORMAT_PNG)
+EXTENSIONS = {FORMAT_JPEG: '.jpg', FORMAT_WEBP: '.webp', FORMAT_PNG: '.png'}
+CONTENT_TYPES = {FORMAT_JPEG: 'image/jpeg', FORMAT_WEBP: 'image/webp', FORMAT_PNG: 'image/png'}
+
+# Quality used when a lossy spec gives none and has a target size to search down from
+SEARCH_START_QUALITY = {FORMAT_JPEG: 95, FORMAT_WEBP: 90}
+MIN_QUALITY = 40  # The target-size search never goes below this; the result may then be bigger
+WEBP_METHOD = 4  # libwebp effort, 0 (fast) to 6 (smallest)
+# Threads for an encode stage; PIL releases the GIL while encoding, so they run in parallel
+DEFAULT_ENCODE_WORKERS = max(2, (os.cpu_count() or 2) // 2)
+
+
+class OutputSpec:
+    """
+    One file written for each processed image.
+
+    Parameters:
+    format (str): One of FORMATS
+    quality (int): JPEG/WebP quality; None uses PIL's default (75 for JPEG, 80 for WebP)
+    max_side (int): Shrink so the longest side is at most this; None keeps the full size
+    suffix (str): Added to the output file name before the extension, e.g. '_thumb'
+    extension (str): Extension of the written file, e.g. '.webp'; None keeps the output path's
+    progressive (bool): Progressive JPEG (often smaller, and renders early in browsers)
+    optimize (bool): Optimized Huffman tables for JPEG, smallest deflate for PNG
+    target_bytes (int): Largest file size wanted; lossy formats search for the
+        highest quality (up to `quality`) that fits
+    lossless (bool): Lossless WebP
+    """
+
+    def __init__(self, format=FORMAT_JPEG, quality=None, max_side=None, suffix='', extension=None,
+                 progressive=False, optimize=False, target_bytes=None, lossless=False):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown output format '{format}', expected one of {FORMATS}")
+        self.format = format
+        self.quality = quality
+        self.max_side = max_side
+        self.suffix = suffix
+        self.extension = extension
+        self.progressive = progressive
+        self.optimize = optimize
+        self.target_bytes = target_bytes
+        self.lossless = lossless
+
+    def path_for(self, output_path):
+        """Return where this output of an image meant for `output_path` is written."""
+        root, extension = os.path.splitext(output_path)
+        return root + self.suffix + (self.extension if self.extension is not None else extension)
+
+    def save_options(self, quality=None):
+        """Return the keyword arguments for Image.save at `quality` (default: the spec's)."""
+        quality = self.quality if quality is None else quality
+        options = {}
+        if self.format == FORMAT_JPEG:
+            options.update(optimize=self.optimize, progressive=self.progressive)
+        elif self.format == FORMAT_WEBP:
+            options.update(method=WEBP_METHOD, lossless=self.lossless)
+        else:
+            options.update(optimize=self.optimize)
+        if quality is not None and self.format != FORMAT_PNG:
+            options['quality'] = quality
+        return options
+
+
+# What earlier versions wrote: one JPEG at the output path, PIL's default settings
+DEFAULT_OUTPUTS = (OutputSpec(),)
+# Full-size progressive JPEG plus WebP listing and thumbnail variants, for the web shop / CDN
+WEB_OUTPUTS = (
+    OutputSpec(FORMAT_JPEG, quality=90, progressive=True, optimize=True),
+    OutputSpec(FORMAT_WEBP, quality=85, max_side=1200, suffix='_listing', extension='.webp'),
+    OutputSpec(FORMAT_WEBP, quality=80, max_side=300, suffix='_thumb', extension='.webp', target_bytes=20 * 1024),
+)
+
+
+def _save(img, spec, quality=None):
+    buffer = io.BytesIO()
+    img.save(buffer, spec.format, **spec.save_options(quality))
+    return buffer.getvalue()
+
+
+def encode_image(img, spec):
+    """
+    Return `img` encoded as `spec` says (without resizing). With a target
+    size, a binary search over quality finds the best one that fits, about
+    six encodes; if even MIN_QUALITY is too big, that is what is returned.
+    """
+    if not spec.target_bytes or spec.format == FORMAT_PNG or spec.lossless:
+        return _save(img, spec)
+
+    high = spec.quality or SEARCH_START_QUALITY[spec.format]
+    data = _save(img, spec, high)
+    if len(data) <= spec.target_bytes:
+        return data
+    low, best = MIN_QUALITY, None
+    high -= 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _save(img, spec, quality)
+        if len(candidate) <= spec.target_bytes:
+            best, low = candidate, quality + 1
+        else:
+            high = quality - 1
+    return best if best is not None else _save(img, spec, MIN_QUALITY)
+
+
+def resized(img, max_side):
+    """Return `img` shrunk so its longest side is at most `max_side` (the image itself if it already is)."""
+    if max_side is None or max(img.size) <= max_side:
+        return img
+    scale = max_side / max(img.size)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def encode_outputs(img, output_path, outputs=DEFAULT_OUTPUTS, timings=None):
+    """
+    Encode every output of `img` and return [(path, bytes)], in the order of
+    `outputs`. All size variants come from the one decoded image; each is
+    shrunk from the smallest larger one already made, so the full-size image
+    is only resampled once. Time spent counts as the 'encode' stage, in
+    `timings` if given (see metrics.stage_timer).
+    """
+    variants = {None: img}
+    encoded = [None] * len(outputs)
+    # Largest first, so every variant has its next larger one to shrink from
+    order = sorted(range(len(outputs)), key=lambda i: -(outputs[i].max_side or float('inf')))
+    for index in order:
+        spec = outputs[index]
+        with _timer(timings, 'encode'):  # Includes the resize
+            variant = variants.get(spec.max_side)
+            if variant is None:
+                larger = min((v for side, v in variants.items() if side is None or side > spec.max_side),
+                             key=lambda v: max(v.size))
+                variant = variants[spec.max_side] = resized(larger, spec.max_side)
+            encoded[index] = (spec.path_for(output_path), encode_image(variant, spec))
+    return encoded
+
+
+def write_atomic(path, data):
+    """
+    Write `data` to `path` through a temporary file in the same folder and a
+    rename, so readers (and a crash) never see a half-written file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as output_file:
+            output_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_outputs(encoded, timings=None):
+    """Write the [(path, bytes)] from encode_outputs atomically, timed as the 'write' stage."""
+    with _timer(timings, 'write'):
+        for path, data in encoded:
+            write_atomic(path, data)
+
+
+def _timer(timings, stage):
+    # Worker processes send their timings back in a dict; everything else records them directly
+    return stage_timer(timings, stage) if timings is not None else get_metrics().timer(stage)
@@ -0,0 +1,126 @@
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import threading
+from metrics import get_metrics
+
+COPY_HARDLINK = 'hardlink'  # Same inode: instant, but rewriting the source in place changes the copy too
+COPY_REFLINK = 'reflink'    # Copy-on-write clone (Btrfs, XFS, ...), falls back to a plain copy
+COPY_FILE = 'copy'          # Byte copy via shutil.copyfile (sendfile / OS fast paths)
+COPY_REENCODE = 'reencode'  # Legacy: decode and save again with PIL
+STRATEGIES = (COPY_HARDLINK, COPY_REFLINK, COPY_FILE, COPY_REENCODE)
+DEFAULT_STRATEGY = COPY_FILE
+
+FICLONE = 0x40049409  # Linux ioctl that clones one file's extents into another
+
+
+def reflink(src, dst):
+    """Clone `src` to `dst` sharing extents; raises OSError where unsupported."""
+    import fcntl  # Unix only; ImportError is treated like an unsupported filesystem
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(dst)
+            raise
+
+
+def copy_file(src, dst, strategy=DEFAULT_STRATEGY):
+    """
+    Copy an original image to `dst` with the given strategy (see STRATEGIES).
+
+    The copy is made under a temporary name in the same folder and renamed
+    over `dst`, so a reader (or another copy to the same name) never sees a
+    half-written file, as in encoder.write_atomic.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return  # Already there (same file or an earlier hard link)
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown copy strategy '{strategy}', expected one of {STRATEGIES}")
+
+    tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        _copy_to(src, tmp_path, strategy, os.path.splitext(dst)[1])
+        os.replace(tmp_path, dst)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _copy_to(src, dst, strategy, extension):
+    if strategy == COPY_REENCODE:
+        with Image.open(src) as img:
+            # `dst` is a temporary name, so the format comes from the final extension
+            img.save(dst, format=Image.registered_extensions().get(extension.lower()))
+        return
+
+    if strategy == COPY_HARDLINK:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass  # Different filesystem or no hard link support: copy instead
+    elif strategy == COPY_REFLINK:
+        try:
+            reflink(src, dst)
+            return
+        except (OSError, ImportError):
+            pass
+
+    shutil.copyfile(src, dst)
+
+
+class Copier:
+    """
+    Copy files on a thread pool so the copies overlap with scanning.
+
+    `callback(src, dst, error)` is called from a pool thread after each copy,
+    with `error` None on success. Copies to the same `dst` (e.g. several
+    folders' 0.jpg flattened into one output folder) run one at a time.
+    Use as a context manager; leaving it waits for every pending copy.
+    """
+
+    def __init__(self, strategy=DEFAULT_STRATEGY, workers=4):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown copy strategy '{strategy}', expected one of {STRATEGIES}")
+        self.strategy = strategy
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copy')
+        self._lock = threading.Lock()
+        self._dst_locks = {}  # dst -> [lock, copies waiting for or holding it]
+
+    def submit(self, src, dst, callback=None):
+        return self._executor.submit(self._copy, src, dst, callback)
+
+    def _copy(self, src, dst, callback):
+        with self._lock:
+            entry = self._dst_locks.setdefault(dst, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0], get_metrics().timer('copy'):
+                copy_file(src, dst, self.strategy)
+        except Exception as e:
+            if callback is None:
+                raise
+            callback(src, dst, e)
+        else:
+            if callback is not None:
+                callback(src, dst, None)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._dst_locks[dst]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
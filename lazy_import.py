@@ -0,0 +1,88 @@
+import importlib
+import re
+import subprocess
+import sys
+import threading
+
+# Modules that make start-up slow; the profile says whether each one was loaded
+HEAVY_MODULES = ('rembg', 'onnxruntime', 'pyodbc', 'scipy', 'numpy')
+IMPORT_PROFILE_FLAG = '--import-profile'
+
+_IMPORT_TIME = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    `np = LazyModule('numpy')` costs nothing at import time; the first
+    `np.asarray` imports numpy, and every attribute looked up is cached on the
+    stand-in so later lookups are plain attribute reads. An ImportError (for
+    example pyodbc without its driver) is raised at that first use, not when
+    the importing module loads.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        value = getattr(self._module or self._load(), attr)
+        self.__dict__[attr] = value
+        return value
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def import_profile(module_name):
+    """
+    Import `module_name` in a fresh interpreter with `-X importtime` and return
+    (seconds to import it, [(cumulative seconds, module)] of its direct
+    imports, slowest first, {heavy module: loaded}).
+    """
+    code = f"import sys, {module_name}; print(','.join(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    # -X importtime lists a module after everything it imports, indented by depth
+    total, children, direct_imports = 0.0, [], []
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME.match(line)
+        if match is None:
+            continue
+        cumulative, depth, name = int(match.group(2)) / 1e6, len(match.group(3)) // 2, match.group(4)
+        if depth == 1:
+            children.append((cumulative, name))
+        elif depth == 0:
+            if name == module_name:
+                total, direct_imports = cumulative, children
+            children = []
+    loaded = set(result.stdout.strip().split(','))
+    heavy = {name: name in loaded for name in HEAVY_MODULES}
+    return total, sorted(direct_imports, reverse=True), heavy
+
+
+def print_import_profile(module_name, top=15):
+    """Print how long importing `module_name` takes, what dominates it and which heavy modules it pulls in."""
+    total, imports, heavy = import_profile(module_name)
+    print(f"Importing {module_name}: {total * 1000:.0f} ms")
+    for cumulative, name in imports[:top]:
+        print(f"  {cumulative * 1000:8.1f} ms  {name}")
+    print("Heavy modules loaded at import: " +
+          (", ".join(name for name, loaded in heavy.items() if loaded) or "none"))
+
+
+def wants_import_profile(argv=None):
+    """Check if the command line asks for the import profile instead of a run."""
+    return IMPORT_PROFILE_FLAG in (sys.argv if argv is None else argv)
@@ -1,53 +1,105 @@
 import os
-from PIL import Image
+import logging
+import threading
+from corner_probe import has_black_corner
+from file_copy import Copier, DEFAULT_STRATEGY
+from manifest import open_manifest, DEFAULT_MANIFEST_NAME, STATUS_DONE, STATUS_ERROR, CLASS_BLACK, CLASS_OTHER
+from lazy_import import wants_import_profile, print_import_profile
+from metrics import reset_metrics, setup_logging, log_event, DEFAULT_METRICS_NAME
+from scanner import scan_images, DEFAULT_INDEX_NAME, DEFAULT_SCAN_WORKERS
 
-def has_black_color(image_path):
-    """Check if black color exists in the corner pixels of the image."""
-    img = Image.open(image_path)
-    img = img.convert("RGB")  # Ensure the image is in RGB mode
-
-    width, height = img.size
-    corners = [
-        img.getpixel((0, 0)),           # Top-left
-        img.getpixel((width - 1, 0)),  # Top-right
-        img.getpixel((0, height - 1)), # Bottom-left
-        img.getpixel((width - 1, height - 1)) # Bottom-right
-    ]
+log = logging.getLogger('listing')
+log.addHandler(logging.NullHandler())  # Silent when imported as a library; entry points call setup_logging
 
-    return (0, 0, 0) in corners  # Check if any corner contains black (RGB: (0, 0, 0))
+def has_black_color(image_path, tolerance=0):
+    """Check if black color exists in the corner pixels of the image."""
+    return has_black_corner(image_path, tolerance)  # Decodes as little of the image as possible
 
-def process_images(input_folder, output_folder):
-    """Process images and save those with black corners directly to the output folder."""
+def process_images(input_folder, output_folder, manifest_path=None, copy_strategy=DEFAULT_STRATEGY,
+                   metrics_path=None, profile_every=0, scan_index_path=None, scan_depth=None,
+                   scan_workers=DEFAULT_SCAN_WORKERS):
+    """
+    Process images and save those with black corners directly to the output folder.
+    Stage timings and counters are written to `metrics_path` while the run goes.
+    Only 'ListingImage' folders are read (see scanner.scan_images); with
+    `scan_index_path`, directories unchanged since the last run are not listed
+    again. By default 'ListingImage' folders are found at any depth, as
+    listing does not rely on where they sit; `scan_depth` stops the scan
+    from entering branches deeper than the level they can be at, e.g.
+    scanner.LISTING_DEPTH for the <root>/<product>/ListingImage layout.
+    """
     os.makedirs(output_folder, exist_ok=True)  # Ensure output folder exists
+    metrics = reset_metrics(profile_every, os.path.join(output_folder, "profiles"))
+    if metrics_path:
+        metrics.start_export(metrics_path)
 
-    # File to store names of saved images
+    # File to store names of saved images; written sorted at the end, since copies finish in any order
     txt_file_path = os.path.join(output_folder, "black_corner_images.txt")
+    names = []
+    names_lock = threading.Lock()
+
+    def saved(file_path, output_path, error):
+        # Runs on a copy thread once the original has been copied
+        if error is not None:
+            metrics.inc('errors')
+            log_event(log, "copy failed", logging.ERROR, image=file_path, error=error)
+            manifest.record(file_path, STATUS_ERROR)
+            return
+
+        # Keep the image name without extension for the text file
+        name_without_extension = os.path.splitext(os.path.basename(file_path))[0]
+        with names_lock:
+            names.append(name_without_extension)
+
+        metrics.inc('images_processed')
+        log_event(log, "saved", output=output_path)
+        manifest.record(file_path, STATUS_DONE, CLASS_BLACK, output_path)
+
+    # Copies run on a thread pool so they overlap with scanning
+    with open_manifest(manifest_path) as manifest, Copier(copy_strategy) as copier:
+        # Process only the 'ListingImage' subfolders; the output folder is never scanned
+        for root, filenames in scan_images(input_folder, workers=scan_workers, index_path=scan_index_path,
+                                           max_depth=scan_depth, exclude=(output_folder,)):
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                name_without_extension = os.path.splitext(filename)[0]
+
+                # Unchanged since an earlier run: keep it in the list without checking or copying again
+                previous = manifest.finished(file_path)
+                if previous is not None:
+                    if previous['classification'] == CLASS_BLACK:
+                        with names_lock:
+                            names.append(name_without_extension)
+                    metrics.inc('images_skipped')
+                    continue
+
+                try:
+                    with metrics.sampled('classify'):
+                        is_black = has_black_color(file_path)
+                    metrics.inc('images_classified')
+                    if is_black:  # Check if the image has black corners
+                        # Save the image directly into the output folder
+                        output_path = os.path.join(output_folder, filename)
+                        copier.submit(file_path, output_path, saved)
+                    else:
+                        manifest.record(file_path, STATUS_DONE, CLASS_OTHER)
+                except Exception as e:
+                    metrics.inc('errors')
+                    log_event(log, "classify failed", logging.ERROR, image=file_path, error=e)
+                    manifest.record(file_path, STATUS_ERROR)
+
     with open(txt_file_path, "w") as txt_file:
-        for root, dirs, files in os.walk(input_folder):
-            if "ListingImage" in root:  # Process only the 'ListingImage' subfolder
-                for filename in files:
-                    if not filename.lower().endswith((".jpg", ".jpeg", ".png")):  # Skip non-image files
-                        continue
-
-                    file_path = os.path.join(root, filename)
-                    try:
-                        if has_black_color(file_path):  # Check if the image has black corners
-                            # Save the image directly into the output folder
-                            img = Image.open(file_path)
-                            output_path = os.path.join(output_folder, filename)
-                            img.save(output_path)
-
-                            # Write the image name without extension to the text file
-                            name_without_extension = os.path.splitext(filename)[0]
-                            txt_file.write(name_without_extension + "\n")
-
-                            print(f"Saved: {output_path}")
-                    except Exception as e:
-                        print(f"Error processing file {file_path}: {e}")
+        txt_file.writelines(name + "\n" for name in sorted(names))
 
+    metrics.stop_export()
     print(f"Image names saved in: {txt_file_path}")
+    print(metrics.summary())
 
 def main():
+    if wants_import_profile():
+        print_import_profile('listing')
+        return
+
     print("Detect black corner pixels in images and save matching images to a single folder.")
     input_folder = input("Enter the path to the input folder: ").strip()
     output_folder = input("Enter the path to the output folder: ").strip()
@@ -56,7 +108,10 @@ def main():
         print(f"The input folder '{input_folder}' does not exist.")
         return
 
-    process_images(input_folder, output_folder)
+    setup_logging()
+    process_images(input_folder, output_folder, os.path.join(output_folder, DEFAULT_MANIFEST_NAME),
+                   metrics_path=os.path.join(output_folder, DEFAULT_METRICS_NAME),
+                   scan_index_path=os.path.join(output_folder, DEFAULT_INDEX_NAME))
 
 if __name__ == "__main__":
     main()
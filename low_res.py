@@ -0,0 +1,168 @@
+from PIL import Image, ImageOps
+from lazy_import import LazyModule
+import math
+import sys
+import time
+import tracemalloc
+
+np = LazyModule('numpy')
+ndimage = LazyModule('scipy.ndimage')
+
+# Longest side the model input is cut down to; u2net itself works at 320px
+DEFAULT_MAX_SIDE = 1024
+STRIP_ROWS = 512  # Full-resolution rows refined at a time
+
+
+def reduce_factor(size, max_side):
+    """Return the integer factor that brings `size` down to at most `max_side` on its longest side."""
+    return max(1, math.ceil(max(size) / max_side))
+
+
+def reduced_copy(img, max_side=DEFAULT_MAX_SIDE):
+    """Return `img` shrunk with PIL's box reducer so its longest side is at most `max_side`."""
+    factor = reduce_factor(img.size, max_side)
+    return img.reduce(factor) if factor > 1 else img
+
+
+def open_reduced(path, max_side=DEFAULT_MAX_SIDE):
+    """
+    Open `path` at reduced resolution. JPEGs are decoded in draft mode, so the
+    decoder itself skips most of the work; any other format is decoded in full
+    and then reduced. The result is EXIF-rotated, like rembg's input.
+    """
+    with Image.open(path) as img:
+        factor = reduce_factor(img.size, max_side)
+        if factor > 1 and img.format == 'JPEG':
+            # Draft picks the largest DCT scale that is still at least this size
+            img.draft('RGB', (img.width // factor, img.height // factor))
+        img = ImageOps.exif_transpose(img)
+        return reduced_copy(img, max_side)
+
+
+def _box(array, radius):
+    return ndimage.uniform_filter(array, size=2 * radius + 1, mode='reflect')
+
+
+def guided_upsample(mask, guide_small, guide_full, radius=4, eps=1e-3, strip_rows=STRIP_ROWS):
+    """
+    Upscale a low-resolution mask to `guide_full`'s size, snapping its edges to
+    the full-resolution image (fast guided filter).
+
+    The guided filter's linear coefficients are fitted between the mask and
+    `guide_small` (the image the mask was predicted on), upsampled bilinearly,
+    and applied to the full-resolution luminance. The full-resolution side is
+    done `strip_rows` rows at a time, so only the 'L' output is ever held at
+    full size.
+
+    Parameters:
+    mask (PIL.Image): Low-resolution mask, same size as `guide_small`
+    guide_small (PIL.Image): Low-resolution image
+    guide_full (PIL.Image): Full-resolution image
+    radius (int): Filter radius in low-resolution pixels
+    eps (float): Regularization; larger values smooth more across edges
+    """
+    guide = np.asarray(guide_small.convert('L'), np.float32) / 255
+    p = np.asarray(mask.convert('L'), np.float32) / 255
+    if guide.shape != p.shape:
+        raise ValueError(f"Mask size {mask.size} does not match the guide's {guide_small.size}")
+
+    mean_i, mean_p = _box(guide, radius), _box(p, radius)
+    var_i = _box(guide * guide, radius) - mean_i * mean_i
+    cov_ip = _box(guide * p, radius) - mean_i * mean_p
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    coeff_a = Image.fromarray(_box(a, radius).astype(np.float32), 'F')
+    coeff_b = Image.fromarray(_box(b, radius).astype(np.float32), 'F')
+    del guide, p, mean_i, mean_p, var_i, cov_ip, a, b
+
+    width, height = guide_full.size
+    scale = guide_small.height / height
+    out = np.empty((height, width), np.uint8)
+    for top in range(0, height, strip_rows):
+        bottom = min(top + strip_rows, height)
+        # Resize only the matching band of the coefficient maps, so no full-size float array exists
+        box = (0, top * scale, guide_small.width, bottom * scale)
+        strip_a = np.asarray(coeff_a.resize((width, bottom - top), Image.Resampling.BILINEAR, box=box))
+        strip_b = np.asarray(coeff_b.resize((width, bottom - top), Image.Resampling.BILINEAR, box=box))
+        luminance = np.asarray(guide_full.crop((0, top, width, bottom)).convert('L'), np.float32)
+        q = strip_a * luminance
+        q *= 1 / 255
+        q += strip_b
+        q *= 255
+        np.clip(q, 0, 255, out=q)
+        np.rint(q, out=q)
+        out[top:bottom] = q
+    return Image.fromarray(out, 'L')
+
+
+def low_res_mask(img, predict, max_side=DEFAULT_MAX_SIDE, small=None):
+    """
+    Return a full-resolution mask for `img`, predicted on a reduced copy.
+
+    Parameters:
+    img (PIL.Image): Full-resolution (EXIF-rotated) image
+    predict (callable): Takes an image and returns its 'L' mask, e.g.
+        lambda im: remove(im, session=session, only_mask=True)
+    max_side (int): Longest side of the image the model sees
+    small (PIL.Image): Reduced copy of `img` if the caller already has one
+        (see open_reduced); made with reduced_copy otherwise
+    """
+    if small is None:
+        small = reduced_copy(img, max_side)
+    if small.size == img.size:
+        return predict(img)
+    return guided_upsample(predict(small), small, img)
+
+
+def _measure(path, max_side, repeat):
+    # Runs in a fresh process, so ru_maxrss is this mode's own peak
+    from rembg import remove
+    from session_pool import get_session
+    from compositing import cutout, flatten_image
+
+    session = get_session()
+    predict = lambda im: remove(im, session=session, only_mask=True)
+
+    def run():
+        with Image.open(path) as img:
+            img = ImageOps.exif_transpose(img)
+        if max_side:
+            mask = low_res_mask(img, predict, max_side, open_reduced(path, max_side))
+        else:
+            mask = predict(img)
+        flatten_image(cutout(img, mask))
+
+    run()  # Warm-up: model load and first-run allocations
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    latency = (time.perf_counter() - start) / repeat * 1000
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    try:
+        import resource
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kB on Linux
+    except ImportError:
+        rss_peak = None
+    return latency, traced_peak, rss_peak
+
+
+def benchmark(path, max_side=DEFAULT_MAX_SIDE, repeat=3):
+    """Compare full-resolution and reduced-resolution masking of `path` and print latency and peak memory."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    with Image.open(path) as img:
+        print(f"{path}: {img.width}x{img.height}, {repeat} runs")
+    for label, side in (("full resolution", None), (f"reduced to {max_side}px", max_side)):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            latency, traced_peak, rss_peak = executor.submit(_measure, path, side, repeat).result()
+        rss = f"{rss_peak / 2**20:.0f} MB" if rss_peak is not None else "n/a"
+        print(f"{label:22} {latency:8.0f} ms/image, peak traced {traced_peak / 2**20:.0f} MB, peak RSS {rss}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python low_res.py IMAGE [MAX_SIDE]")
+    else:
+        benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_MAX_SIDE)
@@ -0,0 +1,197 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MANIFEST_NAME = '.manifest.sqlite'
+
+# Statuses recorded per input file
+STATUS_CLASSIFIED = 'classified'  # Detection done, later steps still to run
+STATUS_DONE = 'done'
+STATUS_ERROR = 'error'
+
+# Classifications recorded per input file
+CLASS_BLACK = 'black'  # Black corners / background found
+CLASS_OTHER = 'other'
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents (same as mask_cache.content_hash)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    SQLite record of every input a folder walker has handled.
+
+    Each row keeps the input's path, size, mtime, content hash, classification,
+    output path and status. A re-run only needs to stat a file to know it is
+    unchanged and finished; files from an interrupted run have no 'done' row
+    and are picked up again. Walkers that overwrite their inputs also keep the
+    hash of the original (`source_hash`) and the settings the output was made
+    with, so a later run can tell what it would need to redo. Safe to share
+    between threads.
+
+    Parameters:
+    db_path (str): SQLite database file
+    hash_files (bool): Store content hashes of files that were processed
+        further than classification, and when their mtime differs compare them
+        before treating a finished file as changed (e.g. after a touch). Files
+        classified as CLASS_OTHER are not hashed: re-probing one after a touch
+        costs no more than hashing it on every run would.
+    commit_every (int): Number of records between commits
+    """
+
+    def __init__(self, db_path, hash_files=True, commit_every=200):
+        self.hash_files = hash_files
+        self.commit_every = commit_every
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                content_hash TEXT,
+                classification TEXT,
+                output_path TEXT,
+                status TEXT,
+                updated_at REAL,
+                source_hash TEXT,
+                settings TEXT
+            )
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(files)")}
+        for column in ('source_hash', 'settings'):
+            if column not in columns:  # Manifests written before these columns existed
+                self._conn.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+        self._conn.commit()
+
+    def lookup(self, path):
+        """Return the row for `path` as a dict, or None."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT size, mtime_ns, content_hash, classification, output_path, status, source_hash, settings "
+                "FROM files WHERE path = ?", (path,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        keys = ('size', 'mtime_ns', 'content_hash', 'classification', 'output_path', 'status', 'source_hash',
+                'settings')
+        return dict(zip(keys, row))
+
+    def finished(self, path, stat=None, status=STATUS_DONE):
+        """
+        Return the row for `path` if it reached `status` (or one of a tuple of
+        statuses) in an earlier run and neither it nor its recorded output has
+        changed since, else None. A file that cannot be read (removed or
+        unreadable since it was listed) counts as changed.
+        """
+        statuses = (status,) if isinstance(status, str) else status
+        row = self.lookup(path)
+        if row is None or row['status'] not in statuses:
+            return None
+        if row['output_path'] and not os.path.exists(row['output_path']):
+            return None
+        try:
+            stat = stat or os.stat(path)
+            if row['size'] == stat.st_size and row['mtime_ns'] == stat.st_mtime_ns:
+                return row
+            if not self.hash_files or row['content_hash'] is None or row['size'] != stat.st_size:
+                return None
+            if file_hash(path) != row['content_hash']:
+                return None
+        except OSError:
+            return None
+        with self._lock:
+            # Same content under a new mtime: remember the new stat so the next run skips the hash
+            self._conn.execute("UPDATE files SET mtime_ns = ? WHERE path = ?", (stat.st_mtime_ns, path))
+            self._maybe_commit()
+        return row
+
+    def is_unchanged(self, path, stat=None, status=STATUS_DONE):
+        """Check if `path` reached `status` in an earlier run and has not changed since."""
+        return self.finished(path, stat, status) is not None
+
+    def record(self, path, status, classification=None, output_path=None, stat=None, source_hash=None,
+               settings=None, content_hash=None):
+        """
+        Record the outcome for `path`, with the size, mtime and hash it has now.
+        `content_hash` is the hash of the file as it is now, when the caller
+        already has it; otherwise it is computed only for files that are
+        hashed at all (see `hash_files`). `source_hash` is the hash of the
+        original when `path` was overwritten with its output, and `settings`
+        a caller-defined description of how the output was made.
+        """
+        digest = content_hash
+        try:
+            stat = stat or os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            if digest is None and self.hash_files and status != STATUS_ERROR and classification != CLASS_OTHER:
+                digest = file_hash(path)
+        except OSError:
+            size = mtime_ns = digest = None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files "
+                "(path, size, mtime_ns, content_hash, classification, output_path, status, updated_at, "
+                "source_hash, settings) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, digest, classification, output_path, status, time.time(), source_hash,
+                 settings))
+            self._maybe_commit()
+
+    def _maybe_commit(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NullManifest:
+    """Stand-in used when no manifest is configured: nothing is skipped or recorded."""
+
+    def lookup(self, path):
+        return None
+
+    def finished(self, path, stat=None, status=STATUS_DONE):
+        return None
+
+    def is_unchanged(self, path, stat=None, status=STATUS_DONE):
+        return False
+
+    def record(self, path, status, classification=None, output_path=None, stat=None, source_hash=None,
+               settings=None, content_hash=None):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_manifest(db_path):
+    """Return a Manifest for `db_path`, or a NullManifest when it is None."""
+    return Manifest(db_path) if db_path else NullManifest()
@@ -0,0 +1,138 @@
+from PIL import Image
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3  # 10 GB
+MASK_SUFFIX = '.png'
+SOURCE_SUFFIX = '.src'
+
+
+def content_hash(data):
+    """Return the SHA-256 hex digest of `data` (the raw bytes of a source file)."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class MaskCache:
+    """
+    Persistent on-disk cache of the alpha masks produced by the background remover.
+
+    Entries are keyed by the content hash of the source file plus the model
+    name and stored as compressed greyscale PNGs under `cache_dir`. The source
+    file itself can be kept too (put_source), for callers that overwrite it
+    with their output and may need the original pixels again, e.g. to render
+    onto another background. When the total size exceeds `max_bytes` the least
+    recently used files are deleted; recency survives restarts through the
+    files' modification times. Safe to share between threads.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # file name -> size in bytes, least recently used first
+        self._total = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        found = []
+        for folder in os.scandir(self.cache_dir):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith((MASK_SUFFIX, SOURCE_SUFFIX)):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total += size
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name[:2], name)
+
+    def key(self, digest, model_name):
+        """Return the cache key for a source file's content hash (see content_hash) and a model name."""
+        return f"{digest}-{model_name}"
+
+    def _open(self, name):
+        # Path of a cached file, marked as just used, or None if it is not cached
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        path = self._path(name)
+        try:
+            os.utime(path)  # Record the use for the next process's LRU order
+        except OSError:
+            self._forget(name)
+            return None
+        return path
+
+    def _forget(self, name):
+        with self._lock:
+            self._total -= self._entries.pop(name, 0)
+
+    def _store(self, name, write):
+        # write(temp_path) creates the file; readers never see a partly written one
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        write(temp_path)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self._total += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_name, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                try:
+                    os.remove(self._path(old_name))
+                except OSError:
+                    pass
+
+    def get(self, key):
+        """Return the cached mask ('L' image) for `key`, or None."""
+        path = self._open(key + MASK_SUFFIX)
+        if path is None:
+            return None
+        try:
+            with Image.open(path) as mask:
+                mask.load()
+        except OSError:
+            self._forget(key + MASK_SUFFIX)
+            return None
+        return mask
+
+    def put(self, key, mask):
+        """Store `mask` under `key`, evicting least recently used entries over the size cap."""
+        self._store(key + MASK_SUFFIX, lambda temp_path: mask.convert('L').save(temp_path, 'PNG', optimize=True))
+
+    def get_source(self, digest):
+        """Return the bytes of the source file with content hash `digest`, or None if not kept."""
+        path = self._open(digest + SOURCE_SUFFIX)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as source_file:
+                return source_file.read()
+        except OSError:
+            self._forget(digest + SOURCE_SUFFIX)
+            return None
+
+    def put_source(self, digest, data):
+        """Keep the source file bytes `data` (content hash `digest`), as they are on disk."""
+        if self._open(digest + SOURCE_SUFFIX) is not None:
+            return  # Already kept; now marked as used
+
+        def write(temp_path):
+            with open(temp_path, 'wb') as source_file:
+                source_file.write(data)
+
+        self._store(digest + SOURCE_SUFFIX, write)
+
+    def __len__(self):
+        return len(self._entries)
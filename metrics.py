@@ -0,0 +1,339 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_METRICS_NAME = 'metrics.json'  # Written next to the manifest unless a path is given
+STAGES = ('walk', 'decode', 'classify', 'infer', 'composite', 'encode', 'write')
+# Histogram bucket upper bounds in seconds (Prometheus `le` labels)
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+DEFAULT_EXPORT_INTERVAL = 10.0  # Seconds between metrics file writes
+DEFAULT_LOG_RATE = 20  # Records per second allowed for each event name
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())  # Silent when imported as a library; entry points call setup_logging
+
+
+def peak_rss():
+    """Return (this process's, its finished children's) peak resident set size in bytes, or (None, None)."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None, None
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024  # ru_maxrss is in kB on Linux, bytes on macOS
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, plus count, sum, min and max."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'buckets': {str(bound): count for bound, count in zip(self.buckets + ('+Inf',), self.counts)},
+        }
+
+
+class Metrics:
+    """
+    Counters, per-stage latency histograms and gauges for one run.
+
+    Stages are the names in STAGES (any other name works too). Gauges can be
+    callables returning a number or a {name: number} dict, such as
+    Pipeline.queue_depths, and are read when a snapshot is taken. With
+    `profile_every` N above 0, every Nth sampled() block of a stage runs under
+    cProfile and its stats are dumped to `profile_dir`.
+    """
+
+    def __init__(self, profile_every=0, profile_dir=None):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.profile_every = profile_every
+        self.profile_dir = profile_dir
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()  # One profiler at a time
+        self._exporter = None
+        self._stop = threading.Event()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_all(self, timings):
+        """Record a {stage: seconds} dict, e.g. timings sent back by a worker process."""
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+
+    def gauge(self, name, value):
+        """Set a gauge to a value or to a callable read at snapshot time."""
+        with self._lock:
+            self.gauges[name] = value
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def sampled(self, stage):
+        """Time a block like timer(); every `profile_every`th one of the stage is also profiled."""
+        profiler = None
+        if self.profile_every:
+            with self._lock:
+                number = self._samples[stage] = self._samples.get(stage, 0) + 1
+            if number % self.profile_every == 0 and self._profile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+                profiler.enable()
+        try:
+            with self.timer(stage):
+                yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profile_lock.release()
+                profile_dir = self.profile_dir or '.'
+                os.makedirs(profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(profile_dir, f"{stage}-{number}.prof"))
+
+    def snapshot(self):
+        """Return every metric as a JSON-ready dict."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {stage: histogram.snapshot() for stage, histogram in self.histograms.items()}
+            gauges = dict(self.gauges)
+        self_rss, children_rss = peak_rss()
+        elapsed = time.time() - self.started
+        processed = counters.get('images_processed', 0)
+        return {
+            'timestamp': time.time(),
+            'elapsed_s': elapsed,
+            'images_per_s': processed / elapsed if elapsed else None,
+            'counters': counters,
+            'stages': histograms,
+            'gauges': Metrics._read_gauges(gauges),
+            'peak_rss_bytes': self_rss,
+            'peak_rss_children_bytes': children_rss,
+        }
+
+    @staticmethod
+    def _read_gauges(gauges):
+        values = {}
+        for name, gauge in gauges.items():
+            try:
+                value = gauge() if callable(gauge) else gauge
+            except Exception:
+                continue  # A gauge whose source is gone (e.g. a finished pipeline)
+            if isinstance(value, dict):
+                values.update({f"{name}.{key}": item for key, item in value.items()})
+            else:
+                values[name] = value
+        return values
+
+    def to_prometheus(self, prefix='bgremove'):
+        """Return the snapshot in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        if snapshot['stages']:
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+        for stage, histogram in sorted(snapshot['stages'].items()):
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        for name, value in sorted(snapshot['gauges'].items()):
+            metric = name.replace('.', '_').replace('-', '_')
+            lines += [f"# TYPE {prefix}_{metric} gauge", f"{prefix}_{metric} {value}"]
+        for name in ('peak_rss_bytes', 'peak_rss_children_bytes'):
+            if snapshot[name] is not None:
+                lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {snapshot[name]}"]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics to `path`: Prometheus text for *.prom, JSON otherwise. The write is atomic."""
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(tmp_path, path)
+
+    def start_export(self, path, interval=DEFAULT_EXPORT_INTERVAL):
+        """Write the metrics to `path` every `interval` seconds until stop_export()."""
+        def export():
+            while not self._stop.wait(interval):
+                try:
+                    self.write(path)
+                except OSError as e:
+                    log.warning("metrics export failed: %s", e)
+
+        self._export_path = path
+        self._exporter = threading.Thread(target=export, name='metrics-export', daemon=True)
+        self._exporter.start()
+
+    def stop_export(self):
+        """Stop the periodic export and write the final metrics."""
+        if self._exporter is None:
+            return
+        self._stop.set()
+        self._exporter.join()
+        self._exporter = None
+        self.write(self._export_path)
+
+    def summary(self):
+        """Return a one-line text summary of the run: throughput and mean latency per stage."""
+        snapshot = self.snapshot()
+        parts = [f"{snapshot['counters'].get('images_processed', 0)} images in {snapshot['elapsed_s']:.1f}s"]
+        for stage in STAGES:
+            histogram = snapshot['stages'].get(stage)
+            if histogram and histogram['count']:
+                parts.append(f"{stage} {histogram['mean'] * 1000:.1f}ms x{histogram['count']}")
+        errors = snapshot['counters'].get('errors', 0)
+        if errors:
+            parts.append(f"{errors} errors")
+        if snapshot['peak_rss_bytes'] is not None:
+            parts.append(f"peak RSS {snapshot['peak_rss_bytes'] / 2**20:.0f} MB")
+        return ", ".join(parts)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_metrics():
+    """Return this process's shared Metrics, creating it on first use."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Metrics()
+        return _default
+
+
+def reset_metrics(profile_every=0, profile_dir=None):
+    """Start a fresh shared Metrics for a new run and return it."""
+    global _default
+    with _default_lock:
+        _default = Metrics(profile_every, profile_dir)
+        return _default
+
+
+@contextmanager
+def stage_timer(timings, stage):
+    """Add the block's duration to `timings[stage]`, for work whose timings are sent back from another process."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `rate` records per second for each event (the record's
+    message template). Dropped records are counted and the count is attached
+    to the next record of that event that gets through, as `suppressed`.
+    """
+
+    def __init__(self, rate=DEFAULT_LOG_RATE):
+        super().__init__()
+        self.rate = rate
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        key = (record.name, record.msg)
+        with self._lock:
+            window_start, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - window_start >= 1.0:
+                window_start, count = now, 0
+            if count >= self.rate:
+                self._windows[key] = (window_start, count, suppressed + 1)
+                return False
+            self._windows[key] = (window_start, count + 1, 0)
+        if suppressed:
+            record.fields = dict(getattr(record, 'fields', {}), suppressed=suppressed)
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format records as `time level logger event key=value ...`, or one JSON object per line."""
+
+    def __init__(self, json_format=False):
+        super().__init__()
+        self.json_format = json_format
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.json_format:
+            entry = {'time': record.created, 'level': record.levelname, 'logger': record.name,
+                     'event': record.getMessage()}
+            entry.update(fields)
+            return json.dumps(entry, default=str)
+        pairs = ' '.join(f"{key}={value}" for key, value in fields.items())
+        timestamp = time.strftime('%H:%M:%S', time.localtime(record.created))
+        return f"{timestamp} {record.levelname:7} {record.name} {record.getMessage()} {pairs}".rstrip()
+
+
+def setup_logging(level=logging.INFO, json_format=False, rate=DEFAULT_LOG_RATE):
+    """Send structured, rate-limited log records to stderr (replaces any handler set up before)."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(json_format))
+    handler.addFilter(RateLimitFilter(rate))
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def log_event(logger, event, level=logging.INFO, **fields):
+    """Log `event` with key=value `fields`, e.g. log_event(log, "processed", path=path)."""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
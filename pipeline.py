@@ -0,0 +1,124 @@
+import logging
+import queue
+import threading
+import time
+from metrics import log_event
+
+_DONE = object()  # End-of-stream marker passed from stage to stage
+
+log = logging.getLogger('pipeline')
+log.addHandler(logging.NullHandler())  # Silent when imported as a library; entry points call setup_logging
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    `func(item, emit)` handles one input item and calls `emit(output)` for
+    every item it passes on (zero, one or many). With `batch_size` above 1
+    the stage instead calls `func(items, emit)` with up to `batch_size` items,
+    waiting at most `batch_timeout` seconds after the first one for the batch
+    to fill.
+
+    Parameters:
+    name (str): Name used in error reports
+    func (callable): Handler, see above
+    workers (int): Number of threads running this stage
+    queue_size (int): Capacity of the stage's input queue; a full queue blocks
+        the stage before it, which keeps memory flat
+    batch_size (int): Items per call, see above
+    batch_timeout (float): Seconds to wait for a batch to fill
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=32, batch_size=1, batch_timeout=0.5):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+
+def _log_error(stage, item, e):
+    log_event(log, "stage failed", logging.ERROR, stage=stage.name, error=e)
+
+
+class Pipeline:
+    """
+    Run stages concurrently, connected by bounded queues.
+
+    Every stage starts at once, so the first item reaches the last stage as
+    soon as the earlier stages have handled it, rather than after they have
+    handled everything. An exception for one item is passed to `on_error`
+    (by default logged) and the pipeline carries on.
+    """
+
+    def __init__(self, stages, on_error=None):
+        self.stages = stages
+        self.on_error = on_error or _log_error
+        self.queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+
+    def queue_depths(self):
+        """Return {stage name: items waiting in its input queue}."""
+        return {stage.name: q.qsize() for stage, q in zip(self.stages, self.queues)}
+
+    def run(self, items):
+        """Feed `items` into the first stage and block until every stage has drained."""
+        threads = []
+        for index, stage in enumerate(self.stages):
+            output = self.queues[index + 1] if index + 1 < len(self.stages) else None
+            remaining = [stage.workers]  # Workers of this stage still running
+            lock = threading.Lock()
+            for number in range(stage.workers):
+                thread = threading.Thread(target=self._worker, name=f"{stage.name}-{number}",
+                                          args=(stage, self.queues[index], output, remaining, lock),
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            self.queues[0].put(item)
+        self.queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+
+    def _worker(self, stage, input_queue, output_queue, remaining, lock):
+        emit = output_queue.put if output_queue is not None else (lambda item: None)
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                break
+
+            if stage.batch_size > 1:
+                item, finished = self._fill_batch(stage, input_queue, [item])
+            else:
+                finished = False
+            try:
+                stage.func(item, emit)
+            except Exception as e:
+                self.on_error(stage, item, e)
+            if finished:
+                break
+
+        # Let sibling workers see the end of the stream; the last one tells the next stage
+        input_queue.put(_DONE)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and output_queue is not None:
+            output_queue.put(_DONE)
+
+    def _fill_batch(self, stage, input_queue, batch):
+        deadline = time.monotonic() + stage.batch_timeout
+        while len(batch) < stage.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = input_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
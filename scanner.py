@@ -0,0 +1,223 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from metrics import get_metrics, log_event
+
+DEFAULT_INDEX_NAME = '.scan_index.sqlite'
+DEFAULT_SCAN_WORKERS = 8  # Directories listed at once; listing is I/O bound, so threads overlap well
+LISTING_FOLDER = 'ListingImage'
+LISTING_DEPTH = 2  # Level of the folders in our layout, <root>/<product>/ListingImage
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# A directory modified this recently may change again within its mtime's resolution
+# (2 s on FAT, coarse on some network shares), so its listing is not indexed
+RACY_SECONDS = 2.0
+
+log = logging.getLogger('scanner')
+log.addHandler(logging.NullHandler())  # Silent when imported as a library; entry points call setup_logging
+
+
+class DirectoryIndex:
+    """
+    SQLite record of each directory's mtime and listing from an earlier scan.
+
+    A directory's mtime changes whenever an entry is added to, removed from or
+    renamed in it, so while the mtime is the one recorded the stored listing
+    is still right and the directory needs a stat instead of a full read.
+    Files edited in place do not change it; the manifest catches those.
+    Safe to share between threads.
+
+    Parameters:
+    db_path (str): SQLite database file
+    commit_every (int): Number of stored listings between commits
+    """
+
+    ROWS_CHUNK = 500  # Paths per query in rows(), under SQLite's default limit of 999 parameters
+
+    def __init__(self, db_path, commit_every=500):
+        self.commit_every = commit_every
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER,
+                subdirs TEXT,
+                files TEXT
+            )
+        """)
+        self._conn.commit()
+
+    def rows(self, paths):
+        """
+        Return {path: (mtime_ns, subdirs JSON, files JSON)} for those of `paths`
+        that have a stored listing, read in one query per few hundred paths
+        (e.g. all the subdirectories of a directory just listed).
+        """
+        found = {}
+        paths = list(paths)
+        with self._lock:
+            for start in range(0, len(paths), self.ROWS_CHUNK):
+                chunk = paths[start:start + self.ROWS_CHUNK]
+                cursor = self._conn.execute(
+                    "SELECT path, mtime_ns, subdirs, files FROM directories "
+                    f"WHERE path IN ({', '.join('?' * len(chunk))})", chunk)
+                for path, mtime_ns, subdirs, files in cursor:
+                    found[path] = (mtime_ns, subdirs, files)
+        return found
+
+    def store(self, path, mtime_ns, subdirs, files):
+        """Record the listing of `path`, and forget subdirectories that are gone since the last one."""
+        with self._lock:
+            row = self._conn.execute("SELECT subdirs FROM directories WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                for name in set(json.loads(row[0])) - set(subdirs):
+                    self._forget(os.path.join(path, name))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO directories (path, mtime_ns, subdirs, files) VALUES (?, ?, ?, ?)",
+                (path, mtime_ns, json.dumps(subdirs), json.dumps(files)))
+            self._maybe_commit()
+
+    def _forget(self, path):
+        # The directory and everything under it: paths in [path + sep, path + next char after sep)
+        self._conn.execute("DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)",
+                           (path, path + os.sep, path + chr(ord(os.sep) + 1)))
+
+    def _maybe_commit(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _list_dir(path, index, row=None):
+    """
+    Return (subdirectory names, file names, whether the index answered, stored
+    rows of the subdirectories) for one directory. `row` is its own stored
+    listing from DirectoryIndex.rows, if any.
+    """
+    metrics = get_metrics()
+    start = time.perf_counter()
+    try:
+        mtime_ns = None
+        unchanged = False
+        if index is not None:
+            mtime_ns = os.stat(path).st_mtime_ns
+            if row is not None and row[0] == mtime_ns:
+                subdirs, files = json.loads(row[1]), json.loads(row[2])
+                unchanged = True
+
+        if not unchanged:
+            subdirs, files = [], []
+            listed_at = time.time_ns()
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # d_type / the find data answers these without a stat per entry, like os.walk
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        files.append(entry.name)
+                    elif not entry.is_symlink():  # Symlinked directories are not followed, as in os.walk
+                        subdirs.append(entry.name)
+            if index is not None and listed_at - mtime_ns > RACY_SECONDS * 1e9:
+                index.store(path, mtime_ns, subdirs, files)
+
+        child_rows = {}
+        if index is not None and subdirs:
+            # One query for all the subdirectories, instead of one each when they are listed
+            child_rows = index.rows(os.path.join(path, name) for name in subdirs)
+    except OSError as e:
+        # Unreadable or vanished directories are skipped, as os.walk does
+        log_event(log, "directory not scanned", logging.WARNING, directory=path, error=e)
+        return [], [], False, {}
+    metrics.observe('walk', time.perf_counter() - start)
+    return subdirs, files, unchanged, child_rows
+
+
+def scan_images(root, folder_name=LISTING_FOLDER, extensions=IMAGE_EXTENSIONS, workers=DEFAULT_SCAN_WORKERS,
+                index_path=None, max_depth=None, exclude=()):
+    """
+    Yield (directory path, [image file names]) for every directory under `root`
+    inside a `folder_name` folder, as soon as each one has been listed.
+
+    A directory is inside it when one of its path components is exactly
+    `folder_name` (the directory itself or an ancestor, so 'ListingImage2' or
+    'OldListingImages' do not count); with `folder_name` None every directory
+    is. Directories are listed with os.scandir on `workers` threads, so on
+    network storage many listings are in flight at once, and results stream
+    out while the rest of the tree is still being read. Order is not stable.
+    With an index, the stored listings of a directory's subdirectories are
+    read together when it has been listed, not one query per directory.
+
+    Parameters:
+    root (str): Folder to scan; yielded paths are joined onto it as given, like os.walk
+    extensions (tuple): Lower-case file name endings that count as images
+    index_path (str): SQLite file of a DirectoryIndex. Listings of directories whose mtime
+        is unchanged since the last scan are taken from it, and new ones recorded.
+    max_depth (int): Deepest level a `folder_name` folder can be at (the children of
+        `root` are level 1). Branches outside one are not entered below that level,
+        e.g. LISTING_DEPTH for <root>/<product>/ListingImage skips every other
+        product subfolder. None enters every branch.
+    exclude (iterable): Folders never entered, e.g. output folders inside `root`
+    """
+    metrics = get_metrics()
+    excluded = {os.path.normcase(os.path.abspath(path)) for path in exclude}
+    root_matched = folder_name is None or folder_name in os.path.normpath(root).split(os.sep)
+    in_flight_limit = workers * 4
+    pending = {}
+
+    index = DirectoryIndex(index_path) if index_path else None
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='scan')
+    try:
+        root_row = index.rows([root]).get(root) if index is not None else None
+        stack = [(root, 0, root_matched, root_row)]  # Depth first, so the backlog of unlisted directories stays small
+        while stack or pending:
+            while stack and len(pending) < in_flight_limit:
+                path, depth, matched, row = stack.pop()
+                pending[executor.submit(_list_dir, path, index, row)] = (path, depth, matched)
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, depth, matched = pending.pop(future)
+                subdirs, files, unchanged, child_rows = future.result()
+                metrics.inc('directories_scanned')
+                if unchanged:
+                    metrics.inc('directories_unchanged')
+
+                for name in subdirs:
+                    child_matched = matched or name == folder_name
+                    if not child_matched and max_depth is not None and depth + 1 >= max_depth:
+                        metrics.inc('directories_pruned')  # Its subfolders would be too deep to count
+                        continue
+                    child = os.path.join(path, name)
+                    if excluded and os.path.normcase(os.path.abspath(child)) in excluded:
+                        continue
+                    stack.append((child, depth + 1, child_matched, child_rows.get(child)))
+
+                if matched:
+                    images = [name for name in files if name.lower().endswith(extensions)]
+                    if images:
+                        yield path, images
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if index is not None:
+            index.close()
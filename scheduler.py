@@ -0,0 +1,241 @@
+from PIL import Image
+from concurrent.futures import wait, FIRST_COMPLETED
+from contextlib import contextmanager
+import itertools
+import os
+import sys
+import threading
+import time
+
+# Peak bytes per pixel of one image going through decode -> mask -> cutout -> flatten -> encode:
+# the decoded RGB copy and its EXIF-rotated copy, RGBA conversion, the empty RGBA and the
+# cutout that rembg composites, the full-size mask, the white canvas and the encode buffer
+DEFAULT_BYTES_PER_PIXEL = 24
+JOB_OVERHEAD_BYTES = 32 * 2**20  # Model input tensors, decoder state and the like, whatever the image size
+SESSION_BYTES = 512 * 2**20  # One resident rembg session (u2net weights and onnxruntime arenas)
+DEFAULT_BUDGET_FRACTION = 0.75  # Share of the available memory the default budget uses
+DEFAULT_PATIENCE = 2.0  # Seconds a job waits before later, smaller jobs may no longer overtake it
+DEFAULT_WINDOW = 64  # Jobs looked ahead at when picking what to start next
+
+_END = object()
+
+
+def image_dimensions(path):
+    """Return (width, height) of an image from its header, without decoding it, or None if unreadable."""
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except Exception:
+        return None  # Fails at decode too, and cheaply, so it costs no more than the overhead
+
+
+def estimate_memory(size, bytes_per_pixel=DEFAULT_BYTES_PER_PIXEL):
+    """Return the estimated peak bytes of processing an image of `size`; None (no readable header) costs the overhead."""
+    if size is None:
+        return JOB_OVERHEAD_BYTES
+    width, height = size
+    return width * height * bytes_per_pixel + JOB_OVERHEAD_BYTES
+
+
+def job_cost(path, bytes_per_pixel=DEFAULT_BYTES_PER_PIXEL):
+    """Return the estimated peak bytes of processing the image at `path`."""
+    return estimate_memory(image_dimensions(path), bytes_per_pixel)
+
+
+def available_memory():
+    """Return the bytes of memory available to new work (free plus reclaimable cache), or None if unknown."""
+    if sys.platform == 'win32':
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_budget(reserved=0, fraction=DEFAULT_BUDGET_FRACTION):
+    """
+    Return a budget for image work: `fraction` of the memory available now,
+    less `reserved` bytes (e.g. the resident sessions), or None if unknown.
+    """
+    available = available_memory()
+    if available is None:
+        return None
+    return max(int(available * fraction) - reserved, JOB_OVERHEAD_BYTES)
+
+
+class MemoryBudget:
+    """
+    Admission control for jobs with an estimated peak memory cost.
+
+    A job is admitted while the costs of the admitted jobs stay within
+    `budget` bytes, so many small images run side by side while large ones
+    take a bigger share. A job costing more than the whole budget is only
+    admitted when nothing else runs, and nothing else is admitted beside it.
+    Smaller jobs may overtake a waiting larger one, until it has waited
+    `patience` seconds. Jobs are held under a key and released by it;
+    releasing a key that is not held does nothing, so error paths can
+    release unconditionally. Safe to share between threads.
+
+    Parameters:
+    budget (int): Bytes the admitted jobs may use together; None for no limit
+    max_jobs (int): Most jobs admitted at once, e.g. the number of workers
+    """
+
+    def __init__(self, budget, max_jobs=None, patience=DEFAULT_PATIENCE):
+        self.budget = budget
+        self.max_jobs = max_jobs
+        self.patience = patience
+        self.in_use = 0
+        self.peak = 0
+        self._held = {}
+        self._waiting = {}  # ticket -> time it started waiting, in arrival order
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+
+    def _fits(self, cost):
+        if self.max_jobs is not None and len(self._held) >= self.max_jobs:
+            return False
+        if self.budget is None or not self._held:
+            return True  # Alone, a job runs whatever its cost
+        return self.in_use + cost <= self.budget
+
+    def _hold(self, key, cost):
+        self._held[key] = self._held.get(key, 0) + cost
+        self.in_use += cost
+        self.peak = max(self.peak, self.in_use)
+
+    def try_acquire(self, key, cost):
+        """Admit a job costing `cost` bytes under `key` if it fits now; return whether it was admitted."""
+        with self._cond:
+            if not self._fits(cost):
+                return False
+            self._hold(key, cost)
+            return True
+
+    def acquire(self, key, cost):
+        """Block until a job costing `cost` bytes can be admitted, and hold it under `key`."""
+        with self._cond:
+            ticket = next(self._tickets)
+            self._waiting[ticket] = time.monotonic()
+            try:
+                while not (self._fits(cost) and not self._overtaking(ticket)):
+                    self._cond.wait(self.patience)  # Woken by releases; the timeout lets waits age
+                self._hold(key, cost)
+            finally:
+                del self._waiting[ticket]
+                self._cond.notify_all()  # The next waiter may be able to go too
+
+    def _overtaking(self, ticket):
+        # Whether an earlier waiter has run out of patience, so this one must queue behind it
+        now = time.monotonic()
+        for other, since in self._waiting.items():
+            if other >= ticket:
+                return False
+            if now - since > self.patience:
+                return True
+        return False
+
+    def release(self, key):
+        """Release the job held under `key`, if any."""
+        with self._cond:
+            cost = self._held.pop(key, None)
+            if cost is not None:
+                self.in_use -= cost
+                self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, key, cost):
+        """Hold a job for the duration of the block."""
+        self.acquire(key, cost)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def usage(self):
+        """Return the current figures as a dict, for a metrics gauge."""
+        with self._cond:
+            return {'in_use_bytes': self.in_use, 'peak_bytes': self.peak, 'budget_bytes': self.budget,
+                    'jobs': len(self._held), 'waiting': len(self._waiting)}
+
+
+def pack_batches(jobs, costs, batch_size, budget=None):
+    """
+    Split `jobs` into batches of at most `batch_size` whose summed costs stay
+    within `budget`, grouping images of similar cost. `costs` maps each job
+    to its cost. A job costing more than the budget gets a batch of its own.
+    """
+    batches, batch, batch_cost = [], [], 0
+    for job in sorted(jobs, key=costs.__getitem__):
+        cost = costs[job]
+        if batch and (len(batch) >= batch_size or (budget is not None and batch_cost + cost > budget)):
+            batches.append(batch)
+            batch, batch_cost = [], 0
+        batch.append(job)
+        batch_cost += cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def run_scheduled(executor, fn, items, budget, cost=job_cost, window=DEFAULT_WINDOW):
+    """
+    Run fn(item) on `executor` for each of `items`, starting them as the
+    MemoryBudget `budget` admits them, and yield the results as they finish.
+
+    Up to `window` items are looked ahead at; of those the largest that fits
+    next to the running ones is started first, so small images fill the gaps
+    around big ones. Items costing more than the budget start once everything
+    else has finished, and run alone. `items` may be a lazy iterable.
+    """
+    items = iter(items)
+    pending = []  # (cost, number, item), biggest first
+    running = {}
+    numbers = itertools.count()
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < window:
+            item = next(items, _END)
+            if item is _END:
+                exhausted = True
+            else:
+                pending.append((cost(item), next(numbers), item))
+        pending.sort(key=lambda entry: (-entry[0], entry[1]))
+
+        # Start everything that fits, biggest first
+        index = 0
+        while index < len(pending):
+            item_cost, number, item = pending[index]
+            if budget.try_acquire(number, item_cost):
+                running[executor.submit(fn, item)] = number
+                del pending[index]
+            else:
+                index += 1
+        if not running:
+            return
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            budget.release(running.pop(future))
+            yield future.result()
+
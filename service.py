@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from PIL import Image, ImageOps
+from batch_inference import BatchInferenceEngine
+from color_key import color_key_mask
+from compositing import cutout, flatten_image, WHITE
+from corner_probe import corner_colors, is_black
+from encoder import OutputSpec, encode_image, CONTENT_TYPES
+from low_res import reduced_copy, guided_upsample
+from session_pool import create_session, DEFAULT_MODEL
+from lazy_import import LazyModule, print_import_profile, IMPORT_PROFILE_FLAG
+
+DEFAULT_PORT = 8080
+MAX_BODY = 100 * 2**20  # Largest upload accepted, in bytes
+STREAM_CHUNK = 64 * 1024  # Bytes per chunk of a streamed response
+BLACK_THRESHOLD = 30  # Corner channels below this count as a black background (as in www)
+
+OP_REMOVE = 'remove-background'
+OP_FLATTEN = 'flatten'
+
+rembg = LazyModule('rembg')
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           411: 'Length Required', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+# Session, batch engine and inference size of the current worker process (set by _init_worker)
+_worker_session = None
+_worker_engine = None
+_worker_max_side = None
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or REASONS[status])
+        self.status = status
+
+
+def _init_worker(model_name, threads, batch_size, max_side):
+    """Create the worker's session (and batch engine) once, when the process starts."""
+    global _worker_session, _worker_engine, _worker_max_side
+    _worker_session = create_session(model_name, threads)
+    if batch_size > 1:
+        _worker_engine = BatchInferenceEngine(_worker_session.inner_session, batch_size)
+    _worker_max_side = max_side
+
+
+def _warm():
+    return os.getpid()
+
+
+def _predict(small):
+    if _worker_engine is not None:
+        return _worker_engine.submit(small)
+    return rembg.remove(small, session=_worker_session, only_mask=True)
+
+
+def _render(operation, img, mask, options):
+    buffer = io.BytesIO()
+    processed_img = cutout(img, mask)
+    if operation == OP_REMOVE:
+        processed_img.save(buffer, 'PNG')
+        return buffer.getvalue(), 'image/png'
+    output = options['output']
+    return encode_image(flatten_image(processed_img, options['background']), output), CONTENT_TYPES[output.format]
+
+
+def process_requests(requests):
+    """
+    Run a micro-batch of (operation, image bytes, options) in a worker process.
+
+    Images that need the model are submitted to the worker's batch engine
+    together, so they share one session call. Returns one (body, content type)
+    or Exception per request, in order.
+    """
+    results = [None] * len(requests)
+    pending = []
+    for index, (operation, data, options) in enumerate(requests):
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                # rembg predicts on the EXIF-rotated image
+                img = ImageOps.exif_transpose(img)
+                img.load()
+
+            # Opt-in: a uniform black background is keyed out directly; anything else goes to the model
+            mask = color_key_mask(img)[0] if options['color_key'] else None
+            if mask is not None:
+                results[index] = _render(operation, img, mask, options)
+                continue
+
+            max_side = options['max_side'] or _worker_max_side
+            small = reduced_copy(img, max_side) if max_side else img
+            pending.append((index, operation, img, small, options, _predict(small)))
+        except Exception as e:
+            results[index] = e
+
+    for index, operation, img, small, options, prediction in pending:
+        try:
+            mask = prediction.result() if _worker_engine is not None else prediction
+            if small.size != img.size:
+                mask = guided_upsample(mask, small, img)
+            results[index] = _render(operation, img, mask, options)
+        except Exception as e:
+            results[index] = e
+    return results
+
+
+def classify(data, tolerance=0):
+    """Return the corner check for an uploaded image as a JSON-ready dict."""
+    corners = corner_colors(io.BytesIO(data), tolerance)
+    return {
+        'corners': [list(color) for color in corners],
+        'black_corner': any(is_black(color, tolerance) for color in corners),
+        'black_background': all(max(color) < BLACK_THRESHOLD for color in corners),
+    }
+
+
+class Coalescer:
+    """
+    Collect concurrent requests into micro-batches for the process pool.
+
+    A batch is sent as soon as it holds `batch_size` requests, or `max_wait`
+    seconds after its first request arrived, whichever comes first.
+    """
+
+    def __init__(self, executor, batch_size=4, max_wait=0.02):
+        self.executor = executor
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.batches_sent = 0
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, operation, data, options):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((operation, data, options), future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        result = await future
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.batches_sent += 1
+        loop = asyncio.get_running_loop()
+        task = loop.run_in_executor(self.executor, process_requests, [request for request, _ in batch])
+        task.add_done_callback(lambda done: self._distribute(done, batch))
+
+    @staticmethod
+    def _distribute(done, batch):
+        error = done.exception()
+        results = done.result() if error is None else [error] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+def _parse_color(text):
+    """Parse a hex RGB colour such as 'ff8800' or '#ff8800'."""
+    color = tuple(bytes.fromhex(text.lstrip('#')))
+    if len(color) != 3:
+        raise ValueError(f"background must be 3 hex bytes (RRGGBB), got '{text}'")
+    return color
+
+
+def _parse_options(query, default_max_side):
+    params = {name: values[-1] for name, values in parse_qs(query).items()}
+    try:
+        background = params.get('background')
+        target_bytes = int(params['target_bytes']) if 'target_bytes' in params else None
+        return {
+            'max_side': int(params['max_side']) if 'max_side' in params else default_max_side,
+            'output': OutputSpec(params.get('format', 'jpeg').upper(), int(params.get('quality', 95)),
+                                 target_bytes=target_bytes),
+            'background': _parse_color(background) if background else WHITE,
+            'color_key': params.get('color_key', '0') in ('1', 'true', 'yes'),
+            'tolerance': int(params.get('tolerance', 0)),
+        }
+    except ValueError as e:
+        raise HTTPError(400, f"Bad query parameter: {e}")
+
+
+class Service:
+    """
+    Asyncio HTTP/1.1 front end for background removal.
+
+    Endpoints (the image is the raw request body):
+    POST /classify           Corner check, JSON response
+    POST /remove-background  Cutout as PNG
+    POST /flatten            Cutout on a solid background as JPEG (or `format`)
+    GET  /health             Liveness and batch count
+
+    Query parameters: max_side, quality, background (hex RGB), color_key (0/1, default 0),
+    tolerance (classify only), format (jpeg/webp/png) and target_bytes (largest
+    response wanted; quality is searched down to fit, flatten only). Model work runs in a pool of processes with
+    warm sessions; classification runs on threads of this process.
+    """
+
+    def __init__(self, workers=1, threads=None, batch_size=4, max_wait=0.02, max_side=None,
+                 model_name=DEFAULT_MODEL):
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        self.workers = workers
+        self.max_side = max_side
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                            initargs=(model_name, threads, batch_size, max_side))
+        self.coalescer = Coalescer(self.executor, batch_size, max_wait)
+
+    async def warm_up(self):
+        """Start every worker process now, so the first requests don't pay for session creation."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, _warm) for _ in range(self.workers)))
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT):
+        await self.warm_up()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} ({self.workers} worker(s))")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    status, content_type, payload = await self.dispatch(method, target, body)
+                except HTTPError as e:
+                    status, content_type, payload = e.status, 'application/json', self._error_body(e)
+                except Image.UnidentifiedImageError as e:
+                    status, content_type, payload = 400, 'application/json', self._error_body(e)
+                except Exception as e:
+                    status, content_type, payload = 500, 'application/json', self._error_body(e)
+                await self._send(writer, status, content_type, payload, keep_alive)
+        except HTTPError as e:
+            # The request itself could not be read; answer and drop the connection
+            await self._send(writer, e.status, 'application/json', self._error_body(e), False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        """Return (status, content type, body bytes) for one request."""
+        url = urlsplit(target)
+        if url.path == '/health':
+            return 200, 'application/json', json.dumps(
+                {'status': 'ok', 'batches': self.coalescer.batches_sent}).encode()
+
+        operation = url.path.strip('/')
+        if operation not in ('classify', OP_REMOVE, OP_FLATTEN):
+            raise HTTPError(404)
+        if method != 'POST':
+            raise HTTPError(405)
+        if not body:
+            raise HTTPError(400, "Request body must be the image")
+
+        options = _parse_options(url.query, self.max_side)
+        if operation == 'classify':
+            result = await asyncio.to_thread(classify, body, options['tolerance'])
+            return 200, 'application/json', json.dumps(result).encode()
+
+        payload, content_type = await self.coalescer.submit(operation, body, options)
+        return 200, content_type, payload
+
+    @staticmethod
+    def _error_body(error):
+        return json.dumps({'error': str(error)}).encode()
+
+    @staticmethod
+    async def _read_request(reader):
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HTTPError(411)
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            raise HTTPError(400, "Bad Content-Length")
+        if length < 0:
+            raise HTTPError(400, "Bad Content-Length")
+        if length > MAX_BODY:
+            raise HTTPError(413)
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), target, headers, body
+
+    @staticmethod
+    async def _send(writer, status, content_type, payload, keep_alive):
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                f"Content-Type: {content_type}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        if len(payload) <= STREAM_CHUNK:
+            head.append(f"Content-Length: {len(payload)}")
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + payload)
+            await writer.drain()
+            return
+
+        # Large images are streamed in chunks so a slow client never holds a second copy
+        head.append("Transfer-Encoding: chunked")
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        view = memoryview(payload)
+        for start in range(0, len(view), STREAM_CHUNK):
+            chunk = view[start:start + STREAM_CHUNK]
+            writer.write(b'%x\r\n' % len(chunk))
+            writer.write(chunk)
+            writer.write(b'\r\n')
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve background removal over HTTP with warm model sessions.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, each with its own session")
+    parser.add_argument("--threads", type=int, help="onnxruntime threads per worker (default: cores / workers)")
+    parser.add_argument("--batch-size", type=int, default=4, help="Largest micro-batch of coalesced requests")
+    parser.add_argument("--max-wait", type=float, default=0.02,
+                        help="Seconds a request waits for others to batch with")
+    parser.add_argument("--max-side", type=int,
+                        help="Run the model on copies reduced to this longest side (see low_res)")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="rembg model name")
+    parser.add_argument(IMPORT_PROFILE_FLAG, action="store_true", help="Report start-up import cost and exit")
+    args = parser.parse_args()
+    if args.import_profile:
+        print_import_profile('service')
+        return
+
+    service = Service(args.workers, args.threads, args.batch_size, args.max_wait, args.max_side, args.model)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+from PIL import Image, ImageOps
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from compositing import cutout, flatten_image
+from batch_inference import BatchInferenceEngine
+from low_res import open_reduced, guided_upsample, low_res_mask
+from manifest import open_manifest, NullManifest, STATUS_DONE, STATUS_ERROR
+import os
+import io
+import itertools
+import logging
+from collections import deque
+from lazy_import import LazyModule
+from metrics import get_metrics, reset_metrics, stage_timer, log_event
+from encoder import encode_outputs, write_outputs, DEFAULT_OUTPUTS, DEFAULT_ENCODE_WORKERS
+from scheduler import MemoryBudget, job_cost, default_budget, pack_batches, run_scheduled, SESSION_BYTES
+
+rembg = LazyModule('rembg')  # Imported when the first session is created
+
+log = logging.getLogger('session_pool')
+log.addHandler(logging.NullHandler())  # Silent when imported as a library; entry points call setup_logging
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+DEFAULT_MODEL = 'u2net'
+
+# Session, batch engine, inference size, outputs and encode threads of the current worker process
+# (set by _init_worker)
+_worker_session = None
+_worker_engine = None
+_worker_max_side = None
+_worker_outputs = DEFAULT_OUTPUTS
+_worker_encoder = None
+_worker_backlog = None
+
+# Sessions shared by in-process callers, by model name (see get_session)
+_shared_sessions = {}
+
+
+def create_session(model_name=DEFAULT_MODEL, threads=None):
+    """Create a rembg session, optionally limiting onnxruntime to `threads` threads."""
+    # rembg reads OMP_NUM_THREADS when it builds the onnxruntime SessionOptions
+    previous = os.environ.get('OMP_NUM_THREADS')
+    if threads:
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+    try:
+        return rembg.new_session(model_name)
+    finally:
+        if threads:
+            if previous is None:
+                del os.environ['OMP_NUM_THREADS']
+            else:
+                os.environ['OMP_NUM_THREADS'] = previous
+
+
+def get_session(model_name=DEFAULT_MODEL):
+    """Return this process's shared session for `model_name`, creating it on first use."""
+    if model_name not in _shared_sessions:
+        _shared_sessions[model_name] = create_session(model_name)
+    return _shared_sessions[model_name]
+
+
+def _on_white(img, timings):
+    # Convert transparent pixels to white
+    with stage_timer(timings, 'composite'):
+        return flatten_image(img)
+
+
+def _save(flattened, output_path, timings, outputs=DEFAULT_OUTPUTS):
+    # Write every output format and size (see encoder)
+    write_outputs(encode_outputs(flattened, output_path, outputs, timings), timings)
+
+
+def render_file(session, input_path, max_side=None, timings=None):
+    """
+    Remove the background of one file with `session` and return the result
+    flattened onto white, ready for encoding (see _save and save_rendered). With
+    `max_side`, the model runs on a copy reduced to that size (see low_res).
+    Seconds spent per stage are added to the `timings` dict, if given.
+    """
+    timings = {} if timings is None else timings
+    if max_side:
+        with stage_timer(timings, 'decode'):
+            with Image.open(input_path) as img:
+                img = ImageOps.exif_transpose(img)
+                img.load()
+            small = open_reduced(input_path, max_side)
+        with stage_timer(timings, 'infer'):
+            mask = low_res_mask(img, lambda im: rembg.remove(im, session=session, only_mask=True),
+                                max_side, small)
+            img = cutout(img, mask)
+        return _on_white(img, timings)
+
+    with stage_timer(timings, 'decode'):
+        with open(input_path, 'rb') as input_file:
+            source_bytes = input_file.read()
+    with stage_timer(timings, 'infer'):  # rembg decodes, predicts and encodes a PNG in one call
+        image_data = rembg.remove(source_bytes, session=session)
+        with Image.open(io.BytesIO(image_data)) as img:
+            img.load()
+    return _on_white(img, timings)
+
+
+def process_file(session, input_path, output_path, max_side=None, timings=None, outputs=DEFAULT_OUTPUTS):
+    """
+    Remove the background of one file with `session` and save it on white as
+    `outputs` (one JPEG at `output_path` by default, see encoder.OutputSpec),
+    all on the calling thread. See render_file for the other arguments.
+    """
+    timings = {} if timings is None else timings
+    _save(render_file(session, input_path, max_side, timings), output_path, timings, outputs)
+
+
+def _run_job(session, job, max_side=None):
+    input_path, _ = job
+    timings = {}
+    try:
+        return input_path, None, timings, render_file(session, input_path, max_side, timings)
+    except Exception as e:
+        return input_path, str(e), timings, None
+
+
+def process_batch(engine, jobs, max_side=None):
+    """
+    Remove the backgrounds of (input_path, output_path) jobs with one batched
+    mask prediction and yield their (input_path, error, timings, image on
+    white) results, for save_rendered. Each image is cut out once its mask
+    is known, so its encoding can overlap with the next one's cutout.
+    """
+    prepared = []
+    for input_path, _ in jobs:
+        timings = {}
+        try:
+            with stage_timer(timings, 'decode'):
+                with Image.open(input_path) as img:
+                    # rembg predicts on the EXIF-rotated image
+                    img = ImageOps.exif_transpose(img)
+                    img.load()
+                small = open_reduced(input_path, max_side) if max_side else img
+            prepared.append((input_path, img, small, engine.submit(small), timings))
+        except Exception as e:
+            yield input_path, str(e), timings, None
+
+    for input_path, img, small, future, timings in prepared:
+        try:
+            with stage_timer(timings, 'infer'):  # Waiting for the shared batch, then upscaling
+                mask = future.result()
+                if small.size != img.size:
+                    mask = guided_upsample(mask, small, img)
+            # Same cutout rembg makes, then converted to white
+            flattened = _on_white(cutout(img, mask), timings)
+        except Exception as e:
+            yield input_path, str(e), timings, None
+        else:
+            yield input_path, None, timings, flattened
+
+
+def _save_job(flattened, output_path, timings, outputs):
+    try:
+        _save(flattened, output_path, timings, outputs)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def save_rendered(results, jobs, encoder, outputs=DEFAULT_OUTPUTS, backlog=2 * DEFAULT_ENCODE_WORKERS):
+    """
+    Encode and write the images of (input_path, error, timings, image on
+    white) results as `outputs` on the `encoder` thread pool, and yield
+    (input_path, error, timings) in the same order once each is saved. The
+    next images are rendered meanwhile; at most `backlog` rendered images
+    are held waiting for the encoder.
+    """
+    output_paths = dict(jobs)
+    saving = deque()
+    for input_path, error, timings, flattened in results:
+        future = None
+        if flattened is not None:
+            future = encoder.submit(_save_job, flattened, output_paths[input_path], timings, outputs)
+        saving.append((input_path, error, timings, future))
+        while saving and (saving[0][3] is None or saving[0][3].done() or len(saving) > backlog):
+            yield _saved(*saving.popleft())
+    while saving:
+        yield _saved(*saving.popleft())
+
+
+def _saved(input_path, error, timings, future):
+    return input_path, future.result() if future is not None else error, timings
+
+
+def _init_worker(model_name, threads, batch_size=1, max_side=None, outputs=DEFAULT_OUTPUTS,
+                 encode_workers=DEFAULT_ENCODE_WORKERS):
+    """Create the worker's session once; it is reused for every file the worker takes."""
+    global _worker_session, _worker_engine, _worker_max_side, _worker_outputs, _worker_encoder, _worker_backlog
+    _worker_session = create_session(model_name, threads)
+    _worker_max_side = max_side
+    _worker_outputs = outputs
+    if batch_size > 1:
+        _worker_engine = BatchInferenceEngine(_worker_session.inner_session, batch_size)
+        # Encodes a batch's images while the rest of it is cut out; lives as long as the worker
+        _worker_encoder = ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix='encode')
+        _worker_backlog = 2 * encode_workers
+
+
+def _worker_job(job):
+    # Saved here, so only the status and timings go back to the parent
+    input_path, error, timings, flattened = _run_job(_worker_session, job, _worker_max_side)
+    if flattened is not None:
+        error = _save_job(flattened, job[1], timings, _worker_outputs)
+    return input_path, error, timings
+
+
+def _worker_batch(jobs):
+    return list(save_rendered(process_batch(_worker_engine, jobs, _worker_max_side), jobs, _worker_encoder,
+                              _worker_outputs, _worker_backlog))
+
+
+def collect_jobs(input_folder, output_folder):
+    """Return (input_path, output_path) pairs for every image in `input_folder`."""
+    jobs = []
+    for file_name in os.listdir(input_folder):
+        if file_name.lower().endswith(IMAGE_EXTENSIONS):
+            jobs.append((os.path.join(input_folder, file_name),
+                         os.path.join(output_folder, file_name)))
+    return jobs
+
+
+def report_results(results, jobs, manifest=None, outputs=DEFAULT_OUTPUTS):
+    manifest = manifest or NullManifest()
+    metrics = get_metrics()
+    output_paths = {input_path: outputs[0].path_for(output_path) for input_path, output_path in jobs}
+    for input_path, error, timings in results:
+        # Stage timings come back with each result, so work done in worker processes is counted too
+        metrics.observe_all(timings)
+        file_name = os.path.basename(input_path)
+        if error is None:
+            metrics.inc('images_processed')
+            log_event(log, "processed", file=file_name)
+            manifest.record(input_path, STATUS_DONE, output_path=output_paths[input_path])
+        else:
+            metrics.inc('errors')
+            log_event(log, "processing failed", logging.ERROR, file=file_name, error=error)
+            manifest.record(input_path, STATUS_ERROR)
+
+
+def remove_background(input_folder, output_folder, workers=1, threads=None, model_name=DEFAULT_MODEL,
+                      manifest_path=None, batch_size=1, max_side=None, metrics_path=None, memory_budget=None,
+                      outputs=DEFAULT_OUTPUTS, encode_workers=DEFAULT_ENCODE_WORKERS):
+    """
+    Remove the background of every image in `input_folder` and save it on white.
+
+    Parameters:
+    input_folder (str): Folder with the source images
+    output_folder (str): Folder where the processed images are written
+    workers (int): Number of worker processes; 1 runs in this process, None uses every core
+    threads (int): onnxruntime intra-op threads per session; by default the cores
+        are split evenly between the workers
+    model_name (str): rembg model used by every session
+    manifest_path (str): SQLite manifest; files finished in an earlier run and
+        unchanged since are skipped
+    batch_size (int): Images per model call (see batch_inference); 1 uses rembg.remove
+    max_side (int): Run the model on copies reduced to this longest side and
+        upscale the masks (see low_res); None uses the full-size images
+    metrics_path (str): Write stage timings and counters here while running
+        (JSON, or Prometheus text for *.prom)
+    memory_budget (int): Bytes the images being processed at once may take
+        together (see scheduler); by default most of the available memory,
+        less the workers' sessions
+    outputs (tuple): encoder.OutputSpec of every file written per image, e.g.
+        encoder.WEB_OUTPUTS for JPEG plus WebP listing and thumbnail sizes
+    encode_workers (int): Threads that encode and write the outputs while the next
+        images are rendered, in this process or in each batch worker
+    """
+    # Ensure the output folder exists
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    metrics = reset_metrics()
+    if metrics_path:
+        metrics.start_export(metrics_path)
+    with open_manifest(manifest_path) as manifest:
+        all_jobs = collect_jobs(input_folder, output_folder)
+        jobs = [job for job in all_jobs if not manifest.is_unchanged(job[0])]
+        metrics.inc('images_skipped', len(all_jobs) - len(jobs))
+        run_jobs(jobs, workers, threads, model_name, manifest, batch_size, max_side, memory_budget, outputs,
+                 encode_workers)
+    metrics.stop_export()
+    print(metrics.summary())
+
+
+def run_jobs(jobs, workers=1, threads=None, model_name=DEFAULT_MODEL, manifest=None, batch_size=1, max_side=None,
+             memory_budget=None, outputs=DEFAULT_OUTPUTS, encode_workers=DEFAULT_ENCODE_WORKERS):
+    """
+    Process (input_path, output_path) jobs in this process or in a pool of `workers`.
+
+    Each image is encoded and written by the process that rendered it, so
+    only its status and timings cross to this process. In this process and
+    in batch workers, `encode_workers` threads encode the rendered images
+    (see save_rendered) while the next ones are rendered; a single-image
+    worker encodes its image itself before taking the next.
+
+    Each image's peak memory is estimated from its header, and pool jobs
+    only start while the running ones fit in `memory_budget` (see
+    scheduler.run_scheduled): thumbnails run on every worker at once, while
+    an image too big for the budget runs alone. Batches are made of images
+    of similar size and kept within the budget too.
+    """
+    if not jobs:
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs) or 1))
+    concurrent = workers > 1 or batch_size > 1  # One image at a time needs no admission control
+    if memory_budget is None and concurrent:
+        memory_budget = default_budget(workers * SESSION_BYTES)
+
+    costs = {}
+    if memory_budget is not None and concurrent:
+        costs = {job: job_cost(job[0]) for job in jobs}  # Header reads only
+    if costs:
+        chunks = pack_batches(jobs, costs, batch_size, memory_budget)
+    else:
+        chunks = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+
+    if workers == 1:
+        session = create_session(model_name, threads)
+        with ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix='encode') as encoder:
+            if batch_size > 1:
+                with BatchInferenceEngine(session.inner_session, batch_size) as engine:
+                    results = itertools.chain.from_iterable(process_batch(engine, chunk, max_side)
+                                                            for chunk in chunks)
+                    report_results(save_rendered(results, jobs, encoder, outputs, 2 * encode_workers),
+                                   jobs, manifest, outputs)
+            else:
+                results = (_run_job(session, job, max_side) for job in jobs)
+                report_results(save_rendered(results, jobs, encoder, outputs, 2 * encode_workers),
+                               jobs, manifest, outputs)
+        return
+
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    budget = MemoryBudget(memory_budget, max_jobs=workers)
+    get_metrics().gauge('memory', budget.usage)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_name, threads, batch_size, max_side, outputs,
+                                       encode_workers)) as executor:
+        # Jobs (or batches of jobs) are handed to the workers as the memory budget admits them
+        if batch_size > 1:
+            results = itertools.chain.from_iterable(
+                run_scheduled(executor, _worker_batch, chunks, budget,
+                              lambda chunk: sum(costs.get(job, 0) for job in chunk)))
+        else:
+            results = run_scheduled(executor, _worker_job, jobs, budget, lambda job: costs.get(job, 0))
+        report_results(results, jobs, manifest, outputs)
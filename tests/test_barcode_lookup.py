@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+import abcd
+import barcode_lookup
+from barcode_lookup import BarcodeCache, lookup_barcodes
+
+
+@pytest.fixture
+def connection():
+    """SQLite stand-in for the catalog database, with the tables the lookup query joins."""
+    conn = sqlite3.connect(':memory:')
+    conn.execute("ATTACH DATABASE ':memory:' AS catalog")
+    conn.execute("CREATE TABLE catalog.ProductSKUMaps (ProductSKUMapIID INTEGER PRIMARY KEY, BarCode TEXT)")
+    conn.execute("CREATE TABLE catalog.ProductImageMaps "
+                 "(ProductSKUMapID INTEGER, ImageFile TEXT, ProductImageTypeID INTEGER)")
+    yield conn
+    conn.close()
+
+
+def add_image(conn, sku_id, barcode, image_file, image_type=8):
+    conn.execute("INSERT OR IGNORE INTO catalog.ProductSKUMaps VALUES (?, ?)", (sku_id, barcode))
+    conn.execute("INSERT INTO catalog.ProductImageMaps VALUES (?, ?, ?)", (sku_id, image_file, image_type))
+
+
+def count_queries(conn):
+    queries = []
+    conn.set_trace_callback(lambda sql: queries.append(sql) if 'SELECT' in sql else None)
+    return queries
+
+
+def test_lookup_is_chunked(connection):
+    for number in range(7):
+        add_image(connection, number, f"BC{number}", f"{100 + number}/ListingImage/0.jpg")
+    queries = count_queries(connection)
+
+    result = lookup_barcodes(connection, [str(100 + number) for number in range(7)], chunk_size=3)
+
+    assert result == {str(100 + number): f"BC{number}" for number in range(7)}
+    assert len(queries) == 3
+
+
+def test_lookup_matches_folder_prefixes_only(connection):
+    add_image(connection, 1, "EXACT", "100")
+    add_image(connection, 2, "SLASH", "200/ListingImage/0.jpg")
+    add_image(connection, 3, "BACKSLASH", "300\\ListingImage\\0.jpg")
+    add_image(connection, 4, "LONGER", "1000/ListingImage/0.jpg")  # Shares the '100' prefix without a separator
+    add_image(connection, 5, "WILDCARD", "4X0/0.jpg")  # Would match '4_0' if '_' were not escaped
+    add_image(connection, 6, "OTHER_TYPE", "500/0.jpg", image_type=3)
+
+    result = lookup_barcodes(connection, ["100", "200", "300", "4_0", "500"])
+
+    assert result == {"100": "EXACT", "200": "SLASH", "300": "BACKSLASH"}
+
+
+def test_cache_entries_expire(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(barcode_lookup.time, 'time', lambda: now[0])
+    cache = BarcodeCache(str(tmp_path / 'barcodes.sqlite'), max_age=100, negative_max_age=10)
+    try:
+        cache.store(["100", "200"], {"100": "BC100"})
+
+        assert cache.lookup(["100", "200", "300"]) == ({"100": "BC100", "200": None}, ["300"])
+
+        # "No barcode" answers expire sooner than found barcodes
+        now[0] += 50
+        known, missing = cache.lookup(["100", "200"])
+        assert known == {"100": "BC100"}
+        assert missing == ["200"]
+
+        now[0] += 100
+        known, missing = cache.lookup(["100", "200"])
+        assert known == {}
+        assert sorted(missing) == ["100", "200"]
+    finally:
+        cache.close()
+
+
+def test_cached_negative_answers_skip_the_database(tmp_path, connection):
+    add_image(connection, 1, "BC100", "100/0.jpg")
+    cache = BarcodeCache(str(tmp_path / 'barcodes.sqlite'))
+    try:
+        queries = count_queries(connection)
+        first = abcd.fetch_matching_barcodes(["100", "999"], connection, cache)
+        second = abcd.fetch_matching_barcodes(["100", "999"], connection, cache)
+
+        assert first == second == [("100", "BC100")]
+        assert len(queries) == 1
+    finally:
+        cache.close()
@@ -0,0 +1,106 @@
+import pytest
+
+import benchmark
+from batch_inference import BatchInferenceEngine
+
+
+class RecordingSession(benchmark.FakeInnerSession):
+    """FakeInnerSession with a configurable batch dimension that records each run's batch size."""
+
+    def __init__(self, batch_dim='batch', fail=False):
+        self.batch_dim = batch_dim
+        self.fail = fail
+        self.batch_sizes = []
+
+    def get_inputs(self):
+        model_input = self._Input()
+        model_input.shape = [self.batch_dim, 3, 320, 320]
+        return [model_input]
+
+    def run(self, output_names, feed):
+        inputs = next(iter(feed.values()))
+        if isinstance(self.batch_dim, int):
+            assert len(inputs) == self.batch_dim
+        self.batch_sizes.append(len(inputs))
+        if self.fail:
+            raise RuntimeError("model failed")
+        return super().run(output_names, feed)
+
+
+def images(count):
+    return [benchmark._product_image((64 + n, 48), True, seed=n) for n in range(count)]
+
+
+def predict_in_one_batch(engine, batch):
+    # A long max_wait keeps every image in one batch; the batch fills and runs at once
+    return engine.predict(batch)
+
+
+def test_dynamic_batch_runs_once_per_batch():
+    session = RecordingSession()
+    batch = images(4)
+    with BatchInferenceEngine(session, batch_size=4, max_wait=5) as engine:
+        masks = predict_in_one_batch(engine, batch)
+
+    assert session.batch_sizes == [4]
+    assert engine.batches_run == 1
+    assert [mask.size for mask in masks] == [img.size for img in batch]
+    assert all(mask.mode == 'L' for mask in masks)
+    # Foreground in the middle of the product, background in the corner
+    assert all(mask.getpixel((img.width // 2, img.height // 2)) > 200 for mask, img in zip(masks, batch))
+    assert all(mask.getpixel((0, 0)) < 50 for mask in masks)
+
+
+@pytest.mark.parametrize('batch_dim, count, expected', [(1, 3, [1, 1, 1]), (2, 3, [2, 2])])
+def test_fixed_batch_runs_in_chunks(batch_dim, count, expected):
+    session = RecordingSession(batch_dim)
+    batch = images(count)
+    with BatchInferenceEngine(session, batch_size=count, max_wait=5) as engine:
+        masks = predict_in_one_batch(engine, batch)
+
+    assert session.batch_sizes == expected
+    assert engine.fixed_batch == batch_dim
+    assert [mask.size for mask in masks] == [img.size for img in batch]
+
+    # Same masks as a model with a dynamic batch axis
+    with BatchInferenceEngine(RecordingSession(), batch_size=count, max_wait=5) as engine:
+        dynamic = predict_in_one_batch(engine, batch)
+    assert [mask.tobytes() for mask in masks] == [mask.tobytes() for mask in dynamic]
+
+
+def test_errors_fail_the_whole_batch_and_the_engine_keeps_running():
+    session = RecordingSession(fail=True)
+    with BatchInferenceEngine(session, batch_size=2, max_wait=5) as engine:
+        futures = [engine.submit(img) for img in images(2)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="model failed"):
+                future.result(timeout=10)
+
+        session.fail = False
+        masks = engine.predict(images(2))
+
+    assert [mask.mode for mask in masks] == ['L', 'L']
+    assert engine.batches_run == 1
+
+
+def test_session_factory_is_called_on_first_batch():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return RecordingSession()
+
+    with BatchInferenceEngine(factory, batch_size=1) as engine:
+        assert calls == []
+        engine.predict(images(1))
+
+    assert calls == [1]
+
+
+def test_partial_batch_runs_after_max_wait():
+    session = RecordingSession()
+    with BatchInferenceEngine(session, batch_size=8, max_wait=0.01) as engine:
+        mask = engine.submit(images(1)[0]).result(timeout=10)
+
+    assert mask.size == (64, 48)
+    assert session.batch_sizes == [1]
@@ -0,0 +1,42 @@
+from PIL import Image, ImageDraw
+
+import benchmark
+import www
+from color_key import PATH_COLOR_KEY, PATH_MODEL, color_key_mask
+
+
+def dark_object_touching_border(size=(200, 200)):
+    """A near-black bag whose body runs off the left edge, with a light label in it."""
+    img = Image.new('RGB', size, (0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    draw.rectangle((0, height // 5, 4 * width // 5, 4 * height // 5), fill=(18, 16, 20))
+    draw.rectangle((width // 2, 2 * height // 5, 3 * width // 5, 3 * height // 5), fill=(230, 230, 230))
+    return img
+
+
+def test_product_on_black_is_keyed():
+    mask, confidence = color_key_mask(benchmark._product_image((200, 200), True, seed=1))
+
+    assert mask is not None
+    assert confidence >= 0.98
+    assert mask.getpixel((100, 100)) == 255
+    assert mask.getpixel((2, 2)) == 0
+
+
+def test_dark_object_touching_border_is_rejected():
+    mask, _ = color_key_mask(dark_object_touching_border())
+
+    assert mask is None
+
+
+def test_color_key_is_opt_in():
+    img = benchmark._product_image((200, 200), True, seed=1)
+    with benchmark.fake_remover():
+        _, default_path = www.get_mask(img, None)
+        _, keyed_path = www.get_mask(img, None, use_color_key=True)
+        _, rejected_path = www.get_mask(dark_object_touching_border(), None, use_color_key=True)
+
+    assert default_path == PATH_MODEL
+    assert keyed_path == PATH_COLOR_KEY
+    assert rejected_path == PATH_MODEL
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from compositing import Compositor, cutout, flatten_image, linear_gradient, paste_flatten
+
+BACKGROUNDS = [(255, 255, 255), (30, 140, 220)]
+
+
+def paste_onto(img, background):
+    # The baseline: a new canvas with the image pasted through its own alpha
+    canvas = Image.new('RGB', img.size, background)
+    canvas.paste(img, (0, 0), img)
+    return np.asarray(canvas)
+
+
+def edge_pixels():
+    # Fully opaque, fully transparent and half-alpha edge pixels, in straight alpha
+    return np.array([[[200, 100, 50, 255], [200, 100, 50, 0], [200, 100, 50, 128], [255, 255, 255, 127]],
+                     [[0, 0, 0, 255], [17, 34, 51, 0], [0, 0, 0, 128], [90, 180, 240, 1]]], np.uint8)
+
+
+def random_rgba(seed, shape=(37, 53, 4)):
+    return np.random.default_rng(seed).integers(0, 256, shape, np.uint8)
+
+
+@pytest.mark.parametrize('background', BACKGROUNDS)
+def test_straight_alpha_matches_paste(background):
+    compositor = Compositor(background, premultiplied=False)
+    for rgba in (edge_pixels(), random_rgba(0)):
+        img = Image.fromarray(rgba, 'RGBA')
+        expected = paste_onto(img, background)
+
+        assert np.array_equal(compositor.flatten(rgba), expected)
+        assert np.array_equal(np.asarray(compositor.flatten_image(img)), expected)
+
+
+def test_straight_alpha_edge_values():
+    out = Compositor(premultiplied=False).flatten(edge_pixels())
+
+    assert out[0, 0].tolist() == [200, 100, 50]  # Opaque: the pixel itself
+    assert out[0, 1].tolist() == [255, 255, 255]  # Transparent: the background
+    # Half alpha: DIV255(200 * 128 + 255 * 127) and so on, as paste rounds
+    assert out[0, 2].tolist() == [227, 177, 152]
+    assert np.array_equal(out, np.asarray(paste_flatten(Image.fromarray(edge_pixels(), 'RGBA'))))
+
+
+@pytest.mark.parametrize('background', BACKGROUNDS)
+def test_premultiplied_matches_paste_of_the_straight_image(background):
+    compositor = Compositor(background, premultiplied=True)
+    for rgba in (edge_pixels(), random_rgba(1)):
+        straight = Image.fromarray(rgba, 'RGBA')
+        premultiplied = cutout(straight.convert('RGB'), straight.getchannel('A'))
+        expected = paste_onto(straight, background).astype(np.int16)
+
+        for out in (compositor.flatten(np.asarray(premultiplied)),
+                    np.asarray(compositor.flatten_image(premultiplied))):
+            # Rounded once when premultiplying and once when blending
+            assert np.abs(out.astype(np.int16) - expected).max() <= 1
+
+
+def test_premultiplied_edge_values():
+    straight = Image.fromarray(edge_pixels(), 'RGBA')
+    premultiplied = cutout(straight.convert('RGB'), straight.getchannel('A'))
+    out = np.asarray(flatten_image(premultiplied))
+
+    assert out[0, 0].tolist() == [200, 100, 50]
+    assert out[0, 1].tolist() == [255, 255, 255]
+    assert out[0, 2].tolist() == [227, 177, 152]
+    # Pasting the premultiplied cutout as if it were straight darkens the edge: the old fringe
+    assert np.asarray(paste_flatten(premultiplied))[0, 2].tolist() == [177, 152, 140]
+
+
+@pytest.mark.parametrize('premultiplied', [False, True])
+def test_image_backgrounds_and_batches_match_the_solid_path(premultiplied):
+    rgba = random_rgba(2)
+    height, width = rgba.shape[:2]
+    gradient = linear_gradient(height, width, (255, 255, 255), (30, 140, 220))
+    by_array = Compositor(gradient, premultiplied).flatten(rgba)
+    by_callable = Compositor(lambda h, w: gradient, premultiplied).flatten(rgba)
+    by_image = Compositor(gradient, premultiplied).flatten_image(Image.fromarray(rgba, 'RGBA'))
+
+    assert np.array_equal(by_array, by_callable)
+    assert np.array_equal(by_array, np.asarray(by_image))
+    # Each row of the gradient is a solid colour
+    row = Compositor(tuple(gradient[5, 0].tolist()), premultiplied).flatten(rgba)
+    assert np.array_equal(by_array[5], row[5])
+
+    compositor = Compositor(premultiplied=premultiplied)
+    batch = np.stack([random_rgba(seed) for seed in range(3)])
+    out = np.empty(batch.shape[:-1] + (3,), np.uint8)
+    assert compositor.flatten(batch, out) is out
+    for index in range(3):
+        assert np.array_equal(out[index], compositor.flatten(batch[index]))
+
+
+def test_rejects_other_arrays():
+    with pytest.raises(ValueError):
+        Compositor().flatten(np.zeros((4, 4, 3), np.uint8))
+    with pytest.raises(ValueError):
+        Compositor().flatten(np.zeros((4, 4, 4), np.uint16))
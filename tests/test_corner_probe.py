@@ -0,0 +1,141 @@
+import io
+import struct
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from corner_probe import png_corners, has_black_corner, corner_colors, all_corners_below
+
+
+def full_corners(path):
+    # What the scripts did before corner_probe: convert the whole image and read the corners
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        width, height = img.size
+        return [img.getpixel(xy) for xy in ((0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1))]
+
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+
+def write_png(path, pixels, colour_type, filters, palette=None):
+    """Write `pixels` (height x width x samples uint8) with the given filter type per scanline."""
+    height, width, bpp = pixels.shape
+    above = np.zeros(width * bpp, np.int32)
+    raw = bytearray()
+    for row, filter_type in zip(pixels.reshape(height, -1).astype(np.int32), filters):
+        left = np.concatenate([np.zeros(bpp, np.int32), row[:-bpp]])
+        upper_left = np.concatenate([np.zeros(bpp, np.int32), above[:-bpp]])
+        predicted = [0, left, above, (left + above) // 2, _paeth(left, above, upper_left)][filter_type]
+        raw.append(filter_type)
+        raw += ((row - predicted) & 0xFF).astype(np.uint8).tobytes()
+        above = row
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    with open(path, 'wb') as fp:
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        fp.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, colour_type, 0, 0, 0)))
+        if palette is not None:
+            fp.write(chunk(b'PLTE', palette))
+        fp.write(chunk(b'IDAT', zlib.compress(bytes(raw))))
+        fp.write(chunk(b'IEND', b''))
+    return str(path)
+
+
+def random_pixels(seed, size=(23, 17), samples=3):
+    return np.random.default_rng(seed).integers(0, 256, (size[1], size[0], samples), np.uint8)
+
+
+@pytest.mark.parametrize('colour_type, samples', [(0, 1), (2, 3), (4, 2), (6, 4)])
+@pytest.mark.parametrize('filters', [(0,), (1,), (2,), (3,), (4,), (1, 2, 0, 2, 1)])
+def test_png_corners_match_a_full_decode(tmp_path, colour_type, samples, filters):
+    pixels = random_pixels(len(filters) * 10 + colour_type, samples=samples)
+    # The first scanline takes any filter; the ones below cycle through `filters`
+    path = write_png(tmp_path / 'a.png', pixels, colour_type, [filters[0]] + [filters[i % len(filters)]
+                                                                              for i in range(1, len(pixels))])
+    expected = full_corners(path)
+
+    pairs = list(png_corners(path))
+
+    assert pairs[0] == expected[:2]
+    if filters[-1] in (3, 4) and len(filters) == 1:
+        assert pairs[1:] == [None]  # Average / Paeth rows below the first need a full decode
+    else:
+        assert pairs[1:] == [expected[2:]]
+
+
+def test_png_corners_of_palette_images(tmp_path):
+    palette = bytes(np.random.default_rng(0).integers(0, 256, 256 * 3, np.uint8))
+    path = write_png(tmp_path / 'p.png', random_pixels(1, samples=1), 3, [1, 2, 0] * 6, palette)
+
+    assert [color for pair in png_corners(path) for color in pair] == full_corners(path)
+
+
+def test_png_corners_of_pil_written_files(tmp_path):
+    for seed, mode in enumerate(('RGB', 'RGBA', 'L', 'LA', 'P')):
+        img = Image.fromarray(random_pixels(seed, (300, 40))).convert(mode)
+        path = str(tmp_path / f'{mode}.png')
+        img.save(path)
+        pairs = list(png_corners(path))
+        assert pairs[0] == full_corners(path)[:2]
+        assert pairs[-1] is None or pairs[-1] == full_corners(path)[2:]
+
+
+def test_png_corners_reject_other_files(tmp_path):
+    jpeg = str(tmp_path / 'a.jpg')
+    Image.new('RGB', (8, 8)).save(jpeg)
+    interlaced = write_png(tmp_path / 'i.png', random_pixels(0, (8, 8)), 2, [0] * 8)
+    with open(interlaced, 'r+b') as fp:
+        fp.seek(28)  # IHDR interlace method; the reader stops before checking the CRC
+        fp.write(b'\x01')
+    sixteen_bit = str(tmp_path / 's.png')
+    Image.new('I;16', (8, 8)).save(sixteen_bit)
+
+    for path in (jpeg, interlaced, sixteen_bit):
+        assert list(png_corners(path)) == [None]
+
+
+def framed(size, frame, background=(255, 255, 255)):
+    img = Image.new('RGB', size, (0, 0, 0))
+    img.paste(background, (frame, frame, size[0] - frame, size[1] - frame))
+    return img
+
+
+def noisy_black(size, seed):
+    return Image.fromarray(np.random.default_rng(seed).integers(0, 24, (size[1], size[0], 3), np.uint8))
+
+
+JPEG_CASES = ([framed((157, 101), frame) for frame in (0, 1, 2, 3)]
+              + [noisy_black((157, 101), seed) for seed in range(6)]
+              + [Image.new('RGB', (64, 48), (0, 0, 0)), Image.new('RGB', (1, 1), (250, 250, 250))])
+
+
+@pytest.mark.parametrize('index', range(len(JPEG_CASES)))
+def test_has_black_corner_matches_a_full_decode(tmp_path, index):
+    img = JPEG_CASES[index]
+    for suffix, options in (('.jpg', {'quality': 90}), ('.png', {})):
+        path = str(tmp_path / f'{index}{suffix}')
+        img.save(path, **options)
+        expected = full_corners(path)
+
+        assert corner_colors(path) == expected
+        assert has_black_corner(path) == ((0, 0, 0) in expected)
+        assert all_corners_below(path, 30) == all(max(color) < 30 for color in expected)
+
+
+def test_tolerance_opts_into_reduced_jpegs(tmp_path):
+    path = str(tmp_path / 'frame.jpg')
+    framed((160, 96), 1).save(path, quality=90)
+
+    assert has_black_corner(path)  # Exact: the 1 px frame is black
+    # At 1/8 scale each corner is the average of an 8x8 block, mostly white
+    assert min(max(color) for color in corner_colors(path, tolerance=10)) > 10
+    with open(path, 'rb') as f:
+        assert corner_colors(io.BytesIO(f.read())) == full_corners(path)
@@ -0,0 +1,107 @@
+import io
+
+import pytest
+from PIL import Image
+
+import benchmark
+from dedup import Deduplicator, perceptual_hash
+from mask_cache import content_hash
+
+
+def save(path, img, **options):
+    img.save(path, **options)
+    return str(path)
+
+
+@pytest.fixture
+def photo():
+    return benchmark._product_image((320, 240), True, seed=3)
+
+
+def collect(calls):
+    return lambda path, destination, result: calls.append((path, destination, result))
+
+
+def test_exact_copies_share_one_leader(tmp_path, photo):
+    first = save(tmp_path / 'a.jpg', photo, quality=90)
+    with open(first, 'rb') as f:
+        (tmp_path / 'b.jpg').write_bytes(f.read())
+    other = save(tmp_path / 'c.jpg', benchmark._product_image((320, 240), True, seed=4), quality=90)
+    calls = []
+    dedup = Deduplicator()
+
+    assert dedup.claim(first, 'out/a', collect(calls))
+    assert not dedup.claim(str(tmp_path / 'b.jpg'), 'out/b', collect(calls))
+    assert dedup.claim(other, 'out/c', collect(calls))
+    assert calls == []  # Waiting for the leader
+
+    dedup.finish(first, 'result a')
+    dedup.finish(other, 'result c')
+
+    assert calls == [(str(tmp_path / 'b.jpg'), 'out/b', 'result a')]
+    assert (dedup.claimed, dedup.duplicates, dedup.groups) == (3, 1, 1)
+
+
+def test_duplicate_after_the_leader_finished_is_answered_right_away(tmp_path, photo):
+    first = save(tmp_path / 'a.png', photo)
+    second = save(tmp_path / 'b.png', photo)
+    calls = []
+    dedup = Deduplicator()
+
+    assert dedup.claim(first, 'out/a', collect(calls))
+    dedup.finish(first, None)  # The leader failed
+    assert not dedup.claim(second, 'out/b', collect(calls))
+
+    assert calls == [(second, 'out/b', None)]
+
+
+def test_near_duplicates_are_grouped_only_when_perceptual(tmp_path, photo):
+    original = save(tmp_path / 'a.jpg', photo, quality=95)
+    resaved = save(tmp_path / 'b.jpg', photo.resize((640, 480)), quality=70)
+    recoloured = save(tmp_path / 'c.jpg', Image.eval(photo, lambda v: min(255, v + 40)), quality=95)
+    cropped = save(tmp_path / 'd.jpg', photo.crop((0, 0, 320, 200)), quality=95)
+
+    exact = Deduplicator()
+    assert all(exact.claim(path, path, collect([])) for path in (original, resaved))
+
+    calls = []
+    near = Deduplicator(perceptual=True)
+    assert near.claim(original, original, collect(calls))
+    assert not near.claim(resaved, resaved, collect(calls))
+    assert near.claim(recoloured, recoloured, collect(calls))  # Another colourway
+    assert near.claim(cropped, cropped, collect(calls))  # Another shape
+    near.finish(original, 'leader')
+
+    assert calls == [(resaved, resaved, 'leader')]
+
+
+def test_claim_uses_the_given_hash_and_bytes(tmp_path, photo, monkeypatch):
+    path = save(tmp_path / 'a.jpg', photo)
+    with open(path, 'rb') as f:
+        data = f.read()
+    monkeypatch.setattr('dedup.file_hash', lambda path: pytest.fail("file hashed again"))
+    opened = []
+    real_open = Image.open
+    monkeypatch.setattr(Image, 'open', lambda fp, *args: opened.append(fp) or real_open(fp, *args))
+
+    dedup = Deduplicator(perceptual=True)
+    assert dedup.claim(path, path, collect([]), content_hash(data), data)
+
+    assert opened and not any(isinstance(fp, str) for fp in opened)
+
+
+def test_aspect_ratio_comes_from_the_full_size(tmp_path):
+    # Draft mode would decode this at 1/8 scale as 126 x 42, an aspect ratio of 3.0
+    path = save(tmp_path / 'wide.jpg', Image.new('RGB', (1001, 333), (90, 120, 200)))
+
+    assert perceptual_hash(path)[2] == pytest.approx(1001 / 333)
+
+
+def test_aspect_ratio_follows_exif_rotation(tmp_path):
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees
+    path = save(tmp_path / 'rotated.jpg', Image.new('RGB', (1001, 333), (90, 120, 200)), exif=exif)
+
+    assert perceptual_hash(path)[2] == pytest.approx(333 / 1001)
+    with open(path, 'rb') as f:
+        assert perceptual_hash(io.BytesIO(f.read())) == perceptual_hash(path)
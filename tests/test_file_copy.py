@@ -0,0 +1,70 @@
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+import file_copy
+from file_copy import COPY_FILE, COPY_HARDLINK, COPY_REENCODE, Copier, copy_file
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+@pytest.mark.parametrize('strategy', [COPY_FILE, COPY_HARDLINK])
+def test_copy_replaces_existing_destination(tmp_path, strategy):
+    src = write(tmp_path / 'src.jpg', b'new')
+    dst = write(tmp_path / 'dst.jpg', b'old')
+
+    copy_file(src, dst, strategy)
+
+    with open(dst, 'rb') as f:
+        assert f.read() == b'new'
+    assert sorted(os.listdir(tmp_path)) == ['dst.jpg', 'src.jpg']
+
+
+def test_reencode_keeps_the_destination_format(tmp_path):
+    src = str(tmp_path / 'src.png')
+    Image.new('RGB', (8, 8), (200, 10, 10)).save(src)
+    dst = str(tmp_path / 'dst.jpg')
+
+    copy_file(src, dst, COPY_REENCODE)
+
+    with Image.open(dst) as img:
+        assert img.format == 'JPEG'
+
+
+@pytest.mark.parametrize('strategy', [COPY_FILE, COPY_HARDLINK])
+def test_copies_to_one_destination_do_not_overlap(tmp_path, monkeypatch, strategy):
+    # Several product folders' 0.jpg are flattened into one output folder
+    sources = [write(tmp_path / f'{n}.src', bytes([n]) * 4096) for n in range(8)]
+    dst = str(tmp_path / '0.jpg')
+    active, overlaps = [0], []
+    lock = threading.Lock()
+    real_copy_to = file_copy._copy_to
+
+    def tracked_copy_to(*args):
+        with lock:
+            active[0] += 1
+            overlaps.append(active[0])
+        try:
+            real_copy_to(*args)
+        finally:
+            with lock:
+                active[0] -= 1
+
+    monkeypatch.setattr(file_copy, '_copy_to', tracked_copy_to)
+    errors = []
+    with Copier(strategy, workers=8) as copier:
+        for src in sources:
+            copier.submit(src, dst, lambda src, dst, error: errors.append(error))
+
+    assert errors == [None] * len(sources)
+    assert max(overlaps) == 1
+    with open(dst, 'rb') as f:
+        data = f.read()
+    assert len(data) == 4096 and len(set(data)) == 1
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
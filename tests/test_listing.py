@@ -0,0 +1,48 @@
+import os
+
+from PIL import Image
+
+import listing
+from scanner import LISTING_DEPTH
+
+
+def _image(path, color):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', (16, 16), color).save(path)
+
+
+def _names(output_folder):
+    with open(os.path.join(output_folder, 'black_corner_images.txt')) as f:
+        return f.read().splitlines()
+
+
+def test_listing_folders_are_found_at_any_depth(tmp_path):
+    # The input folder one level above <root>/<product>/ListingImage
+    root = str(tmp_path / 'catalog')
+    _image(os.path.join(root, 'shoes', '100001', 'ListingImage', 'a.png'), (0, 0, 0))
+    _image(os.path.join(root, 'shoes', '100001', 'ListingImage', 'b.png'), (255, 255, 255))
+    output_folder = str(tmp_path / 'out')
+
+    listing.process_images(root, output_folder)
+    assert _names(output_folder) == ['a']
+    assert os.listdir(output_folder).count('a.png') == 1
+
+    limited = str(tmp_path / 'limited')
+    listing.process_images(root, limited, scan_depth=LISTING_DEPTH)
+    assert _names(limited) == []
+
+
+def test_names_are_written_sorted(tmp_path, monkeypatch):
+    root = str(tmp_path / 'catalog')
+    for number in range(12):
+        _image(os.path.join(root, f'{100000 + number}', 'ListingImage', f'{(number * 7) % 12:02}.png'), (0, 0, 0))
+    output_folder = str(tmp_path / 'out')
+    manifest_path = str(tmp_path / 'manifest.sqlite')
+
+    listing.process_images(root, output_folder, manifest_path)
+    expected = [f'{number:02}' for number in range(12)]
+    assert _names(output_folder) == expected
+
+    # A re-run lists the images finished earlier without copying them again
+    listing.process_images(root, output_folder, manifest_path)
+    assert _names(output_folder) == expected
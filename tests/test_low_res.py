@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from low_res import open_reduced, reduced_copy, guided_upsample, low_res_mask
+
+
+def product(size=(803, 611), box=(201, 150, 598, 467)):
+    # A bright product on black, its edges off the 8-pixel grid the reduced copies use
+    img = Image.new('RGB', size, (0, 0, 0))
+    img.paste((230, 200, 180), box)
+    truth = Image.new('L', size, 0)
+    truth.paste(255, box)
+    return img, truth
+
+
+@pytest.mark.parametrize('suffix', ['.jpg', '.png'])
+@pytest.mark.parametrize('size, max_side', [((2000, 1500), 512), ((1001, 333), 300), ((640, 480), 1024)])
+def test_open_reduced_keeps_to_the_bound(tmp_path, suffix, size, max_side):
+    path = str(tmp_path / f'a{suffix}')
+    Image.new('RGB', size, (40, 90, 160)).save(path)
+
+    small = open_reduced(path, max_side)
+
+    assert max(small.size) <= max_side
+    assert max(small.size) > max_side // 2 or small.size == size  # Not reduced further than needed
+    assert small.width / small.height == pytest.approx(size[0] / size[1], rel=0.02)
+
+
+def test_open_reduced_is_exif_rotated(tmp_path):
+    path = str(tmp_path / 'rotated.jpg')
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees
+    Image.new('RGB', (1600, 900), (40, 90, 160)).save(path, exif=exif)
+
+    small = open_reduced(path, 400)
+
+    assert small.height > small.width and max(small.size) <= 400
+
+
+def _small_mask(small):
+    # What the model would predict on the reduced copy: soft on edges, like a real mask
+    return small.convert('L').point(lambda v: 255 if v > 40 else 0)
+
+
+def test_strips_match_a_single_pass():
+    img, _ = product()
+    small = reduced_copy(img, 200)
+    mask = _small_mask(small)
+
+    whole = np.asarray(guided_upsample(mask, small, img, strip_rows=img.height), np.int16)
+    for strip_rows in (1, 7, 128):
+        strips = np.asarray(guided_upsample(mask, small, img, strip_rows=strip_rows), np.int16)
+        assert np.abs(strips - whole).max() <= 1
+
+
+def test_edges_stay_on_the_full_resolution_edges():
+    img, truth = product()
+    calls = []
+
+    def predict(im):
+        calls.append(im.size)
+        return _small_mask(im)
+
+    mask = low_res_mask(img, predict, max_side=200)
+
+    assert calls == [reduced_copy(img, 200).size]
+    assert mask.size == img.size
+    found = np.asarray(mask) >= 128
+    truth = np.asarray(truth) >= 128
+    # The reduced copy blurs each edge over 4 full-resolution pixels; the guide snaps it back to the exact row
+    assert (found != truth).sum() == 0
+
+
+def test_mask_size_must_match_the_guide():
+    img, _ = product()
+    small = reduced_copy(img, 200)
+    with pytest.raises(ValueError):
+        guided_upsample(Image.new('L', (10, 10)), small, img)
+
+
+def test_small_images_go_to_the_model_as_they_are():
+    img, truth = product((150, 100), (40, 30, 110, 70))
+    assert low_res_mask(img, lambda im: truth if im is img else None, max_side=200) is truth
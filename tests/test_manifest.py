@@ -0,0 +1,44 @@
+import os
+
+from manifest import CLASS_BLACK, CLASS_OTHER, STATUS_DONE, Manifest, file_hash
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_only_processed_files_are_hashed(tmp_path):
+    black = write(tmp_path / 'black.jpg', b'black')
+    other = write(tmp_path / 'other.jpg', b'other')
+    with Manifest(str(tmp_path / 'm.sqlite')) as manifest:
+        manifest.record(black, STATUS_DONE, CLASS_BLACK, black)
+        manifest.record(other, STATUS_DONE, CLASS_OTHER)
+
+        assert manifest.lookup(black)['content_hash'] == file_hash(black)
+        assert manifest.lookup(other)['content_hash'] is None
+
+
+def test_touched_file_is_finished_only_when_hashed(tmp_path):
+    black = write(tmp_path / 'black.jpg', b'black')
+    other = write(tmp_path / 'other.jpg', b'other')
+    with Manifest(str(tmp_path / 'm.sqlite')) as manifest:
+        manifest.record(black, STATUS_DONE, CLASS_BLACK, black)
+        manifest.record(other, STATUS_DONE, CLASS_OTHER)
+        for path in (black, other):
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        assert manifest.is_unchanged(black)
+        assert not manifest.is_unchanged(other)
+
+
+def test_missing_file_counts_as_changed(tmp_path):
+    path = write(tmp_path / 'gone.jpg', b'gone')
+    with Manifest(str(tmp_path / 'm.sqlite')) as manifest:
+        manifest.record(path, STATUS_DONE, CLASS_OTHER)
+        os.remove(path)
+
+        assert manifest.finished(path) is None
+        assert not manifest.is_unchanged(path)
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+
+from pipeline import Pipeline, Stage
+
+
+def test_every_item_reaches_the_last_stage():
+    out, lock = [], threading.Lock()
+
+    def collect(item, emit):
+        with lock:
+            out.append(item)
+
+    pipeline = Pipeline([
+        Stage("double", lambda item, emit: (emit(item), emit(item + 1000)), workers=3),
+        Stage("drop odd", lambda item, emit: item % 2 or emit(item), workers=2),
+        Stage("collect", collect, workers=2),
+    ])
+    pipeline.run(range(100))
+
+    assert sorted(out) == sorted([n for n in range(100) if n % 2 == 0] + [n + 1000 for n in range(100) if n % 2 == 0])
+
+
+def test_bounded_queues_hold_back_earlier_stages():
+    release = threading.Event()
+    fed = []
+
+    def items():
+        for number in range(50):
+            fed.append(number)
+            yield number
+
+    def slow(item, emit):
+        release.wait(5)
+
+    pipeline = Pipeline([
+        Stage("pass", lambda item, emit: emit(item), queue_size=2),
+        Stage("slow", slow, queue_size=3),
+    ])
+    runner = threading.Thread(target=pipeline.run, args=(items(),))
+    runner.start()
+    time.sleep(0.2)
+
+    # One item in each stage's hands, its queue full, and one more blocked on a put
+    assert len(fed) <= 1 + 2 + 1 + 3 + 1
+    assert pipeline.queue_depths() == {"pass": 2, "slow": 3}
+    release.set()
+    runner.join(5)
+    assert not runner.is_alive() and len(fed) == 50
+
+
+def test_batches_fill_up_to_the_batch_size():
+    batches = []
+    pipeline = Pipeline([Stage("batch", lambda items, emit: batches.append(list(items)), batch_size=3,
+                               batch_timeout=5)])
+    pipeline.run(range(7))
+
+    # The end of the stream flushes the last, partial batch without waiting out the timeout
+    assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_batch_timeout_flushes_a_partial_batch():
+    batches = []
+    resumed = threading.Event()
+
+    def items():
+        yield 0
+        yield 1
+        resumed.wait(5)  # The source stalls, as a slow scan does
+        yield 2
+
+    pipeline = Pipeline([Stage("resolve", lambda items, emit: (batches.append(list(items)), resumed.set()),
+                               batch_size=10, batch_timeout=0.05)])
+    pipeline.run(items())
+
+    assert batches == [[0, 1], [2]]
+
+
+def test_errors_are_reported_and_the_rest_carries_on():
+    errors, out = [], []
+
+    def fail_on_three(item, emit):
+        if item == 3:
+            raise ValueError("bad item")
+        emit(item)
+
+    pipeline = Pipeline([Stage("check", fail_on_three), Stage("collect", lambda item, emit: out.append(item))],
+                        on_error=lambda stage, item, e: errors.append((stage.name, item, str(e))))
+    pipeline.run(range(6))
+
+    assert errors == [("check", 3, "bad item")]
+    assert out == [0, 1, 2, 4, 5]
+
+
+def test_errors_are_logged_by_default(caplog):
+    def fail(item, emit):
+        raise ValueError("bad item")
+
+    with caplog.at_level(logging.ERROR, logger='pipeline'):
+        Pipeline([Stage("check", fail)]).run([1])
+
+    record, = caplog.records
+    assert record.getMessage() == "stage failed"
+    assert record.fields['stage'] == "check" and str(record.fields['error']) == "bad item"
+
+
+def test_every_worker_stops_when_the_stream_ends():
+    before = set(threading.enumerate())
+    pipeline = Pipeline([Stage("a", lambda item, emit: emit(item), workers=4),
+                         Stage("b", lambda items, emit: None, workers=3, batch_size=4, batch_timeout=0.01),
+                         Stage("c", lambda item, emit: None, workers=2)])
+    pipeline.run(range(20))
+    Pipeline([Stage("a", lambda item, emit: emit(item), workers=2),
+              Stage("b", lambda item, emit: None)]).run([])  # An empty stream ends too
+
+    assert set(threading.enumerate()) - before == set()
@@ -0,0 +1,100 @@
+import os
+import time
+
+import pytest
+
+import scanner
+from scanner import LISTING_DEPTH, DirectoryIndex, scan_images
+
+
+def make_tree(root):
+    """<root>/<product>/ListingImage/*.jpg, plus folders a scan should not read."""
+    for product in ('100', '200'):
+        listing = root / product / 'ListingImage'
+        listing.mkdir(parents=True)
+        (listing / '0.jpg').write_bytes(b'x')
+        (listing / 'notes.txt').write_bytes(b'x')
+        deep = root / product / 'Archive' / 'ListingImage'  # Too deep for the layout
+        deep.mkdir(parents=True)
+        (deep / '1.jpg').write_bytes(b'x')
+    (root / '300' / 'ListingImage2').mkdir(parents=True)
+    (root / '300' / 'ListingImage2' / '0.jpg').write_bytes(b'x')
+
+
+def age(root, seconds=60):
+    # Directories modified within RACY_SECONDS are not indexed
+    past = time.time() - seconds
+    for path, dirs, _ in os.walk(root):
+        os.utime(path, (past, past))
+
+
+def scanned(root, **options):
+    return sorted((os.path.relpath(path, root), sorted(images)) for path, images in scan_images(str(root), **options))
+
+
+def test_scan_finds_listing_folders_at_any_depth_without_a_limit(tmp_path):
+    make_tree(tmp_path)
+
+    assert scanned(tmp_path) == [
+        (os.path.join('100', 'Archive', 'ListingImage'), ['1.jpg']),
+        (os.path.join('100', 'ListingImage'), ['0.jpg']),
+        (os.path.join('200', 'Archive', 'ListingImage'), ['1.jpg']),
+        (os.path.join('200', 'ListingImage'), ['0.jpg']),
+    ]
+
+
+def test_listing_depth_prunes_other_product_folders(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+    listed = []
+    real_list_dir = scanner._list_dir
+    monkeypatch.setattr(scanner, '_list_dir', lambda path, *args: listed.append(path) or real_list_dir(path, *args))
+
+    assert scanned(tmp_path, max_depth=LISTING_DEPTH) == [
+        (os.path.join('100', 'ListingImage'), ['0.jpg']),
+        (os.path.join('200', 'ListingImage'), ['0.jpg']),
+    ]
+    assert not [path for path in listed if 'Archive' in path or 'ListingImage2' in path]
+
+
+def test_index_answers_unchanged_directories(tmp_path, monkeypatch):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    make_tree(root)
+    age(root)
+    index_path = str(tmp_path / 'index.sqlite')
+    first = scanned(root, index_path=index_path)
+
+    monkeypatch.setattr(scanner.os, 'scandir', lambda path: pytest.fail(f"{path} listed again"))
+    assert scanned(root, index_path=index_path) == first
+
+
+def test_index_rows_are_read_per_directory(tmp_path, monkeypatch):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    make_tree(root)
+    age(root)
+    index_path = str(tmp_path / 'index.sqlite')
+    scanned(root, index_path=index_path)
+    queries = []
+    real_rows = DirectoryIndex.rows
+    monkeypatch.setattr(DirectoryIndex, 'rows', lambda self, paths: queries.append(list(paths)) or
+                        real_rows(self, queries[-1]))
+
+    scanned(root, index_path=index_path)
+
+    # The root, then one batch per listed directory that has subdirectories
+    assert queries[0] == [str(root)]
+    assert sorted(len(paths) for paths in queries[1:]) == [1, 1, 1, 2, 2, 3]
+
+
+def test_changed_directory_is_listed_again(tmp_path):
+    root = tmp_path / 'tree'
+    root.mkdir()
+    make_tree(root)
+    age(root)
+    index_path = str(tmp_path / 'index.sqlite')
+    scanned(root, index_path=index_path)
+
+    (root / '100' / 'ListingImage' / '5.png').write_bytes(b'x')
+
+    assert (os.path.join('100', 'ListingImage'), ['0.jpg', '5.png']) in scanned(root, index_path=index_path)
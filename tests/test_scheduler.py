@@ -0,0 +1,154 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import MemoryBudget, pack_batches, run_scheduled
+
+
+def test_budget_caps_the_admitted_costs():
+    budget = MemoryBudget(100)
+
+    assert budget.try_acquire('a', 60)
+    assert not budget.try_acquire('b', 50)
+    assert budget.try_acquire('c', 40)
+    assert budget.in_use == 100
+
+    budget.release('a')
+    budget.release('a')  # Not held any more: nothing happens
+    assert budget.in_use == 40
+    assert budget.try_acquire('b', 50)
+    assert budget.usage() == {'in_use_bytes': 90, 'peak_bytes': 100, 'budget_bytes': 100, 'jobs': 2,
+                              'waiting': 0}
+
+
+def test_max_jobs_caps_the_admitted_jobs():
+    budget = MemoryBudget(None, max_jobs=2)
+
+    assert budget.try_acquire('a', 10**12)
+    assert budget.try_acquire('b', 10**12)
+    assert not budget.try_acquire('c', 1)
+
+
+def test_oversized_job_runs_alone():
+    budget = MemoryBudget(100)
+    assert budget.try_acquire('small', 10)
+    assert not budget.try_acquire('big', 500)  # Waits for the running job
+
+    budget.release('small')
+    assert budget.try_acquire('big', 500)
+    assert not budget.try_acquire('small', 1)  # Nothing beside it
+
+    budget.release('big')
+    assert budget.try_acquire('small', 1)
+
+
+def _acquire_in_thread(budget, key, cost, order):
+    def acquire():
+        budget.acquire(key, cost)
+        order.append(key)
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    return thread
+
+
+def _wait_for_waiters(budget, count):
+    deadline = time.monotonic() + 5
+    while budget.usage()['waiting'] != count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_smaller_jobs_overtake_until_patience_runs_out():
+    budget = MemoryBudget(100, patience=60)
+    assert budget.try_acquire('running', 80)
+    order = []
+    big = _acquire_in_thread(budget, 'big', 60, order)
+    _wait_for_waiters(budget, 1)
+
+    # The big job has not waited long: a small one that fits goes first
+    budget.acquire('small', 10)
+    assert order == [] and budget.in_use == 90
+
+    budget.release('running')
+    budget.release('small')
+    big.join(5)
+    assert order == ['big']
+
+
+def test_jobs_queue_behind_a_job_out_of_patience():
+    budget = MemoryBudget(100, patience=0.05)
+    assert budget.try_acquire('running', 80)
+    order = []
+    big = _acquire_in_thread(budget, 'big', 60, order)
+    _wait_for_waiters(budget, 1)
+    time.sleep(0.1)
+
+    # Fits next to the running job, but the big job has waited longer than the patience
+    small = _acquire_in_thread(budget, 'small', 10, order)
+    _wait_for_waiters(budget, 2)
+    time.sleep(0.1)
+    assert order == []
+
+    budget.release('running')
+    big.join(5)
+    small.join(5)
+    assert order == ['big', 'small']
+    assert budget.in_use == 70
+
+
+def test_admit_releases_on_error():
+    budget = MemoryBudget(100)
+    try:
+        with budget.admit('a', 60):
+            assert budget.in_use == 60
+            raise ValueError
+    except ValueError:
+        pass
+    assert budget.in_use == 0
+
+
+def test_pack_batches_keeps_size_and_cost_limits():
+    costs = {'a': 10, 'b': 30, 'c': 20, 'd': 40, 'e': 25, 'huge': 500}
+
+    assert pack_batches(list(costs), costs, 2) == [['a', 'c'], ['e', 'b'], ['d', 'huge']]
+    # Sorted by cost, cut where the next job would go over the budget, the oversized one alone
+    assert pack_batches(list(costs), costs, 3, budget=60) == [['a', 'c', 'e'], ['b'], ['d'], ['huge']]
+    assert pack_batches([], {}, 4, budget=60) == []
+
+
+def test_run_scheduled_yields_every_item_once():
+    budget = MemoryBudget(100, max_jobs=4)
+    lock = threading.Lock()
+    running = set()
+    alone = []
+    pulled = []
+
+    def items():
+        for number in range(200):
+            pulled.append(number)
+            yield number
+
+    def cost(number):
+        return 500 if number == 37 else 10 + number % 5 * 10
+
+    def work(number):
+        with lock:
+            running.add(number)
+            if number == 37:
+                alone.append(running == {37})
+            assert budget.in_use <= budget.budget or number == 37
+        time.sleep(0.001)
+        with lock:
+            running.discard(number)
+        return number * 2
+
+    with ThreadPoolExecutor(4) as executor:
+        results = run_scheduled(executor, work, items(), budget, cost, window=8)
+        first = next(results)
+        assert len(pulled) <= 9  # Looked ahead at `window` items, not the whole iterable
+        rest = list(results)
+
+    assert sorted([first] + rest) == [number * 2 for number in range(200)]
+    assert alone == [True]
+    assert budget.in_use == 0 and budget.peak <= 500
@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+import pytest
+
+from service import HTTPError, Service, _parse_options
+
+
+class Writer:
+    """Collects what the service writes to a connection."""
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += bytes(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def service():
+    service = Service(workers=1)  # Worker processes only start on the first model request
+    yield service
+    service.close()
+
+
+def exchange(service, request):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(request)
+        reader.feed_eof()
+        writer = Writer()
+        await service.handle_connection(reader, writer)
+        return writer.data
+
+    head, _, body = asyncio.run(run()).partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(body) if body else None
+
+
+@pytest.mark.parametrize('length', [b'abc', b'-5', b'1.5'])
+def test_bad_content_length_is_rejected(service, length):
+    status, body = exchange(service, b'POST /classify HTTP/1.1\r\nContent-Length: ' + length + b'\r\n\r\nxyz')
+
+    assert status == 400
+    assert 'Content-Length' in body['error']
+
+
+@pytest.mark.parametrize('background', ['fff', 'ff00', 'ff00ff00', 'zzzzzz'])
+def test_bad_background_is_rejected(service, background):
+    request = f'POST /flatten?background={background} HTTP/1.1\r\nContent-Length: 3\r\n\r\nxyz'
+    status, body = exchange(service, request.encode('latin-1'))
+
+    assert status == 400
+    assert 'background' in body['error'] or 'hex' in body['error']
+
+
+def test_background_accepts_hex_rgb():
+    assert _parse_options('background=%23ff8800', None)['background'] == (255, 136, 0)
+    assert _parse_options('background=0000ff', None)['background'] == (0, 0, 255)
+
+
+def test_bad_query_parameter_raises_http_400():
+    with pytest.raises(HTTPError) as error:
+        _parse_options('background=ff', None)
+
+    assert error.value.status == 400
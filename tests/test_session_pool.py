@@ -0,0 +1,68 @@
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import benchmark
+import session_pool
+
+
+@pytest.fixture
+def folders(tmp_path):
+    input_folder, output_folder = tmp_path / 'in', tmp_path / 'out'
+    input_folder.mkdir()
+    output_folder.mkdir()
+    for seed in range(5):
+        benchmark._product_image((200, 160), True, seed).save(input_folder / f'{seed}.jpg', quality=95)
+    (input_folder / 'broken.jpg').write_bytes(b'not an image')
+    return str(input_folder), str(output_folder)
+
+
+@pytest.mark.parametrize('batch_size', [1, 4])
+def test_outputs_are_encoded_off_the_inference_thread(folders, monkeypatch, batch_size):
+    input_folder, output_folder = folders
+    threads, reported = [], []
+    save = session_pool._save
+    monkeypatch.setattr(session_pool, '_save',
+                        lambda *args: threads.append(threading.current_thread()) or save(*args))
+    report = session_pool.report_results
+    monkeypatch.setattr(session_pool, 'report_results',
+                        lambda results, *args: report((reported.append(result) or result for result in results), *args))
+
+    with benchmark.fake_remover():
+        session_pool.remove_background(input_folder, output_folder, batch_size=batch_size, encode_workers=2)
+
+    assert len(threads) == 5
+    assert all(thread.name.startswith('encode') for thread in threads)
+    assert sorted(os.listdir(output_folder)) == [f'{seed}.jpg' for seed in range(5)]
+    # Every job reported once, the unreadable one with its error
+    jobs = session_pool.collect_jobs(input_folder, output_folder)
+    assert sorted(input_path for input_path, _, _ in reported) == sorted(input_path for input_path, _ in jobs)
+    errors = {os.path.basename(input_path): error for input_path, error, _ in reported}
+    assert errors.pop('broken.jpg') is not None
+    assert set(errors.values()) == {None}
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason="workers must inherit the fake model")
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_workers_save_their_own_images(folders, monkeypatch, batch_size):
+    input_folder, output_folder = folders
+    returned = []
+    run_scheduled = session_pool.run_scheduled
+
+    def recording(*args):
+        for result in run_scheduled(*args):
+            returned.append(result)
+            yield result
+
+    monkeypatch.setattr(session_pool, 'run_scheduled', recording)
+
+    with benchmark.fake_remover():
+        session_pool.remove_background(input_folder, output_folder, workers=2, batch_size=batch_size)
+
+    assert sorted(os.listdir(output_folder)) == [f'{seed}.jpg' for seed in range(5)]
+    results = [result for batch in returned for result in batch] if batch_size > 1 else returned
+    # Only status and timings come back from the workers, never a rendered image
+    assert len(results) == 6 and all(len(result) == 3 for result in results)
+    assert sum(error is not None for _, error, _ in results) == 1
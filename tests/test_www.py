@@ -0,0 +1,145 @@
+import builtins
+import os
+import threading
+
+from PIL import Image
+
+import benchmark
+import dedup
+import www
+from manifest import Manifest, STATUS_DONE, CLASS_BLACK
+
+
+def _product_folder(root):
+    folder = os.path.join(root, 'products', '100001', 'ListingImage')
+    os.makedirs(folder)
+    path = os.path.join(folder, '0.jpg')
+    benchmark._product_image((200, 160), True, 0).save(path, quality=95)
+    return os.path.join(root, 'products'), path
+
+
+def _count_model_calls(monkeypatch, fake):
+    calls = []
+    remove = fake.remove
+
+    def counting_remove(data, session=None, only_mask=False, **kwargs):
+        calls.append(only_mask)
+        return remove(data, session, only_mask, **kwargs)
+
+    monkeypatch.setattr(fake, 'remove', counting_remove)
+    return calls
+
+
+def _corner(path):
+    with Image.open(path) as img:
+        return img.convert('RGB').getpixel((0, 0))
+
+
+def test_new_background_is_rendered_from_the_cache(tmp_path, monkeypatch):
+    folder, image_path = _product_folder(str(tmp_path))
+    with open(image_path, 'rb') as original_file:
+        original = original_file.read()
+    cache_dir = str(tmp_path / 'cache')
+    manifest_path = str(tmp_path / 'manifest.sqlite')
+
+    with benchmark.fake_remover() as fake:
+        calls = _count_model_calls(monkeypatch, fake)
+        www.process_products_folder(folder, cache_dir, manifest_path=manifest_path, use_color_key=False)
+        assert len(calls) == 1
+        assert min(_corner(image_path)) > 240  # On white
+
+        # The file now holds the white output; the red one is made from the kept original and mask
+        www.process_products_folder(folder, cache_dir, background_color=(255, 0, 0), manifest_path=manifest_path,
+                                    use_color_key=False)
+        assert len(calls) == 1
+        red, green, blue = _corner(image_path)
+        assert red > 240 and green < 20 and blue < 20
+
+        # Same settings again: nothing to do
+        mtime = os.stat(image_path).st_mtime_ns
+        www.process_products_folder(folder, cache_dir, background_color=(255, 0, 0), manifest_path=manifest_path,
+                                    use_color_key=False)
+        assert os.stat(image_path).st_mtime_ns == mtime
+        assert len(calls) == 1
+
+    with Manifest(manifest_path) as manifest:
+        row = manifest.lookup(image_path)
+    assert row['status'] == STATUS_DONE and row['classification'] == CLASS_BLACK
+    assert row['source_hash'] == www.content_hash(original)
+
+
+def test_without_a_cache_finished_images_are_left_alone(tmp_path):
+    folder, image_path = _product_folder(str(tmp_path))
+    manifest_path = str(tmp_path / 'manifest.sqlite')
+    with benchmark.fake_remover():
+        www.process_products_folder(folder, manifest_path=manifest_path, use_color_key=False)
+        mtime = os.stat(image_path).st_mtime_ns
+        www.process_products_folder(folder, background_color=(255, 0, 0), manifest_path=manifest_path,
+                                    use_color_key=False)
+    assert os.stat(image_path).st_mtime_ns == mtime
+
+
+def test_duplicate_images_are_processed_once(tmp_path, monkeypatch):
+    folder, image_path = _product_folder(str(tmp_path))
+    copy_path = os.path.join(folder, '100002', 'ListingImage', '0.jpg')
+    os.makedirs(os.path.dirname(copy_path))
+    with open(image_path, 'rb') as original_file:
+        original = original_file.read()
+    with open(copy_path, 'wb') as copy_file:
+        copy_file.write(original)
+    manifest_path = str(tmp_path / 'manifest.sqlite')
+    hashed, opened, streamed = [], [], []
+    monkeypatch.setattr(www, 'content_hash', _counting(www.content_hash, hashed))
+    monkeypatch.setattr(dedup, 'file_hash', _counting(dedup.file_hash, streamed))
+    monkeypatch.setattr(www, 'open', _counting(builtins.open, opened), raising=False)
+    monkeypatch.setattr(Manifest, 'record', _no_file_hash(Manifest.record))
+
+    with benchmark.fake_remover() as fake:
+        calls = _count_model_calls(monkeypatch, fake)
+        www.process_products_folder(folder, manifest_path=manifest_path, use_color_key=False)
+
+    assert len(calls) == 1
+    with open(image_path, 'rb') as output_file, open(copy_path, 'rb') as copy_file:
+        output = output_file.read()
+        assert copy_file.read() == output
+    # Both originals hashed in chunks while grouping; only the leader read whole, and the output
+    # hashed once before it was written
+    assert sorted(streamed) == sorted([image_path, copy_path])
+    assert len(opened) == 1 and opened[0] in (image_path, copy_path)
+    assert sorted(map(len, hashed)) == sorted([len(original), len(output)])
+    with Manifest(manifest_path) as manifest:
+        for path in (image_path, copy_path):
+            row = manifest.lookup(path)
+            assert row['status'] == STATUS_DONE and row['classification'] == CLASS_BLACK
+            assert row['content_hash'] == www.content_hash(output)
+
+
+def _counting(function, calls):
+    def counting(data, *args, **kwargs):
+        calls.append(data)
+        return function(data, *args, **kwargs)
+    return counting
+
+
+def _no_file_hash(record):
+    def checked(self, path, *args, **kwargs):
+        # Black rows get the output's hash from the caller instead of reading the file back
+        if len(args) >= 2 and args[1] == CLASS_BLACK and args[0] == STATUS_DONE:
+            assert kwargs.get('content_hash')
+        return record(self, path, *args, **kwargs)
+    return checked
+
+
+def test_outputs_are_encoded_off_the_inference_thread(tmp_path, monkeypatch):
+    folder, image_path = _product_folder(str(tmp_path))
+    threads = []
+    encode = www.encode_outputs
+    monkeypatch.setattr(www, 'encode_outputs',
+                        lambda *args, **kwargs: threads.append(threading.current_thread()) or encode(*args, **kwargs))
+
+    with benchmark.fake_remover():
+        www.process_products_folder(folder, use_color_key=False)
+
+    assert len(threads) == 1 and threads[0] is not threading.current_thread()
+    assert threads[0].name.startswith('encode')
+    assert min(_corner(image_path)) > 240
@@ -1,66 +1,324 @@
-from rembg import remove
-from PIL import Image
+from PIL import Image, ImageOps
 import os
 import io
-import numpy as np
+import json
+import logging
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from corner_probe import image_corners
+from compositing import cutout, flatten_image, WHITE
+from mask_cache import MaskCache, content_hash
+from color_key import color_key_mask, PATH_COLOR_KEY, PATH_CACHE, PATH_MODEL
+from session_pool import get_session, DEFAULT_MODEL
+from batch_inference import BatchInferenceEngine
+from low_res import reduced_copy, guided_upsample
+from lazy_import import LazyModule, wants_import_profile, print_import_profile
+from metrics import get_metrics, reset_metrics, setup_logging, log_event, DEFAULT_METRICS_NAME
+from scheduler import MemoryBudget, job_cost, default_budget, run_scheduled, SESSION_BYTES
+from dedup import Deduplicator
+from file_copy import copy_file
+from encoder import OutputSpec, encode_outputs, write_outputs, DEFAULT_ENCODE_WORKERS
+from manifest import (open_manifest, DEFAULT_MANIFEST_NAME, STATUS_CLASSIFIED, STATUS_DONE, STATUS_ERROR,
+                      CLASS_BLACK, CLASS_OTHER)
+
+rembg = LazyModule('rembg')  # Only needed once an image reaches the model
+
+log = logging.getLogger('www')
+log.addHandler(logging.NullHandler())  # Silent when imported as a library; entry points call setup_logging
 
 def is_background_black(image):
-    # Convert image to numpy array
-    img_array = np.array(image)
-    
-    # Get the corners of the image
-    corners = [
-        img_array[0, 0],
-        img_array[0, -1],
-        img_array[-1, 0],
-        img_array[-1, -1]
-    ]
+    # Get the corners of the image without copying it into an array
+    corners = image_corners(image)
     
     # Check if corners are black (RGB values close to 0)
     threshold = 30  # Allowing some variation in black
-    return all(np.all(corner < threshold) for corner in corners)
+    return all(max(corner) < threshold for corner in corners)
+
+def get_mask(img, digest, mask_cache=None, use_color_key=False, engine=None, max_side=None):
+    """
+    Return (mask, path) for `img`. With `use_color_key`, a uniform black
+    background is keyed out directly (see color_key); otherwise the mask comes from `mask_cache` when the source with
+    content hash `digest` was seen before, and from the model as a last resort (batched with other
+    images when `engine` is a BatchInferenceEngine). With `max_side`, the model
+    sees a copy reduced to that size and the mask is upscaled (see low_res).
+    """
+    if use_color_key:
+        mask, _ = color_key_mask(img)
+        if mask is not None:
+            return mask, PATH_COLOR_KEY
+
+    # Reduced-resolution masks differ slightly, so they are cached separately
+    model_name = f"{DEFAULT_MODEL}@{max_side}" if max_side else DEFAULT_MODEL
+    key = mask_cache.key(digest, model_name) if mask_cache is not None else None
+    mask = mask_cache.get(key) if key is not None else None
+    if mask is not None:
+        return mask, PATH_CACHE
+
+    small = reduced_copy(img, max_side) if max_side else img
+    if engine is not None:
+        mask = engine.submit(small).result()
+    else:
+        mask = rembg.remove(small, session=get_session(), only_mask=True)
+    if small.size != img.size:
+        mask = guided_upsample(mask, small, img)
+    if key is not None:
+        mask_cache.put(key, mask)
+    return mask, PATH_MODEL
+
+def process_image(image_path, mask_cache=None, background_color=WHITE, quality=95, use_color_key=False, stats=None,
+                  engine=None, stats_lock=None, max_side=None, outputs=None, source_hash=None, manifest=None):
+    # Returns (classification, hash of the original, hash of the output written in place):
+    # CLASS_BLACK with both, CLASS_OTHER with None twice, or None on error (with the original's
+    # hash once it is known). `stats` (a Counter) counts which path produced each mask, under `stats_lock` if given. `outputs`
+    # (encoder.OutputSpec) are written next to the image; by default one JPEG in place.
+    # With a `mask_cache`, the original of every image overwritten is kept in it, and
+    # `source_hash` renders the image again from that original (e.g. onto another
+    # background) instead of from the file, which is an earlier output. The original's
+    # hash goes to `manifest` before the file is overwritten
+    classification, digest, rendered = render_image(image_path, mask_cache, background_color, use_color_key, stats,
+                                                    engine, stats_lock, max_side, source_hash, manifest)
+    if rendered is None:
+        return classification, digest, None
+    return save_image(image_path, rendered, digest, outputs or (OutputSpec(quality=quality),))
 
-def process_image(image_path):
+def render_image(image_path, mask_cache=None, background_color=WHITE, use_color_key=False, stats=None, engine=None,
+                 stats_lock=None, max_side=None, source_hash=None, manifest=None):
+    # The decode, classify, mask and composite half of process_image (same arguments).
+    # Returns (classification, hash of the original, rendered): `rendered` is the
+    # (composited image, mask path) for save_image when the image is black, else None
+    metrics = get_metrics()
+    digest = source_hash
     try:
-        # Open and process image
-        with open(image_path, 'rb') as input_file:
-            # First check if the image has a black background
-            with Image.open(image_path) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                if is_background_black(img):
-                    # Remove background and convert to white
-                    image_data = remove(input_file.read())
-                    with Image.open(io.BytesIO(image_data)) as processed_img:
-                        # Convert transparent pixels to white
-                        background = Image.new('RGB', processed_img.size, (255, 255, 255))
-                        background.paste(processed_img, (0, 0), processed_img.convert('RGBA'))
-                        # Save back to the same location
-                        background.save(image_path, 'JPEG', quality=95)
-                        print(f"Processed (black background removed): {image_path}")
-                else:
-                    print(f"Skipped (no black background): {image_path}")
-                    
+        # Decode the image once; it is classified, cut out and composited in memory
+        with metrics.timer('decode'):
+            if source_hash is not None:
+                source_bytes = mask_cache.get_source(source_hash) if mask_cache is not None else None
+                if source_bytes is None:
+                    digest = None  # Evicted: from now on the file is treated as a new image
+                    raise FileNotFoundError(f"original {source_hash} is no longer in the mask cache")
+            else:
+                with open(image_path, 'rb') as input_file:
+                    source_bytes = input_file.read()
+            img = Image.open(io.BytesIO(source_bytes))
+            img.load()
+
+        with img:
+            # First check if the image has a black background (corner pixels only)
+            with metrics.timer('classify'):
+                black = is_background_black(img)
+            if black:
+                # rembg predicts on the EXIF-rotated image, so cut out that one
+                img = ImageOps.exif_transpose(img)
+
+                digest = digest or content_hash(source_bytes)
+                if mask_cache is not None and source_hash is None:
+                    mask_cache.put_source(digest, source_bytes)  # The file is about to be overwritten
+                if manifest is not None:
+                    manifest.record(image_path, STATUS_CLASSIFIED, CLASS_BLACK, source_hash=digest)
+
+                # Remove background; the model only runs when keying and the cache can't help
+                with metrics.sampled('infer'):
+                    mask, path = get_mask(img, digest, mask_cache, use_color_key, engine, max_side)
+                if stats is not None:
+                    if stats_lock is not None:
+                        with stats_lock:
+                            stats[path] += 1
+                    else:
+                        stats[path] += 1
+
+                # Convert transparent pixels to the background color
+                with metrics.timer('composite'):
+                    background = flatten_image(cutout(img, mask), background_color)
+                return CLASS_BLACK, digest, (background, path)
+            else:
+                metrics.inc('images_skipped')
+                log_event(log, "skipped, no black background", logging.DEBUG, image=image_path)
+                return CLASS_OTHER, None, None
+
     except Exception as e:
-        print(f"Error processing {image_path}: {e}")
+        metrics.inc('errors')
+        log_event(log, "processing failed", logging.ERROR, image=image_path, error=e)
+        return None, digest, None
 
-def process_products_folder(main_folder):
-    # Walk through all subdirectories
+def save_image(image_path, rendered, digest, outputs):
+    # The encode and write half of process_image, for the `rendered` result of
+    # render_image; returns what process_image does
+    background, path = rendered
+    metrics = get_metrics()
+    try:
+        # Save back to the same location (and any size variants beside it)
+        encoded = encode_outputs(background, image_path, outputs)
+        write_outputs(encoded)
+    except Exception as e:
+        metrics.inc('errors')
+        log_event(log, "processing failed", logging.ERROR, image=image_path, error=e)
+        return None, digest, None
+    # Hashed here, so the manifest doesn't read the file back to record it
+    output_hash = next((content_hash(output) for output_path, output in encoded if output_path == image_path), None)
+    metrics.inc('images_processed')
+    log_event(log, "background removed", path=path, image=image_path)
+    return CLASS_BLACK, digest, output_hash
+
+def render_settings(background_color, outputs):
+    # What an output depends on besides the original and its mask, as recorded in the manifest
+    return json.dumps({'background': list(background_color), 'outputs': [vars(spec) for spec in outputs]},
+                      sort_keys=True)
+
+def find_images(main_folder, manifest, outputs=(), settings=None):
+    # Walk through all subdirectories, skipping files unchanged since an earlier run
+    # and the size variants of `outputs` written by one. Yields (image path, source hash):
+    # with `settings` (see render_settings), black images finished with other settings, or
+    # interrupted after their original was kept, come with the hash to render them from
+    metrics = get_metrics()
+    suffixes = tuple(spec.suffix for spec in outputs if spec.suffix)
+    start = time.perf_counter()
     for root, dirs, files in os.walk(main_folder):
+        metrics.observe('walk', time.perf_counter() - start)
+        metrics.inc('directories_scanned')
         for file in files:
-            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
+            if file.lower().endswith(('.jpg', '.jpeg', '.png')) and not (
+                    suffixes and os.path.splitext(file)[0].endswith(suffixes)):
                 image_path = os.path.join(root, file)
-                process_image(image_path)
+                row = manifest.lookup(image_path) if settings is not None else None
+                if row is not None and row['source_hash'] and row['classification'] == CLASS_BLACK and (
+                        row['status'] == STATUS_CLASSIFIED or row['settings'] != settings):
+                    if row['status'] == STATUS_CLASSIFIED or manifest.is_unchanged(image_path):
+                        yield image_path, row['source_hash']
+                        continue
+                if not manifest.is_unchanged(image_path):
+                    yield image_path, None
+        start = time.perf_counter()
+
+def record_result(manifest, image_path, classification, source_hash=None, settings=None, output_hash=None):
+    if classification is None:
+        # The original stays known, so a later run can still render it from the mask cache
+        status = STATUS_CLASSIFIED if source_hash else STATUS_ERROR
+        manifest.record(image_path, status, CLASS_BLACK if source_hash else None, source_hash=source_hash)
+    elif classification == CLASS_BLACK:
+        # Black images were rewritten in place, so the stat/hash recorded is the output's
+        manifest.record(image_path, STATUS_DONE, classification, image_path, source_hash=source_hash,
+                        settings=settings, content_hash=output_hash)
+    else:
+        manifest.record(image_path, STATUS_DONE, classification)
+
+def process_products_folder(main_folder, mask_cache_dir=None, background_color=WHITE, quality=95,
+                            manifest_path=None, use_color_key=False, batch_size=1, max_side=None,
+                            metrics_path=None, profile_every=0, memory_budget=None, dedup=True,
+                            perceptual_dedup=False, outputs=None, encode_workers=DEFAULT_ENCODE_WORKERS):
+    # Stage timings and counters go to `metrics_path` (JSON, or Prometheus text for *.prom)
+    # while the run goes; every `profile_every`th image per stage is profiled.
+    # With `batch_size` above 1, images start only while their estimated peak memory
+    # fits in `memory_budget` bytes (by default most of the available memory).
+    # With `dedup`, a photo found in several folders is processed once and the
+    # result copied over the other copies (`perceptual_dedup`: near-identical too, see dedup).
+    # `outputs` (encoder.OutputSpec) replace the one in-place JPEG at `quality`, e.g.
+    # encoder.WEB_OUTPUTS adds WebP listing and thumbnail sizes beside each image. They are
+    # encoded and written on `encode_workers` threads of their own, while the next images
+    # are decoded and go through the model
+    outputs = outputs or (OutputSpec(quality=quality),)
+    metrics = reset_metrics(profile_every, os.path.join(main_folder, "profiles"))
+    if metrics_path:
+        metrics.start_export(metrics_path)
+
+    # Masks are cached by source content, so re-runs skip inference
+    mask_cache = MaskCache(mask_cache_dir) if mask_cache_dir else None
+    # With the originals kept in the cache, images finished with other settings are rendered again
+    settings = render_settings(background_color, outputs) if mask_cache is not None else None
+    stats = Counter()
+    deduplicator = Deduplicator(perceptual_dedup) if dedup else None
+
+    def duplicate_done(image_path, _, result):
+        # Same content as `leader_path`, which has been processed in place: take its outputs
+        leader_path, classification, source_hash, output_hash = result
+        if classification == CLASS_BLACK:
+            try:
+                for spec in outputs:
+                    copy_file(spec.path_for(leader_path), spec.path_for(image_path))
+                metrics.inc('duplicates_reused')
+                log_event(log, "background removal reused", image=image_path)
+            except OSError as e:
+                metrics.inc('errors')
+                log_event(log, "copy failed", logging.ERROR, image=image_path, error=e)
+                classification = None
+        record_result(manifest, image_path, classification, source_hash, settings, output_hash)
+
+    def claimed(images):
+        # Only the first image of each group of duplicates is processed; the rest wait for its result.
+        # Images rendered again are grouped by their originals. New files are hashed in chunks, so
+        # the images looked ahead at by the scheduler hold no file contents; the job reads its own
+        for image_path, source_hash in images:
+            if deduplicator is None or deduplicator.claim(image_path, image_path, duplicate_done, source_hash):
+                yield image_path, source_hash
+
+    def finished(image_path, classification, source_hash, output_hash):
+        record_result(manifest, image_path, classification, source_hash, settings, output_hash)
+        if deduplicator is not None:
+            deduplicator.finish(image_path, (image_path, classification, source_hash, output_hash))
+
+    saving = deque()  # (image path, future of save_image), in the order the images were rendered
+
+    def rendered(image_path, classification, source_hash, result):
+        if result is None:
+            finished(image_path, classification, source_hash, None)
+        else:
+            saving.append((image_path, encoder.submit(save_image, image_path, result, source_hash, outputs)))
+        # Composited images waiting for the encoder hold their pixels, so only a few may wait
+        while saving and (saving[0][1].done() or len(saving) > 2 * encode_workers):
+            image_path, future = saving.popleft()
+            finished(image_path, *future.result())
+
+    # Files finished in an earlier run and unchanged since are skipped
+    with open_manifest(manifest_path) as manifest, \
+            ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix='encode') as encoder:
+        if batch_size == 1:
+            for image_path, source_hash in claimed(find_images(main_folder, manifest, outputs, settings)):
+                rendered(image_path, *render_image(image_path, mask_cache, background_color, use_color_key, stats,
+                                                   max_side=max_side, source_hash=source_hash, manifest=manifest))
+        else:
+            # `batch_size` images are decoded and composited on threads at once, and
+            # the ones that need the model share one session call
+            stats_lock = threading.Lock()
+            budget = MemoryBudget(memory_budget if memory_budget is not None else default_budget(SESSION_BYTES),
+                                  max_jobs=batch_size)
+            metrics.gauge('memory', budget.usage)
+            with BatchInferenceEngine(lambda: get_session().inner_session, batch_size) as engine, \
+                    ThreadPoolExecutor(max_workers=batch_size) as executor:
+                def run(image):
+                    image_path, source_hash = image
+                    return (image_path,) + render_image(image_path, mask_cache, background_color, use_color_key,
+                                                        stats, engine, stats_lock, max_side, source_hash, manifest)
+
+                # Small images are started together, and one too big for the budget runs on its own
+                images = claimed(find_images(main_folder, manifest, outputs, settings))
+                for result in run_scheduled(executor, run, images, budget, cost=lambda image: job_cost(image[0])):
+                    rendered(*result)
+        while saving:
+            image_path, future = saving.popleft()
+            finished(image_path, *future.result())
+
+    metrics.stop_export()
+    print(f"Background removal paths: {PATH_COLOR_KEY} {stats[PATH_COLOR_KEY]}, "
+          f"{PATH_CACHE} {stats[PATH_CACHE]}, {PATH_MODEL} {stats[PATH_MODEL]}")
+    print(metrics.summary())
+    if deduplicator is not None:
+        print(deduplicator.summary(metrics))
 
-if __name__ == '__main__':
+if __name__ == '__main__' and wants_import_profile():
+    print_import_profile('www')
+elif __name__ == '__main__':
     # Ask user for the main products folder path
     products_folder = input("Enter the main products folder path: ").strip()
+    mask_cache_dir = input("Enter the mask cache folder path (leave empty to disable): ").strip() or None
 
     # Check if folder exists
     if not os.path.exists(products_folder):
         print(f"Error: Folder '{products_folder}' does not exist.")
     else:
         print("Processing images... This may take a while.")
-        process_products_folder(products_folder)
+        setup_logging()
+        manifest_path = os.path.join(products_folder, DEFAULT_MANIFEST_NAME)
+        process_products_folder(products_folder, mask_cache_dir, manifest_path=manifest_path,
+                                metrics_path=os.path.join(products_folder, DEFAULT_METRICS_NAME))
         print("Processing complete!")
\ No newline at end of file